@@ -1,67 +1,63 @@
 try:
-    from coherelabs import c4ai as Coherelabs
-    from qwen import Qwen3Omni
-    from qwen import Qwen3VL
-    from amd import gpt_oss_120b
+    import registry
+    from registry import register_provider, load_plugins, models_payload
 
 except ImportError:
-    from .coherelabs import c4ai as Coherelabs
-    from .qwen import Qwen3Omni
-    from .qwen import Qwen3VL
-    from .amd import gpt_oss_120b
+    from . import registry
+    from .registry import register_provider, load_plugins, models_payload
 
 
-# Collect model lists (normalize to list)
-coherelabs_models = list(Coherelabs().model_aliases.keys())
-qwen3omni_models = list(Qwen3Omni().model_aliases)
-gpt_oss_120b_models = list(gpt_oss_120b().model_aliases)
-qwen3vl_models = list(Qwen3VL().model_aliases)
+# Built-in providers. Modules are imported on first use of one of their models.
+register_provider("Coherelabs", ".coherelabs:c4ai",
+                  ["command-a", "command-r-plus", "command-r", "command-r7b"])
+register_provider("Qwen3Omni", ".qwen:Qwen3Omni", ["Qwen3Omni", "Qwen3Omni-think"])
+register_provider("Qwen3VL", ".qwen:Qwen3VL", ["Qwen3VL"])
+register_provider("gpt_oss_120b", ".amd:gpt_oss_120b", ["gpt-oss-120b", "gpt-oss-20b"])
 
-provider_and_models = {
-    "Coherelabs": coherelabs_models,
-    "Qwen3Omni": qwen3omni_models,
-    "Qwen3VL": qwen3vl_models,
-    "gpt_oss_120b": gpt_oss_120b_models
+load_plugins()
+
+# Provider classes and the shared transport, imported lazily
+_LAZY = {
+    "Coherelabs": "Coherelabs",
+    "Qwen3Omni": "Qwen3Omni",
+    "Qwen3VL": "Qwen3VL",
+    "gpt_oss_120b": "gpt_oss_120b",
 }
-Provider_list = list(provider_and_models.keys())
 
 
-def find_provider(model_name):
-    """Given a model name, find the provider."""
-    for provider, models in provider_and_models.items():
-        if model_name in models:
-            return provider
-    return None
+def __getattr__(name):
+    if name in _LAZY:
+        return registry._specs[_LAZY[name]].load()
+    if name == "transport":
+        try:
+            from transport import transport
+        except ImportError:
+            from .transport import transport
+        return transport
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
+# Live views kept up to date by register_provider()
+provider_and_models = registry.provider_and_models
+Provider_list = registry.provider_list
 
-def make_workable(model_name):
-    """Given a model name, return the provider class and workable model name."""
-    provider_name = find_provider(model_name)
-    if not provider_name:
-        raise ValueError(f"Model '{model_name}' not found in any provider.")
 
-    if provider_name == "Coherelabs":
-        provider = Coherelabs()
-    elif provider_name == "Qwen3Omni":
-        provider = Qwen3Omni()
-    elif provider_name == "Qwen3VL":
-        provider = Qwen3VL()
-    elif provider_name == "gpt_oss_120b":
-        provider = gpt_oss_120b()
-    else:
-        raise ValueError(f"Unknown provider '{provider_name}'.")
+def find_provider(model_name):
+    """Given a model name, find the provider."""
+    spec = registry.lookup(model_name)
+    return spec.name if spec else None
 
-    return provider
+
+def make_workable(model_name):
+    """Given a model name, return the shared provider engine that serves it."""
+    return registry.engine(model_name)
 
 
 __all__ = [
-    "Coherelabs",
-    "Qwen3Omni",
-    'Qwen3VL',
-    "gpt_oss_120b",
     "Provider_list",
     "provider_and_models",
     'find_provider',
-    'make_workable'
+    'make_workable',
+    "register_provider",
+    "models_payload"
 ]
@@ -0,0 +1,101 @@
+"""
+Adaptive concurrency limit for one upstream endpoint.
+
+The limit moves with what the endpoint shows us, gradient style (after Vegas
+and Netflix's gradient limiter). The baseline is the lowest time to first
+token seen in the last BASELINE_WINDOW seconds, i.e. the endpoint with no
+queue; current latency is a fast EWMA. When the window runs out the baseline
+restarts from current latency, which lets the limit probe upwards again
+after the upstream has changed. Each sample moves the limit a fifth of the
+way towards limit * gradient + sqrt(limit), where the gradient is
+UPSTREAM_LIMIT_TOLERANCE * baseline / current, capped to [0.5, 1]. While
+latency stays near the baseline the limit grows by the sqrt(limit) headroom,
+and once latency rises past the tolerance it shrinks in proportion. A failed
+call halves the limit outright (multiplicative decrease). Samples taken
+while the endpoint is using less than half its limit do not grow it, so an
+idle endpoint does not inflate a limit it never tested.
+
+The limit is off by default. A slot is held for the whole stream but only
+the first token is sampled, and on a shared Space that time is mostly the
+Space's own queue, so turn it on for endpoints you run yourself.
+
+    UPSTREAM_ADAPTIVE_LIMIT     "1" limits in-flight calls per endpoint
+    UPSTREAM_LIMIT_INITIAL      starting in-flight limit per endpoint (8)
+    UPSTREAM_LIMIT_MIN          lowest the limit may go (1)
+    UPSTREAM_LIMIT_MAX          highest the limit may go (64)
+    UPSTREAM_LIMIT_TOLERANCE    latency over baseline tolerated before shrinking (1.5)
+"""
+import math
+import os
+import time
+
+
+ENABLED = os.environ.get("UPSTREAM_ADAPTIVE_LIMIT", "0") == "1"
+INITIAL = float(os.environ.get("UPSTREAM_LIMIT_INITIAL", 8))
+MINIMUM = float(os.environ.get("UPSTREAM_LIMIT_MIN", 1))
+MAXIMUM = float(os.environ.get("UPSTREAM_LIMIT_MAX", 64))
+TOLERANCE = float(os.environ.get("UPSTREAM_LIMIT_TOLERANCE", 1.5))
+
+# Seconds the lowest first-token time is kept as the baseline
+BASELINE_WINDOW = 60.0
+# EWMA weights of current latency and of each limit update
+SHORT_ALPHA = 0.3
+SMOOTHING = 0.2
+BACKOFF = 0.5
+
+
+class AdaptiveLimit:
+    """In-flight limit of one endpoint. Not thread-safe; the replica table locks it."""
+
+    def __init__(self, initial=INITIAL, minimum=MINIMUM, maximum=MAXIMUM, tolerance=TOLERANCE):
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.tolerance = tolerance
+        self.baseline = None  # lowest seconds to first token this window
+        self.baseline_at = 0.0
+        self.current = None   # fast EWMA seconds to first token
+        self.increases = 0
+        self.decreases = 0
+
+    def allows(self, in_flight):
+        return in_flight < max(1, int(self.limit))
+
+    def _set(self, limit):
+        limit = min(max(limit, self.minimum), self.maximum)
+        if int(limit) > int(self.limit):
+            self.increases += 1
+        elif int(limit) < int(self.limit):
+            self.decreases += 1
+        self.limit = limit
+
+    def sample(self, seconds, in_flight):
+        """A call got its first token after `seconds` with `in_flight` calls running."""
+        now = time.monotonic()
+        if self.baseline is None:
+            self.baseline = self.current = seconds
+            self.baseline_at = now
+            return
+        self.current += SHORT_ALPHA * (seconds - self.current)
+        if seconds <= self.baseline:
+            self.baseline, self.baseline_at = seconds, now
+        elif now - self.baseline_at > BASELINE_WINDOW:
+            self.baseline, self.baseline_at = self.current, now
+
+        gradient = max(0.5, min(1.0, self.tolerance * self.baseline / max(self.current, 1e-6)))
+        target = self.limit * gradient
+        if gradient >= 1.0 and in_flight >= self.limit / 2:
+            target += math.sqrt(self.limit)
+        self._set(self.limit + SMOOTHING * (target - self.limit))
+
+    def failed(self):
+        self._set(self.limit * BACKOFF)
+
+    def as_dict(self):
+        return {
+            "limit": round(self.limit, 2),
+            "baseline_ttft_ms": round(self.baseline * 1000, 1) if self.baseline is not None else None,
+            "current_ttft_ms": round(self.current * 1000, 1) if self.current is not None else None,
+            "increases": self.increases,
+            "decreases": self.decreases,
+        }
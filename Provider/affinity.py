@@ -0,0 +1,128 @@
+"""
+Conversation affinity index.
+
+Maps a hash of a chat history to the upstream conversation that already
+holds it, so a follow-up turn can be sent as just the new user message
+instead of opening a new conversation and re-uploading the transcript.
+
+A conversation is claimed by one call at a time. Concurrent calls with the
+same history (regenerations, `n` > 1) open conversations of their own
+instead of branching the same one at once.
+
+    CONVERSATION_AFFINITY       "0" disables affinity
+    CONVERSATION_AFFINITY_MAX   conversations remembered (4096)
+    CONVERSATION_AFFINITY_TTL   seconds a conversation stays reusable (1800)
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+ENABLED = os.environ.get("CONVERSATION_AFFINITY", "1") != "0"
+MAX_ENTRIES = int(os.environ.get("CONVERSATION_AFFINITY_MAX", 4096))
+TTL = float(os.environ.get("CONVERSATION_AFFINITY_TTL", 1800))
+
+
+def _turn(msg):
+    role = msg.get("role")
+    content = msg.get("content")
+    if role == "assistent":
+        role = "assistant"
+    if isinstance(content, str):
+        content = content.strip()
+    return [role, content]
+
+
+def history_key(model, max_tokens, messages):
+    """Hash of everything that shaped an upstream conversation.
+
+    Content is stripped so a client that trims the assistant reply it got
+    back still lands on the same conversation.
+    """
+    canonical = json.dumps(
+        [model, max_tokens, [_turn(m) for m in messages]],
+        separators=(",", ":"),
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+class AffinityIndex:
+    """LRU + TTL map of history hash -> upstream conversation handle."""
+
+    def __init__(self, max_entries=MAX_ENTRIES, ttl=TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._claimed = set()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.busy = 0
+
+    def _get(self, key):
+        item = self._entries.get(key)
+        if item is not None and item[1] <= time.time():
+            del self._entries[key]
+            item = None
+        if item is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return item[0]
+
+    def get(self, key):
+        with self._lock:
+            return self._get(key)
+
+    def claim(self, key):
+        """get(), but None while another call holds `key`; release(key) when done with it."""
+        with self._lock:
+            if key in self._claimed:
+                self.busy += 1
+                return None
+            value = self._get(key)
+            if value is not None:
+                self._claimed.add(key)
+            return value
+
+    def release(self, key):
+        with self._lock:
+            self._claimed.discard(key)
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.time() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def update(self, key, value):
+        """Replace the value for `key` if it is still present, keeping its expiry."""
+        with self._lock:
+            item = self._entries.get(key)
+            if item is not None:
+                self._entries[key] = (value, item[1])
+
+    def drop(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": True,
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "busy": self.busy,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+conversation_affinity = AffinityIndex() if ENABLED else None
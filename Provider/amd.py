@@ -1,128 +1,212 @@
-import requests
-import uuid
-import json
+try:
+    from transport import transport
+    from context import RequestContext, new_session_hash
+    from streamparse import QUEUE_MESSAGES, append_tokens, gradio_events, agradio_events
+    from space_queues import observe
+    from replicas import upstream_endpoints, failover, afailover
+    from metrics import timed_phase
+    from context_window import ContextWindow
+    from gradio_mux import cancel_job, acancel_job
+    import deadlines
+except ImportError:
+    from .transport import transport
+    from .context import RequestContext, new_session_hash
+    from .streamparse import QUEUE_MESSAGES, append_tokens, gradio_events, agradio_events
+    from .space_queues import observe
+    from .replicas import upstream_endpoints, failover, afailover
+    from .metrics import timed_phase
+    from .context_window import ContextWindow
+    from .gradio_mux import cancel_job, acancel_job
+    from . import deadlines
 
 class gpt_oss_120b():
+    model_aliases = ["gpt-oss-120b","gpt-oss-20b"]
+    tokenizer_family = "gpt-oss"
+
+    # Gradio diff format: ['append', [1, 'content'], 'text'] in data[1]
+    CONTENT_PATH = [1, "content"]
+    JOIN_FN_INDEX = 4
+
     def __init__(self):
-        self.BASE = "https://amd-gpt-oss-120b-chatbot.hf.space"
-        self.session_hash = str(uuid.uuid4()).replace("-", "")[:10]
-        self.session = requests.Session()
-        self.model_aliases = ["gpt-oss-120b","gpt-oss-20b"]
+        self.endpoints = upstream_endpoints("gpt_oss_120b", "https://amd-gpt-oss-120b-chatbot.hf.space")
         self.default_model = "gpt-oss-120b"
-        self.messages = []
+        self.context = ContextWindow("gpt_oss_120b", self.tokenizer_family, self.__fragment__)
         self.max_tokens = 2048
-        self.prompt = None
-        self.system_prompt = """
+        self.system_template = """
         You must strictly ensure your response never exceeds {MAXTOKENS} tokens.
         If a user's request requires more than {MAXTOKENS} tokens, you must compress,
         summarize, or shorten the output so the entire response fits within {MAXTOKENS} tokens.
         Never exceed this limit, never continue the answer in another message,
         and never ignore this constraint for any reason.
         """
+
     # -----------------------------------------------------
-    def __gen_prompt__(self):
-        """Generate prompt from messages."""
-        prompt = ""
-        system_prompt = ""
-        self.system_prompt = self.system_prompt.replace("{MAXTOKENS}", str(self.max_tokens))
-        for msg in self.messages:
-            role = msg.get("role")
-            content = msg.get("content", "")
-
-            if role == "system":
-                system_prompt += f"System: {content}\n" + self.system_prompt + "\n"
-            elif role == "user":
-                prompt += f"User: {content}\n"
-            elif role == "assistant":
-                prompt += f"Assistant: {content}\n"
-
-        prompt = self.system_prompt + "\n" + prompt + "Assistant: "
-        self.prompt = prompt
-        self.system_prompt = system_prompt
+    @staticmethod
+    def __fragment__(role, content):
+        if role == "system":
+            return f"System: {content}\n"
+        elif role == "user":
+            return f"User: {content}\n"
+        elif role == "assistant":
+            return f"Assistant: {content}\n"
+        return None
+
+    def __gen_prompt__(self, ctx):
+        """Generate (prompt, system prompt) from messages, trimmed to the context budget."""
+        limit_prompt = self.system_template.replace("{MAXTOKENS}", str(ctx.max_tokens)) + "\n"
+        system, messages = ctx.split_system()
+        system_prompt = f"System: {system}\n" + limit_prompt if system is not None else ""
+
+        history = self.context.render(messages, ctx.max_tokens, limit_prompt + system_prompt)
+        return limit_prompt + history + "Assistant: ", system_prompt
     # -----------------------------------------------------
-    def __send_user_message__(self):
-        """Send user message to the model."""
-        payload = {
-            "data": [self.prompt],
+    def __user_message_payload__(self, ctx, prompt):
+        return {
+            "data": [prompt],
             "event_data": None,
             "fn_index": 2,
             "trigger_id": 13,
-            "session_hash": self.session_hash
+            "session_hash": ctx.session_hash
+        }
+
+    def __chat_state_payload__(self, ctx):
+        return {
+            "data": [None, []],
+            "event_data": None,
+            "fn_index": 3,
+            "trigger_id": 13,
+            "session_hash": ctx.session_hash
+        }
+
+    def __join_payload__(self, ctx, system_prompt):
+        return {
+            "data": [None, None, system_prompt, 0.7],
+            "event_data": None,
+            "fn_index": self.JOIN_FN_INDEX,
+            "trigger_id": 13,
+            "session_hash": ctx.session_hash
         }
-        self.session.post(
-            f"{self.BASE}/gradio_api/run/predict?__theme=dark",
-            json=payload
+    # -----------------------------------------------------
+    @timed_phase
+    def __send_user_message__(self, ctx, prompt):
+        """Send user message to the model."""
+        transport.client(ctx.base).post(
+            f"{ctx.base}/gradio_api/run/predict?__theme=dark",
+            json=self.__user_message_payload__(ctx, prompt),
+            timeout=deadlines.timeout()
         )
     # -----------------------------------------------------
-    def __push_chat_state__(self):
+    @timed_phase
+    def __push_chat_state__(self, ctx):
         """Push chat state to the model."""
-       
-        self.session.post(
-            f"{self.BASE}/gradio_api/run/predict?__theme=dark",
-            json={
-                "data": [None, []],
-                "event_data": None,
-                "fn_index": 3,
-                "trigger_id": 13,
-                "session_hash": self.session_hash
-            }
-)
+        transport.client(ctx.base).post(
+            f"{ctx.base}/gradio_api/run/predict?__theme=dark",
+            json=self.__chat_state_payload__(ctx),
+            timeout=deadlines.timeout()
+        )
     # -----------------------------------------------------
-    def __join_queue__(self):
+    @timed_phase
+    def __join_queue__(self, ctx, system_prompt):
         """Join the inference queue."""
-        payload = {
-            "data": [None, None, self.system_prompt, 0.7],
-            "event_data": None,
-            "fn_index": 4,
-            "trigger_id": 13,
-            "session_hash": self.session_hash
-        }
-        res = self.session.post(
-            f"{self.BASE}/gradio_api/queue/join?__theme=dark",
-            json=payload
+        res = transport.client(ctx.base).post(
+            f"{ctx.base}/gradio_api/queue/join?__theme=dark",
+            json=self.__join_payload__(ctx, system_prompt),
+            timeout=deadlines.timeout()
         )
         res.raise_for_status()
         return res.json().get("event_id")
-    
+
+    # -----------------------------------------------------
+    def __stream_response__(self, ctx, event_id):
+        """Stream response from the model; cancels the job if the stream is left early."""
+        url = f"{ctx.base}/gradio_api/queue/data?session_hash={ctx.session_hash}"
+        finished = False
+        try:
+            with transport.client(ctx.base).stream("GET", url, timeout=deadlines.timeout("stream")) as res:
+                res.raise_for_status()
+
+                for payload in gradio_events(deadlines.checked(res.iter_bytes()), QUEUE_MESSAGES):
+                    if observe(ctx.base, payload):
+                        continue
+                    # stop condition
+                    if payload.get("msg") == "process_completed":
+                        finished = True
+                        break
+
+                    yield from append_tokens(payload, 1, self.CONTENT_PATH)
+        finally:
+            if not finished:
+                cancel_job(ctx.base, ctx.session_hash, self.JOIN_FN_INDEX, event_id)
+    # -----------------------------------------------------
+    @timed_phase
+    async def __asend_user_message__(self, ctx, prompt):
+        """Send user message to the model."""
+        await transport.aclient(ctx.base).post(
+            f"{ctx.base}/gradio_api/run/predict?__theme=dark",
+            json=self.__user_message_payload__(ctx, prompt),
+            timeout=deadlines.timeout()
+        )
     # -----------------------------------------------------
-    def __stream_response__(self):
-        """Stream response from the model."""
-        url = f"{self.BASE}/gradio_api/queue/data?session_hash={self.session_hash}"
-        res = self.session.get(url, stream=True)
+    @timed_phase
+    async def __apush_chat_state__(self, ctx):
+        """Push chat state to the model."""
+        await transport.aclient(ctx.base).post(
+            f"{ctx.base}/gradio_api/run/predict?__theme=dark",
+            json=self.__chat_state_payload__(ctx),
+            timeout=deadlines.timeout()
+        )
+    # -----------------------------------------------------
+    @timed_phase
+    async def __ajoin_queue__(self, ctx, system_prompt):
+        """Join the inference queue."""
+        res = await transport.aclient(ctx.base).post(
+            f"{ctx.base}/gradio_api/queue/join?__theme=dark",
+            json=self.__join_payload__(ctx, system_prompt),
+            timeout=deadlines.timeout()
+        )
         res.raise_for_status()
-        
-        for line in res.iter_lines():
-            if not line:
-                continue
-
-            if not line.startswith(b"data:"):
-                continue
-
-            payload = json.loads(line[5:])
-
-            # stop condition
-            if payload.get("msg") == "process_completed":
-                break
-
-            if payload.get("msg") != "process_generating":
-                continue
-
-            output = payload.get("output", {})
-            data = output.get("data", [])
-
-            if not data or not data[1]:
-                continue
-
-            # Gradio diff format:
-            # ['append', [1, 'content'], 'text']
-            for diff in data[1]:
-                if (
-                    isinstance(diff, list)
-                    and diff[0] == "append"
-                    and diff[1] == [1, "content"]
-                ):
-                    token = diff[2]
-                    yield token
+        return res.json().get("event_id")
+    # -----------------------------------------------------
+    async def __astream_response__(self, ctx, event_id):
+        """Stream response from the model without blocking the event loop."""
+        url = f"{ctx.base}/gradio_api/queue/data?session_hash={ctx.session_hash}"
+        finished = False
+        try:
+            async with transport.aclient(ctx.base).stream("GET", url, timeout=deadlines.timeout("stream")) as res:
+                res.raise_for_status()
+
+                async for payload in agradio_events(deadlines.achecked(res.aiter_bytes()), QUEUE_MESSAGES):
+                    if observe(ctx.base, payload):
+                        continue
+                    # stop condition
+                    if payload.get("msg") == "process_completed":
+                        finished = True
+                        break
+
+                    for token in append_tokens(payload, 1, self.CONTENT_PATH):
+                        yield token
+        finally:
+            if not finished:
+                acancel_job(ctx.base, ctx.session_hash, self.JOIN_FN_INDEX, event_id)
+    # -----------------------------------------------------
+    def __attempt__(self, ctx, base):
+        """Stage and join the call on replica `base`; returns its token iterator."""
+        ctx = ctx.on(base, new_session_hash())
+        prompt, system_prompt = self.__gen_prompt__(ctx)
+
+        self.__send_user_message__(ctx, prompt)
+        self.__push_chat_state__(ctx)
+        event_id = self.__join_queue__(ctx, system_prompt)
+        return self.__stream_response__(ctx, event_id)
+    # -----------------------------------------------------
+    async def __aattempt__(self, ctx, base):
+        ctx = ctx.on(base, new_session_hash())
+        prompt, system_prompt = self.__gen_prompt__(ctx)
+
+        await self.__asend_user_message__(ctx, prompt)
+        await self.__apush_chat_state__(ctx)
+        event_id = await self.__ajoin_queue__(ctx, system_prompt)
+        return self.__astream_response__(ctx, event_id)
     # -----------------------------------------------------
     def create(
             self,
@@ -131,20 +215,34 @@ class gpt_oss_120b():
             model: str = "gpt-oss-120b",
             stream: bool = True
         ):
-        self.default_model = model
-        self.messages = message
-        self.max_tokens = max_tokens
+        ctx = RequestContext.new(message, model, max_tokens, stream)
+        tokens = failover(self.endpoints, lambda base: self.__attempt__(ctx, base), model=ctx.model)
 
-        self.__gen_prompt__()
-        self.__send_user_message__()
-        self.__push_chat_state__()
-        self.__join_queue__()
+        if stream:
+            return tokens
+
+        # NON-STREAMING RESPONSE
+        output = ""
+        for token in tokens:
+            output += token
+        return output
+    # -----------------------------------------------------
+    async def acreate(
+            self,
+            message: list,
+            max_tokens: int = 2048,
+            model: str = "gpt-oss-120b",
+            stream: bool = True
+        ):
+        """Async counterpart of create(); streams through a non-blocking client."""
+        ctx = RequestContext.new(message, model, max_tokens, stream)
+        tokens = await afailover(self.endpoints, lambda base: self.__aattempt__(ctx, base), model=ctx.model)
 
         if stream:
-            return self.__stream_response__()
-        
+            return tokens
+
         # NON-STREAMING RESPONSE
         output = ""
-        for token in self.__stream_response__():
+        async for token in tokens:
             output += token
-        return output
\ No newline at end of file
+        return output
@@ -1,33 +1,58 @@
-import requests
+import asyncio
 import json
+import threading
+import weakref
+from typing import NamedTuple
+
+try:
+    from transport import transport
+    from context import RequestContext
+    from affinity import conversation_affinity, history_key
+    from session_pool import checkout
+    from streamparse import cohere_tokens, acohere_tokens
+    from replicas import upstream_endpoints, failover, afailover
+    from metrics import timed_phase
+    from context_window import ContextWindow
+    import deadlines
+except ImportError:
+    from .transport import transport
+    from .context import RequestContext
+    from .affinity import conversation_affinity, history_key
+    from .session_pool import checkout
+    from .streamparse import cohere_tokens, acohere_tokens
+    from .replicas import upstream_endpoints, failover, afailover
+    from .metrics import timed_phase
+    from .context_window import ContextWindow
+    from . import deadlines
+
+
+# Background msgid refreshes and stops in flight; held so the tasks are not collected
+_refreshes = set()
+
+
+class Conversation(NamedTuple):
+    """Upstream conversation and the message id the next turn hangs off."""
+    con_id: str = None
+    msgid: str = ""
+    cookies: dict = {}
+    base: str = None  # replica the conversation lives on
+
 
 class c4ai:
+    model_aliases = {
+        "command-a": "command-a-03-2025",
+        "command-r-plus": "command-r-plus-08-2024",
+        "command-r": "command-r-08-2024",
+        "command-r7b": "command-r7b-12-2024",
+    }
+    tokenizer_family = "cohere"
+
     def __init__(self):
         self.default_model = "command-a"
 
-        self.model_aliases = {
-            "command-a": "command-a-03-2025",
-            "command-r-plus": "command-r-plus-08-2024",
-            "command-r": "command-r-08-2024",
-            "command-r7b": "command-r7b-12-2024",
-        }
-
         self.maxtoken = 2048
-        self.messages = []
-        self.prompt = None
-        self.msgid = ""
-        self.con_id = None
-
-        self.url = "https://coherelabs-c4ai-command.hf.space"
-        self.CONV_URL = f"{self.url}/conversation"
-        self.session = requests.Session()
-
-        self.headers = {
-            "User-Agent": "Mozilla/5.0",
-            "Accept": "*/*",
-            "Origin": self.url,
-            "Referer": self.url + "/",
-        }
+        self.endpoints = upstream_endpoints("c4ai", "https://coherelabs-c4ai-command.hf.space")
+        self.context = ContextWindow("c4ai", self.tokenizer_family, self.__fragment__)
 
         # Base system prompt
         self.system_template = """
@@ -38,41 +63,117 @@ Never exceed this limit, never continue the answer in another message,
 and never ignore this constraint for any reason.
 """
 
+    def __conv_url__(self, base):
+        return f"{base}/conversation"
+
+    def __base_headers__(self, base):
+        return {
+            "User-Agent": "Mozilla/5.0",
+            "Accept": "*/*",
+            "Origin": base,
+            "Referer": base + "/",
+        }
+
     # ------------------ SYSTEM PROMPT ------------------
-    def __add_system_prompt__(self):
-        """Extract system prompt from messages list."""
-        self.system = self.system_template.replace("{MAXTOKENS}", str(self.maxtoken))
+    def __add_system_prompt__(self, ctx):
+        """Build the conversation preprompt from the caller's system message."""
+        system = self.system_template.replace("{MAXTOKENS}", str(ctx.max_tokens))
 
-        for i, msg in enumerate(self.messages):
-            if msg["role"] == "system":
-                self.system += "\nAdditional system rule:\n" + msg["content"]
-                del self.messages[i]
-                break
+        content, _ = ctx.split_system()
+        if content is not None:
+            system += "\nAdditional system rule:\n" + content
+
+        return system
 
     # ------------------ TRANSCRIPT MAKER ------------------
-    def __custom_prompt_maker__(self):
-        last_messages = self.messages[-10:]
+    @staticmethod
+    def __fragment__(role, content):
+        role = "assistant" if role == "assistent" else role
+        return f"{role}: {content}"
+
+    def __custom_prompt_maker__(self, ctx):
+        """Transcript of the history that fits the context budget next to the preprompt."""
+        _, messages = ctx.split_system()
+        return self.context.render(messages, ctx.max_tokens, self.__add_system_prompt__(ctx), sep="\n")
+
+    # ------------------ CONVERSATION AFFINITY ------------------
+    def __resume_key__(self, ctx):
+        """History key of everything before the new user turn, or None.
 
-        for msg in last_messages:
-            if msg["role"] == "assistent":
-                msg["role"] = "assistant"
+        Only a request that ends in a user message and already holds an
+        assistant reply can extend a conversation opened by an earlier call.
+        """
+        if conversation_affinity is None or len(ctx.messages) < 2:
+            return None
+        if ctx.messages[-1].get("role") != "user":
+            return None
+        if not any(m.get("role") in ("assistant", "assistent") for m in ctx.messages):
+            return None
+        return history_key(ctx.model, ctx.max_tokens, ctx.messages[:-1])
 
-        self.prompt = "\n".join(f"{m['role']}: {m['content']}" for m in last_messages)
+    def __turn_key__(self, ctx, text):
+        """History key of this call's messages plus the reply it produced."""
+        reply = {"role": "assistant", "content": text}
+        return history_key(ctx.model, ctx.max_tokens, ctx.messages + (reply,))
+
+    def __remember__(self, ctx, conv, text):
+        """Index the conversation under its new history; returns the key or None."""
+        if conversation_affinity is None or not text or conv.con_id is None:
+            return None
+        key = self.__turn_key__(ctx, text)
+        conversation_affinity.put(key, conv._replace(msgid=""))
+        return key
+
+    def __refresh__(self, key, conv):
+        """Look up the id of the reply just streamed and attach it to `key`."""
+        conv = self.__data_json__(conv._replace(msgid=""))
+        if conv.msgid:
+            conversation_affinity.update(key, conv)
+        else:
+            conversation_affinity.drop(key)
+
+    async def __arefresh__(self, key, conv):
+        with deadlines.within(None):  # not bound by the call that just ended
+            conv = await self.__adata_json__(conv._replace(msgid=""))
+        if conv.msgid:
+            conversation_affinity.update(key, conv)
+        else:
+            conversation_affinity.drop(key)
+
+    # ------------------ LATEST MESSAGE ID ------------------
+    @staticmethod
+    def __latest_msgid__(data):
+        """Id of the newest message in a devalue-encoded conversation node.
+
+        The node is a flat array: data[0] is the conversation, its "messages"
+        field points at a list of indices into the array, and each message's
+        "id" field points at its id string. A brand new conversation holds only
+        the root message, so this is the same id the first turn replies to.
+        """
+        try:
+            root = data[0]
+            last = data[data[root["messages"]][-1]]
+            msgid = data[last["id"]]
+            if isinstance(msgid, str):
+                return msgid
+        except (KeyError, IndexError, TypeError):
+            pass
+        return data[3]
 
     # ------------------ PAYLOAD BUILDER ------------------
-    def __payloads__(self, mode=None):
+    def __payloads__(self, ctx, conv=None, mode=None, inputs=None):
         if mode == "CONV":
             return {
-                "model": self.model_aliases[self.default_model],
-                "preprompt": self.system
+                "model": self.model_aliases[ctx.model],
+                "preprompt": self.__add_system_prompt__(ctx)
             }
 
         return {
             "data": (
                 None,
                 json.dumps({
-                    "inputs": self.prompt,
-                    "id": self.msgid,
+                    "inputs": inputs,
+                    "id": conv.msgid,
                     "is_retry": False,
                     "is_continue": False,
                     "web_search": False,
@@ -82,64 +183,326 @@ and never ignore this constraint for any reason.
             )
         }
 
+    # ------------------ REQUEST HEADERS ------------------
+    def __headers__(self, conv):
+        """Headers plus the cookies this conversation was opened with.
+
+        The pooled clients are shared and keep no cookie jar, so the upstream
+        session cookie travels with the call instead.
+        """
+        if not conv.cookies:
+            return self.__base_headers__(conv.base)
+        cookie = "; ".join(f"{k}={v}" for k, v in conv.cookies.items())
+        return {**self.__base_headers__(conv.base), "Cookie": cookie}
+
     # ------------------ GET CONVERSATION ID ------------------
-    def __get_conversationId__(self):
+    @timed_phase
+    def __get_conversationId__(self, ctx):
         try:
-            payload = self.__payloads__("CONV")
+            payload = self.__payloads__(ctx, mode="CONV")
 
-            res = self.session.post(
-                self.CONV_URL,
+            res = transport.client(ctx.base).post(
+                self.__conv_url__(ctx.base),
                 json=payload,
-                headers=self.headers
+                headers=self.__base_headers__(ctx.base),
+                timeout=deadlines.timeout()
             )
             res.raise_for_status()
-            self.con_id = res.json()["conversationId"]
+            return Conversation(res.json()["conversationId"], "", dict(res.cookies), ctx.base)
 
         except Exception as e:
             print("CONV ERROR:", e)
+            return Conversation(base=ctx.base)
 
-    # ------------------ FETCH FIRST DATA.JSON ------------------
-    def __data_json__(self):
+    # ------------------ FETCH DATA.JSON ------------------
+    @timed_phase
+    def __data_json__(self, conv):
         try:
-            res = self.session.get(
-                f"{self.CONV_URL}/{self.con_id}/__data.json",
-                headers=self.headers
+            res = transport.client(conv.base).get(
+                f"{self.__conv_url__(conv.base)}/{conv.con_id}/__data.json",
+                headers=self.__headers__(conv),
+                timeout=deadlines.timeout()
             )
             res.raise_for_status()
             first_line = res.text.split("\n")[0]
             data = json.loads(first_line)
 
-            self.msgid = data["nodes"][1]["data"][3]
+            return conv._replace(msgid=self.__latest_msgid__(data["nodes"][1]["data"]))
 
         except Exception as e:
             print("DATA.JSON ERROR:", e)
+            return conv
 
     # ------------------ MAIN CHAT STREAM ------------------
-    def __chat__(self):
-        payload = self.__payloads__()
+    def __chat__(self, ctx, conv, inputs, resumed=None):
+        """Stream the reply; index the conversation if it completes.
+
+        `resumed` is the affinity key the conversation came from. If the
+        upstream no longer accepts turns on it, the key is dropped and, when no
+        token has been sent yet, the turn is replayed on a fresh conversation.
+        Other errors are raised. Closing the stream early stops the generation
+        upstream.
+        """
+        payload = self.__payloads__(ctx, conv, inputs=inputs)
+        text = []
 
         try:
-            res = self.session.post(
-                f"{self.CONV_URL}/{self.con_id}",
+            with transport.client(conv.base).stream(
+                "POST",
+                f"{self.__conv_url__(conv.base)}/{conv.con_id}",
                 files=payload,
-                headers=self.headers,
-                stream=True
+                headers=self.__headers__(conv),
+                timeout=deadlines.timeout("stream")
+            ) as res:
+                res.raise_for_status()
+
+                for token in cohere_tokens(deadlines.checked(res.iter_bytes())):
+                    text.append(token)
+                    yield token
+
+        except GeneratorExit:
+            threading.Thread(target=self.__stop__, args=(conv,), daemon=True).start()
+            raise
+        except Exception as e:
+            print("CHAT ERROR:", e)
+            if deadlines.is_timeout(e):
+                # Out of time: stop the generation and give up on this turn
+                threading.Thread(target=self.__stop__, args=(conv,), daemon=True).start()
+                raise
+            if resumed is not None:
+                conversation_affinity.drop(resumed)
+                if not text:
+                    # Nothing sent yet: replay the turn on a fresh conversation
+                    conv = self.__data_json__(self.__get_conversationId__(ctx))
+                    yield from self.__chat__(ctx, conv, self.__custom_prompt_maker__(ctx))
+                    return
+            # Surface it so failover and the replica's limit see the failure
+            raise
+
+        key = self.__remember__(ctx, conv, "".join(text))
+        if key is not None:
+            threading.Thread(target=self.__refresh__, args=(key, conv), daemon=True).start()
+
+    # ------------------ STOP GENERATING ------------------
+    def __stop__(self, conv):
+        """Ask the upstream to stop a generation nobody is reading any more."""
+        try:
+            transport.client(conv.base).post(
+                f"{self.__conv_url__(conv.base)}/{conv.con_id}/stop-generating",
+                headers=self.__headers__(conv),
+                timeout=deadlines.DEFAULT_TIMEOUT
+            )
+        except Exception as e:
+            print("STOP ERROR:", e)
+
+    async def __astop__(self, conv):
+        try:
+            await transport.aclient(conv.base).post(
+                f"{self.__conv_url__(conv.base)}/{conv.con_id}/stop-generating",
+                headers=self.__headers__(conv),
+                timeout=deadlines.DEFAULT_TIMEOUT
+            )
+        except Exception as e:
+            print("STOP ERROR:", e)
+
+    # ------------------ ASYNC GET CONVERSATION ID ------------------
+    @timed_phase
+    async def __aget_conversationId__(self, ctx):
+        try:
+            payload = self.__payloads__(ctx, mode="CONV")
+
+            res = await transport.aclient(ctx.base).post(
+                self.__conv_url__(ctx.base),
+                json=payload,
+                headers=self.__base_headers__(ctx.base),
+                timeout=deadlines.timeout()
             )
             res.raise_for_status()
+            return Conversation(res.json()["conversationId"], "", dict(res.cookies), ctx.base)
 
-            for line in res.iter_lines():
-                if not line.strip():
-                    continue
-                try:
-                    obj = json.loads(line.decode())
-                except:
-                    continue
+        except Exception as e:
+            print("CONV ERROR:", e)
+            return Conversation(base=ctx.base)
 
-                if obj.get("type") == "stream":
-                    yield obj["token"].replace("\x00", "")
+    # ------------------ ASYNC FETCH DATA.JSON ------------------
+    @timed_phase
+    async def __adata_json__(self, conv):
+        try:
+            res = await transport.aclient(conv.base).get(
+                f"{self.__conv_url__(conv.base)}/{conv.con_id}/__data.json",
+                headers=self.__headers__(conv),
+                timeout=deadlines.timeout()
+            )
+            res.raise_for_status()
+            first_line = res.text.split("\n")[0]
+            data = json.loads(first_line)
+
+            return conv._replace(msgid=self.__latest_msgid__(data["nodes"][1]["data"]))
 
+        except Exception as e:
+            print("DATA.JSON ERROR:", e)
+            return conv
+
+    # ------------------ ASYNC CHAT STREAM ------------------
+    async def __achat__(self, ctx, conv, inputs, resumed=None):
+        payload = self.__payloads__(ctx, conv, inputs=inputs)
+        text = []
+
+        try:
+            async with transport.aclient(conv.base).stream(
+                "POST",
+                f"{self.__conv_url__(conv.base)}/{conv.con_id}",
+                files=payload,
+                headers=self.__headers__(conv),
+                timeout=deadlines.timeout("stream")
+            ) as res:
+                res.raise_for_status()
+
+                async for token in acohere_tokens(deadlines.achecked(res.aiter_bytes())):
+                    text.append(token)
+                    yield token
+
+        except (GeneratorExit, asyncio.CancelledError):
+            task = asyncio.get_running_loop().create_task(self.__astop__(conv))
+            _refreshes.add(task)
+            task.add_done_callback(_refreshes.discard)
+            raise
         except Exception as e:
             print("CHAT ERROR:", e)
+            if deadlines.is_timeout(e):
+                task = asyncio.get_running_loop().create_task(self.__astop__(conv))
+                _refreshes.add(task)
+                task.add_done_callback(_refreshes.discard)
+                raise
+            if resumed is not None:
+                conversation_affinity.drop(resumed)
+                if not text:
+                    conv = await self.__adata_json__(await self.__aget_conversationId__(ctx))
+                    async for token in self.__achat__(ctx, conv, self.__custom_prompt_maker__(ctx)):
+                        yield token
+                    return
+            raise
+
+        key = self.__remember__(ctx, conv, "".join(text))
+        if key is not None:
+            task = asyncio.create_task(self.__arefresh__(key, conv))
+            _refreshes.add(task)
+            task.add_done_callback(_refreshes.discard)
+
+    # ------------------ PRE-WARMED CONVERSATIONS ------------------
+    @timed_phase
+    def __warm__(self, ctx):
+        """Open a conversation ready for a first turn; used by the session pool."""
+        conv = self.__data_json__(self.__get_conversationId__(ctx))
+        return conv if conv.msgid else None
+
+    def __checkout__(self, ctx):
+        """A pre-warmed conversation with this call's preprompt, or None.
+
+        Conversations are keyed on everything the preprompt is built from, and
+        the pool keeps only that part of the call, not its messages.
+        """
+        system, _ = ctx.split_system()
+        warm_ctx = RequestContext.new(
+            [{"role": "system", "content": system}] if system is not None else [],
+            ctx.model,
+            ctx.max_tokens,
+        ).on(ctx.base)
+        key = (type(self).__name__, ctx.model, ctx.base, ctx.max_tokens, system)
+        return checkout(key, lambda: self.__warm__(warm_ctx))
+
+    # ------------------ OPEN OR RESUME ------------------
+    def __held__(self, ctx):
+        """(resume key, conversation already holding this history or None).
+
+        A held conversation is claimed for this call; __holding__ releases it.
+        """
+        key = self.__resume_key__(ctx)
+        return key, conversation_affinity.claim(key) if key is not None else None
+
+    @staticmethod
+    def __holding__(tokens, key, held):
+        """Pass `tokens` through, releasing the claim on `held` once they end or are dropped."""
+        if held is None:
+            return tokens
+
+        def holding():
+            try:
+                yield from tokens
+            finally:
+                release()
+
+        stream = holding()
+        # A finalizer runs at most once, so a late collection cannot drop
+        # a claim another call has taken on the same key since
+        release = weakref.finalize(stream, conversation_affinity.release, key)
+        return stream
+
+    @staticmethod
+    def __aholding__(tokens, key, held):
+        if held is None:
+            return tokens
+
+        async def holding():
+            try:
+                async for token in tokens:
+                    yield token
+            finally:
+                release()
+                await tokens.aclose()
+
+        stream = holding()
+        release = weakref.finalize(stream, conversation_affinity.release, key)
+        return stream
+
+    def __open__(self, ctx, key, held):
+        """Return (conversation, inputs, resumed key) for this call on replica ctx.base.
+
+        A call that extends a conversation we already hold on this replica
+        sends only its new user turn there; anything else opens a fresh
+        conversation and sends the flattened transcript, preferably on a
+        pre-warmed conversation.
+        """
+        conv = held if held is not None and held.base == ctx.base else None
+        if conv is not None and not conv.msgid:
+            conv = self.__data_json__(conv)
+        if conv is not None and conv.msgid:
+            return conv, ctx.messages[-1]["content"], key
+        if conv is not None:
+            conversation_affinity.drop(key)
+
+        conv = self.__checkout__(ctx)
+        if conv is None:
+            conv = self.__get_conversationId__(ctx)
+            conv = self.__data_json__(conv)
+        return conv, self.__custom_prompt_maker__(ctx), None
+
+    async def __aopen__(self, ctx, key, held):
+        conv = held if held is not None and held.base == ctx.base else None
+        if conv is not None and not conv.msgid:
+            conv = await self.__adata_json__(conv)
+        if conv is not None and conv.msgid:
+            return conv, ctx.messages[-1]["content"], key
+        if conv is not None:
+            conversation_affinity.drop(key)
+
+        conv = self.__checkout__(ctx)
+        if conv is None:
+            conv = await self.__aget_conversationId__(ctx)
+            conv = await self.__adata_json__(conv)
+        return conv, self.__custom_prompt_maker__(ctx), None
+
+    # ------------------ ONE REPLICA ------------------
+    def __attempt__(self, ctx, base, key, held):
+        """Run the call on replica `base`; returns its token iterator."""
+        ctx = ctx.on(base)
+        conv, inputs, resumed = self.__open__(ctx, key, held)
+        return self.__chat__(ctx, conv, inputs, resumed)
+
+    async def __aattempt__(self, ctx, base, key, held):
+        ctx = ctx.on(base)
+        conv, inputs, resumed = await self.__aopen__(ctx, key, held)
+        return self.__achat__(ctx, conv, inputs, resumed)
 
     # ------------------ PUBLIC CREATE FUNCTION ------------------
     def create(
@@ -149,19 +512,57 @@ and never ignore this constraint for any reason.
             model:str=  "command-a",
             stream: bool = True
             ):
-        self.default_model = model
-        self.messages = message
-        self.maxtoken = max_tokens
+        ctx = RequestContext.new(message, model, max_tokens, stream)
+        key, held = self.__held__(ctx)
+        try:
+            tokens = failover(
+                self.endpoints,
+                lambda base: self.__attempt__(ctx, base, key, held),
+                prefer=held.base if held is not None else None,
+                model=ctx.model
+            )
+        except BaseException:
+            if held is not None:
+                conversation_affinity.release(key)
+            raise
+        tokens = self.__holding__(tokens, key, held)
 
-        self.__add_system_prompt__()
-        self.__custom_prompt_maker__()
-        self.__get_conversationId__()
-        self.__data_json__()
+        if stream:
+            return tokens
+        else:
+            output = ""
+            for chunk in tokens:
+                output += chunk
+            return output
+
+    # ------------------ PUBLIC ASYNC CREATE FUNCTION ------------------
+    async def acreate(
+            self,
+            message: list,
+            max_tokens: int = 2048,
+            model:str=  "command-a",
+            stream: bool = True
+            ):
+        """Async counterpart of create(); streams through a non-blocking client."""
+        ctx = RequestContext.new(message, model, max_tokens, stream)
+        key, held = self.__held__(ctx)
+        try:
+            tokens = await afailover(
+                self.endpoints,
+                lambda base: self.__aattempt__(ctx, base, key, held),
+                prefer=held.base if held is not None else None,
+                model=ctx.model
+            )
+        except BaseException:
+            if held is not None:
+                conversation_affinity.release(key)
+            raise
+        tokens = self.__aholding__(tokens, key, held)
 
         if stream:
-            return self.__chat__()
+            return tokens
         else:
             output = ""
-            for chunk in self.__chat__():
+            async for chunk in tokens:
                 output += chunk
-            return output
\ No newline at end of file
+            return output
@@ -0,0 +1,46 @@
+import uuid
+from dataclasses import dataclass, replace
+from types import MappingProxyType
+
+
+def new_session_hash():
+    return str(uuid.uuid4()).replace("-", "")[:10]
+
+
+@dataclass(frozen=True)
+class RequestContext:
+    """Everything one create() call needs, frozen for the life of the call.
+
+    Provider engines are long-lived and shared between threads and tasks, so
+    nothing per-request may live on `self`; it lives here instead. Messages
+    are copied into read-only mappings, so an engine can neither mutate the
+    caller's list nor see another call's.
+    """
+    model: str
+    messages: tuple
+    max_tokens: int
+    session_hash: str
+    stream: bool = True
+    base: str = None  # upstream replica serving this call
+
+    @classmethod
+    def new(cls, messages, model, max_tokens, stream=True, session_hash=None):
+        frozen = tuple(MappingProxyType(dict(m)) for m in (messages or []))
+        return cls(
+            model=model,
+            messages=frozen,
+            max_tokens=max_tokens,
+            session_hash=session_hash or new_session_hash(),
+            stream=stream,
+        )
+
+    def on(self, base, session_hash=None):
+        """The same call aimed at replica `base`, optionally under a given session."""
+        return replace(self, base=base, session_hash=session_hash or self.session_hash)
+
+    def split_system(self):
+        """Return (first system message content or None, remaining messages)."""
+        for i, msg in enumerate(self.messages):
+            if msg.get("role") == "system":
+                return msg.get("content"), self.messages[:i] + self.messages[i + 1:]
+        return None, self.messages
@@ -0,0 +1,154 @@
+"""
+Token-budgeted chat history.
+
+Every provider renders the caller's history into the prompt format its
+Space expects. ContextWindow does that rendering and fits it into a token
+budget: the context size of the provider minus the reply's max_tokens and
+the system prompt. max_tokens reserves at most CONTEXT_REPLY_TOKENS, so a
+caller asking for an unbounded reply (Qwen3VL defaults to 10^10) still gets
+its history. The system prompt and the last CONTEXT_PINNED_MESSAGES
+messages are always kept. Older messages are added newest first while they
+fit, and everything before the first one that does not fit is dropped, so
+the history stays contiguous.
+
+Rendered fragments and their token counts are cached per message (by a
+hash of role and content) in a small LRU per window, so each turn of a
+growing conversation only renders and counts its new messages.
+
+Tokens are counted with the tokenizers the gateway loads (see
+use_tokenizers()); without them, four characters count as a token.
+
+    CONTEXT_TOKENS              default context budget of a provider (16384)
+    <PROVIDER>_CONTEXT_TOKENS   budget of one provider, e.g. QWEN3VL_CONTEXT_TOKENS
+    CONTEXT_REPLY_TOKENS        most of the budget a reply's max_tokens reserves (4096)
+    CONTEXT_PINNED_MESSAGES     most recent messages always kept (2)
+    CONTEXT_FRAGMENT_CACHE      rendered messages cached per provider (4096)
+"""
+import hashlib
+import os
+import threading
+import weakref
+from collections import OrderedDict
+
+
+DEFAULT_CONTEXT_TOKENS = int(os.environ.get("CONTEXT_TOKENS", 16384))
+REPLY_TOKENS = int(os.environ.get("CONTEXT_REPLY_TOKENS", 4096))
+PINNED_MESSAGES = int(os.environ.get("CONTEXT_PINNED_MESSAGES", 2))
+FRAGMENT_CACHE_SIZE = int(os.environ.get("CONTEXT_FRAGMENT_CACHE", 4096))
+
+
+def context_tokens(name, default=DEFAULT_CONTEXT_TOKENS):
+    """Context budget of a provider: <NAME>_CONTEXT_TOKENS if set, else `default`."""
+    return int(os.environ.get(f"{name.upper()}_CONTEXT_TOKENS", default))
+
+
+class _CharCount:
+    name = "chars"
+
+    def count(self, text):
+        return len(text) // 4 + 1
+
+
+_tokenizer_for = lambda family: _CharCount()
+
+
+def use_tokenizers(tokenizer_for):
+    """Count with `tokenizer_for(family)`, which returns an object with count(text)."""
+    global _tokenizer_for
+    _tokenizer_for = tokenizer_for
+
+
+def _content(message):
+    content = message.get("content", "")
+    if isinstance(content, list):
+        return "".join(part.get("text", "") for part in content if isinstance(part, dict))
+    return content if isinstance(content, str) else str(content or "")
+
+
+_windows = weakref.WeakSet()
+
+
+class ContextWindow:
+    """Renders a provider's history and fits it into its token budget.
+
+    `fragment(role, content)` renders one message, or returns None for a
+    message the provider leaves out. The budget is context_tokens(name).
+    """
+
+    def __init__(self, name, family, fragment):
+        self.name = name
+        self.family = family
+        self.budget = context_tokens(name)
+        self.fragment = fragment
+        self._fragments = OrderedDict()  # hash -> (text, tokens)
+        self._lock = threading.Lock()
+        self.trimmed = 0
+        self.dropped = 0
+        _windows.add(self)
+
+    def _cached(self, role, content, render):
+        key = hashlib.blake2b(f"{role}\0{content}".encode(), digest_size=16).digest()
+        with self._lock:
+            cached = self._fragments.get(key)
+            if cached is not None:
+                self._fragments.move_to_end(key)
+                return cached
+        text = render(role, content)
+        cached = (text, _tokenizer_for(self.family).count(text) if text else 0)
+        with self._lock:
+            self._fragments[key] = cached
+            while len(self._fragments) > FRAGMENT_CACHE_SIZE:
+                self._fragments.popitem(last=False)
+        return cached
+
+    def _render(self, message):
+        """(fragment, tokens) of one message."""
+        return self._cached(message.get("role", ""), _content(message), self.fragment)
+
+    def count(self, text):
+        """Tokens of `text` sent with every call, cached like a message."""
+        return self._cached("\0", text, lambda _, text: text)[1]
+
+    def _fit(self, messages, max_tokens, fixed):
+        """(message, fragment) pairs of the newest `messages` that fit, oldest first."""
+        rendered = [(m, self._render(m)) for m in messages]
+        rendered = [(m, r) for m, r in rendered if r[0] is not None]
+        pinned = min(PINNED_MESSAGES, len(rendered))
+        start = len(rendered) - pinned
+        reply = min(max(max_tokens, 0), REPLY_TOKENS) if isinstance(max_tokens, int) else 0
+        room = self.budget - reply - self.count(fixed)
+        room -= sum(tokens for _, (_, tokens) in rendered[start:])
+
+        while start > 0 and rendered[start - 1][1][1] <= room:
+            start -= 1
+            room -= rendered[start][1][1]
+        if start:
+            with self._lock:
+                self.trimmed += 1
+                self.dropped += start
+        return [(m, text) for m, (text, _) in rendered[start:]]
+
+    def keep(self, messages, max_tokens, fixed=""):
+        """The newest `messages` that fit, oldest first.
+
+        `fixed` is the text sent with every call (system prompt, template);
+        it and `max_tokens` come off the budget first.
+        """
+        return [m for m, _ in self._fit(messages, max_tokens, fixed)]
+
+    def render(self, messages, max_tokens, fixed="", sep=""):
+        """The fragments of keep() joined into one string."""
+        return sep.join(text for _, text in self._fit(messages, max_tokens, fixed))
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                "budget": self.budget,
+                "cached_fragments": len(self._fragments),
+                "trimmed_calls": self.trimmed,
+                "dropped_messages": self.dropped,
+            }
+
+
+def stats():
+    return {window.name: window.as_dict() for window in list(_windows)}
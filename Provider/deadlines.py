@@ -0,0 +1,164 @@
+"""
+Request deadlines and per-phase upstream timeouts.
+
+The gateway gives every call a Budget: the seconds its client will wait.
+within(budget) puts it in a context variable, so it follows the call into
+provider setup, asyncio tasks and the threads the replica code starts for
+it. The budget is split over the phases of an upstream call, each capped by
+the time the whole request has left:
+
+    connect      opening a connection to the Space
+    setup        each setup request (queue join, new conversation...)
+    first_token  from the start of the call to its first token
+    token        between two tokens once the reply streams
+
+Connect and setup are httpx timeouts on each request. The first-token and
+inter-token limits are checked whenever upstream bytes or queue messages
+arrive, so Gradio heartbeats cannot keep a stalled job alive, and every
+stream also has a read timeout of UPSTREAM_TOKEN_TIMEOUT so a silent
+connection cannot hang a worker either. Calls without a budget (warmers,
+keep-alive pings) still get the connect and read timeouts.
+
+An exceeded limit raises UpstreamTimeout, a TimeoutError. It unwinds the
+provider's stream, which closes the upstream response and cancels the
+Gradio job.
+
+    UPSTREAM_CONNECT_TIMEOUT        seconds to open a connection (10)
+    UPSTREAM_SETUP_TIMEOUT          seconds for each setup request (30)
+    UPSTREAM_FIRST_TOKEN_TIMEOUT    seconds from the start of a call to its first token (120)
+    UPSTREAM_TOKEN_TIMEOUT          seconds between tokens or stream reads (60)
+"""
+import contextlib
+import contextvars
+import os
+import time
+
+import httpx
+
+
+CONNECT_TIMEOUT = float(os.environ.get("UPSTREAM_CONNECT_TIMEOUT", 10))
+SETUP_TIMEOUT = float(os.environ.get("UPSTREAM_SETUP_TIMEOUT", 30))
+FIRST_TOKEN_TIMEOUT = float(os.environ.get("UPSTREAM_FIRST_TOKEN_TIMEOUT", 120))
+TOKEN_TIMEOUT = float(os.environ.get("UPSTREAM_TOKEN_TIMEOUT", 60))
+
+DEFAULT_TIMEOUT = httpx.Timeout(TOKEN_TIMEOUT, connect=CONNECT_TIMEOUT)
+
+
+class UpstreamTimeout(TimeoutError):
+    """An upstream call ran out of time in `phase`."""
+
+    MESSAGES = {
+        "deadline": "Request deadline exceeded before the response completed",
+        "connect": f"Could not connect to the upstream within {CONNECT_TIMEOUT:g}s",
+        "setup": f"Upstream setup took longer than {SETUP_TIMEOUT:g}s",
+        "first_token": f"No first token from the upstream within {FIRST_TOKEN_TIMEOUT:g}s",
+        "token": f"Upstream stalled for more than {TOKEN_TIMEOUT:g}s between tokens",
+    }
+
+    def __init__(self, phase):
+        self.phase = phase
+        super().__init__(self.MESSAGES[phase])
+
+
+def as_timeout(error, phase="setup"):
+    """`error` as an UpstreamTimeout if it is an httpx timeout, else unchanged."""
+    if isinstance(error, httpx.ConnectTimeout):
+        return UpstreamTimeout("connect")
+    if isinstance(error, httpx.TimeoutException):
+        return UpstreamTimeout(phase)
+    return error
+
+
+def is_timeout(error):
+    return isinstance(error, (TimeoutError, httpx.TimeoutException))
+
+
+class Budget:
+    """Deadlines of one request."""
+
+    def __init__(self, seconds):
+        now = time.monotonic()
+        self.deadline = now + seconds
+        self.first_token_by = min(self.deadline, now + FIRST_TOKEN_TIMEOUT)
+        self.last_token = None
+
+    def token(self):
+        self.last_token = time.monotonic()
+
+    def remaining(self):
+        return max(0.0, self.deadline - time.monotonic())
+
+    def _next(self):
+        """(phase, monotonic time) of the limit that runs out first."""
+        if self.last_token is None:
+            phase, at = "first_token", self.first_token_by
+        else:
+            phase, at = "token", self.last_token + TOKEN_TIMEOUT
+        if self.deadline <= at:
+            return "deadline", self.deadline
+        return phase, at
+
+    def wait(self):
+        """Seconds until the next limit runs out."""
+        return max(0.0, self._next()[1] - time.monotonic())
+
+    def check(self):
+        """Raise UpstreamTimeout if a limit has run out."""
+        phase, at = self._next()
+        if time.monotonic() >= at:
+            raise UpstreamTimeout(phase)
+
+
+_budget = contextvars.ContextVar("upstream_budget", default=None)
+
+
+@contextlib.contextmanager
+def within(budget):
+    """Run upstream calls made in this block under `budget`."""
+    token = _budget.set(budget)
+    try:
+        yield budget
+    finally:
+        _budget.reset(token)
+
+
+def current():
+    return _budget.get()
+
+
+def timeout(phase="setup"):
+    """httpx timeout for one upstream request of this call: "setup" or "stream"."""
+    read = SETUP_TIMEOUT if phase == "setup" else TOKEN_TIMEOUT
+    budget = _budget.get()
+    if budget is None:
+        return httpx.Timeout(read, connect=CONNECT_TIMEOUT)
+    left = budget.remaining()
+    if not left:
+        raise UpstreamTimeout("deadline")
+    return httpx.Timeout(min(read, left), connect=min(CONNECT_TIMEOUT, left))
+
+
+def checked(chunks):
+    """Pass upstream `chunks` through, raising UpstreamTimeout once the call runs out of time."""
+    budget = _budget.get()
+    if budget is None:
+        return chunks
+
+    def _checked():
+        for chunk in chunks:
+            budget.check()
+            yield chunk
+    return _checked()
+
+
+def achecked(chunks):
+    """Async counterpart of checked()."""
+    budget = _budget.get()
+    if budget is None:
+        return chunks
+
+    async def _checked():
+        async for chunk in chunks:
+            budget.check()
+            yield chunk
+    return _checked()
@@ -0,0 +1,447 @@
+"""
+Multiplexed Gradio queue streams.
+
+A Gradio Space delivers every event of one session over a single
+`/gradio_api/queue/data?session_hash=...` SSE stream, each message tagged
+with the `event_id` that `/queue/join` returned. Instead of one session and
+one long-lived data connection per request, all jobs for a Space are joined
+under one shared session hash and a single reader routes the stream's
+messages to per-job queues by `event_id`. Upstream connections no longer
+scale with the number of concurrent streams.
+
+The blocking client gets a reader thread per Space, the async client a
+reader task per Space and event loop. Only Spaces that keep no per-session
+state between calls can share a session; providers that stage inputs with
+run/predict before joining must keep their own.
+
+A job whose reader stops before the event completes (a lost hedge, a
+disconnected client, a timeout) is cancelled upstream through
+`/gradio_api/cancel`, since the shared data stream stays open and Gradio
+would otherwise run it to the end. Jobs on their own data stream are
+cancelled the same way. A job waiting on its queue gives up when its
+call's first-token or inter-token time runs out (Provider/deadlines.py).
+
+    GRADIO_MULTIPLEX    "0" gives every job its own session and data stream
+"""
+import asyncio
+import contextvars
+import os
+import queue
+import threading
+import time
+import weakref
+
+try:
+    from transport import transport
+    from context import new_session_hash
+    from streamparse import QUEUE_MESSAGES, gradio_events, agradio_events
+    from space_queues import observe
+    import deadlines
+except ImportError:
+    from .transport import transport
+    from .context import new_session_hash
+    from .streamparse import QUEUE_MESSAGES, gradio_events, agradio_events
+    from .space_queues import observe
+    from . import deadlines
+
+
+ENABLED = os.environ.get("GRADIO_MULTIPLEX", "1") != "0"
+
+# Messages after which an event produces nothing more
+TERMINAL = ("process_completed", "unexpected_error")
+# What the shared reader decodes; everything else is skipped undecoded
+ROUTED_MESSAGES = QUEUE_MESSAGES | {b"close_stream"}
+# How long messages for a not-yet-registered event_id are held
+EARLY_TTL = 60.0
+# Data streams in a row that may end without routing anything while jobs wait
+MAX_EMPTY_STREAMS = 3
+
+
+class _Stats:
+    def __init__(self):
+        self.connections = 0
+        self.jobs = 0
+        self.routed = 0
+        self.early = 0
+        self.dropped = 0
+        self.cancelled = 0
+
+    def as_dict(self, active):
+        return {
+            "active_jobs": active,
+            "jobs": self.jobs,
+            "connections": self.connections,
+            "routed": self.routed,
+            "early": self.early,
+            "dropped": self.dropped,
+            "cancelled": self.cancelled,
+        }
+
+
+class _Router:
+    """Routing state shared by the blocking and async multiplexers.
+
+    Callers hold `_lock` (a real lock for threads, a no-op on one loop).
+    """
+
+    def __init__(self, base):
+        self.base = base
+        self.data_url = f"{base}/gradio_api/queue/data"
+        self.session_hash = new_session_hash()
+        self._queues = {}     # event_id -> job queue
+        self._early = {}      # event_id -> (first seen, [events]) before join returned
+        self._abandoned = set()
+        self._reading = False
+        self._stats = _Stats()
+
+    def _stream_url(self):
+        return f"{self.data_url}?session_hash={self.session_hash}"
+
+    def _register(self, event_id, q):
+        """Attach a job queue; returns True if the reader has to be started."""
+        self._stats.jobs += 1
+        self._queues[event_id] = q
+        _, early = self._early.pop(event_id, (0, []))
+        for event in early:
+            q.put_nowait(event)
+        start = not self._reading
+        self._reading = True
+        return start
+
+    def _route(self, event):
+        """Hand one stream message to its job; returns True if it reached one."""
+        if observe(self.base, event):
+            return True  # queue estimates go to the Space's queue model
+        event_id = event.get("event_id")
+        if event_id is None:
+            return False  # heartbeats and the like
+        terminal = event.get("msg") in TERMINAL
+
+        q = self._queues.get(event_id)
+        if q is not None:
+            q.put_nowait(event)
+            self._stats.routed += 1
+            if terminal:
+                del self._queues[event_id]
+            return True
+
+        if event_id in self._abandoned:
+            self._stats.dropped += 1
+            if terminal:
+                self._abandoned.discard(event_id)
+            return False
+
+        now = time.monotonic()
+        for stale in [k for k, (seen, _) in self._early.items() if now - seen > EARLY_TTL]:
+            del self._early[stale]
+        self._early.setdefault(event_id, (now, []))[1].append(event)
+        self._stats.early += 1
+        return False
+
+    def _release(self, event_id, finished):
+        """A job stopped reading; drop whatever its event still sends.
+
+        Returns True if the event is still running and should be cancelled.
+        """
+        if self._queues.pop(event_id, None) is not None and not finished:
+            self._abandoned.add(event_id)
+            self._stats.cancelled += 1
+            return True
+        return False
+
+    def _stream_ended(self, error, routed_any, empty_streams):
+        """Decide whether the reader stops. Returns the new empty-stream count or None."""
+        empty_streams = 0 if routed_any else empty_streams + 1
+        if error is None and self._queues and empty_streams >= MAX_EMPTY_STREAMS:
+            error = ConnectionError(f"{self.base}: data stream keeps closing with jobs pending")
+        if error is not None:
+            for q in self._queues.values():
+                q.put_nowait(error)
+            self._queues.clear()
+        if not self._queues:
+            self._reading = False
+            return None
+        return empty_streams
+
+    def stats(self):
+        return self._stats.as_dict(len(self._queues))
+
+
+class GradioMux(_Router):
+    """One shared session and data stream per Space for the blocking client."""
+
+    def __init__(self, base):
+        super().__init__(base)
+        self._lock = threading.Lock()
+
+    def submit(self, join_url, payload):
+        """Join `payload` under the shared session; returns an iterator of its events.
+
+        The payload's own session_hash is replaced. The join happens here, so
+        upstream errors surface before the first token is awaited.
+        """
+        res = transport.client(self.base).post(
+            join_url, json={**payload, "session_hash": self.session_hash}, timeout=deadlines.timeout()
+        )
+        res.raise_for_status()
+        event_id = res.json().get("event_id")
+
+        q = queue.Queue()
+        with self._lock:
+            start = self._register(event_id, q)
+        if start:
+            threading.Thread(target=self._read, name=f"gradio-mux {self.base}", daemon=True).start()
+        return self._follow(event_id, payload.get("fn_index"), q, deadlines.current())
+
+    def _follow(self, event_id, fn_index, q, budget):
+        finished = False
+        try:
+            while True:
+                if budget is None:
+                    event = q.get()
+                else:
+                    try:
+                        event = q.get(timeout=budget.wait())
+                    except queue.Empty:
+                        budget.check()
+                        continue
+                if isinstance(event, Exception):
+                    finished = True
+                    raise event
+                yield event
+                if event.get("msg") in TERMINAL:
+                    finished = True
+                    return
+        finally:
+            with self._lock:
+                cancel = self._release(event_id, finished)
+            if cancel:
+                cancel_job(self.base, self.session_hash, fn_index, event_id)
+
+    def _read(self):
+        empty_streams = 0
+        while True:
+            error, routed_any = None, False
+            try:
+                with transport.client(self.base).stream("GET", self._stream_url()) as res:
+                    res.raise_for_status()
+                    with self._lock:
+                        self._stats.connections += 1
+                    for event in gradio_events(res.iter_bytes(), ROUTED_MESSAGES):
+                        if event.get("msg") == "close_stream":
+                            break
+                        with self._lock:
+                            routed_any = self._route(event) or routed_any
+            except Exception as e:
+                print("GRADIO STREAM ERROR:", e)
+                error = e
+
+            with self._lock:
+                empty_streams = self._stream_ended(error, routed_any, empty_streams)
+                if empty_streams is None:
+                    return
+
+
+class AsyncGradioMux(_Router):
+    """Async counterpart of GradioMux. Lives on one event loop."""
+
+    def __init__(self, base):
+        super().__init__(base)
+        self._reader = None
+
+    async def submit(self, join_url, payload):
+        res = await transport.aclient(self.base).post(
+            join_url, json={**payload, "session_hash": self.session_hash}, timeout=deadlines.timeout()
+        )
+        res.raise_for_status()
+        event_id = res.json().get("event_id")
+
+        q = asyncio.Queue()
+        if self._register(event_id, q):
+            # The shared reader outlives this call, so it must not run under its budget
+            self._reader = contextvars.Context().run(asyncio.create_task, self._read())
+        return self._follow(event_id, payload.get("fn_index"), q, deadlines.current())
+
+    async def _follow(self, event_id, fn_index, q, budget):
+        finished = False
+        try:
+            while True:
+                if budget is None:
+                    event = await q.get()
+                else:
+                    try:
+                        event = await asyncio.wait_for(q.get(), budget.wait())
+                    except asyncio.TimeoutError:
+                        budget.check()
+                        continue
+                if isinstance(event, Exception):
+                    finished = True
+                    raise event
+                yield event
+                if event.get("msg") in TERMINAL:
+                    finished = True
+                    return
+        finally:
+            if self._release(event_id, finished):
+                acancel_job(self.base, self.session_hash, fn_index, event_id)
+
+    async def _read(self):
+        empty_streams = 0
+        while True:
+            error, routed_any = None, False
+            try:
+                async with transport.aclient(self.base).stream("GET", self._stream_url()) as res:
+                    res.raise_for_status()
+                    self._stats.connections += 1
+                    async for event in agradio_events(res.aiter_bytes(), ROUTED_MESSAGES):
+                        if event.get("msg") == "close_stream":
+                            break
+                        routed_any = self._route(event) or routed_any
+            except Exception as e:
+                print("GRADIO STREAM ERROR:", e)
+                error = e
+
+            empty_streams = self._stream_ended(error, routed_any, empty_streams)
+            if empty_streams is None:
+                return
+
+
+# =======================
+# CANCELLATION
+# =======================
+# Cancels in flight on event loops; held so the tasks are not collected
+_cancels = set()
+
+
+def _cancel_request(base, session_hash, fn_index, event_id):
+    return f"{base}/gradio_api/cancel", {"session_hash": session_hash, "fn_index": fn_index, "event_id": event_id}
+
+
+def _cancel(base, session_hash, fn_index, event_id):
+    url, body = _cancel_request(base, session_hash, fn_index, event_id)
+    try:
+        transport.client(base).post(url, json=body, timeout=deadlines.DEFAULT_TIMEOUT)
+    except Exception as e:
+        print("GRADIO CANCEL ERROR:", e)
+
+
+async def _acancel(base, session_hash, fn_index, event_id):
+    url, body = _cancel_request(base, session_hash, fn_index, event_id)
+    try:
+        await transport.aclient(base).post(url, json=body, timeout=deadlines.DEFAULT_TIMEOUT)
+    except Exception as e:
+        print("GRADIO CANCEL ERROR:", e)
+
+
+def cancel_job(base, session_hash, fn_index, event_id):
+    """Cancel a running Gradio job from a background thread."""
+    threading.Thread(target=_cancel, args=(base, session_hash, fn_index, event_id), daemon=True).start()
+
+
+def acancel_job(base, session_hash, fn_index, event_id):
+    """Cancel a running Gradio job from a task on the running loop."""
+    task = asyncio.get_running_loop().create_task(_acancel(base, session_hash, fn_index, event_id))
+    _cancels.add(task)
+    task.add_done_callback(_cancels.discard)
+
+
+# =======================
+# PER-SPACE REGISTRY
+# =======================
+_muxes = {}
+_amuxes = weakref.WeakKeyDictionary()  # event loop -> {base: AsyncGradioMux}
+_lock = threading.Lock()
+
+
+def mux_for(base):
+    mux = _muxes.get(base)
+    if mux is None:
+        with _lock:
+            mux = _muxes.setdefault(base, GradioMux(base))
+    return mux
+
+
+def amux_for(base):
+    loop = asyncio.get_running_loop()
+    with _lock:
+        per_loop = _amuxes.setdefault(loop, {})
+        mux = per_loop.get(base)
+        if mux is None:
+            mux = per_loop[base] = AsyncGradioMux(base)
+    return mux
+
+
+def stats():
+    with _lock:
+        muxes = [("sync", m) for m in _muxes.values()]
+        muxes += [("async", m) for per_loop in _amuxes.values() for m in per_loop.values()]
+    spaces = {}
+    for kind, mux in muxes:
+        spaces.setdefault(mux.base, {})[kind] = mux.stats()
+    return {"enabled": True, "spaces": spaces}
+
+
+# =======================
+# ENTRY POINTS
+# =======================
+def _solo_events(base, data_url, session_hash, fn_index, event_id):
+    """Per-job data stream, used when multiplexing is off."""
+    finished = False
+    try:
+        url = f"{data_url}?session_hash={session_hash}"
+        with transport.client(base).stream("GET", url, timeout=deadlines.timeout("stream")) as res:
+            res.raise_for_status()
+            for event in gradio_events(deadlines.checked(res.iter_bytes()), QUEUE_MESSAGES):
+                if observe(base, event):
+                    continue
+                finished = event.get("msg") in TERMINAL
+                yield event
+                if finished:
+                    return
+    finally:
+        if not finished:
+            cancel_job(base, session_hash, fn_index, event_id)
+
+
+async def _asolo_events(base, data_url, session_hash, fn_index, event_id):
+    finished = False
+    try:
+        url = f"{data_url}?session_hash={session_hash}"
+        async with transport.aclient(base).stream("GET", url, timeout=deadlines.timeout("stream")) as res:
+            res.raise_for_status()
+            async for event in agradio_events(deadlines.achecked(res.aiter_bytes()), QUEUE_MESSAGES):
+                if observe(base, event):
+                    continue
+                finished = event.get("msg") in TERMINAL
+                yield event
+                if finished:
+                    return
+    finally:
+        if not finished:
+            acancel_job(base, session_hash, fn_index, event_id)
+
+
+def submit(base, join_url, payload):
+    """Join a Gradio job and return an iterator over its stream messages."""
+    if ENABLED:
+        return mux_for(base).submit(join_url, payload)
+
+    res = transport.client(base).post(join_url, json=payload, timeout=deadlines.timeout())
+    res.raise_for_status()
+    return _solo_events(
+        base, f"{base}/gradio_api/queue/data", payload["session_hash"],
+        payload.get("fn_index"), res.json().get("event_id")
+    )
+
+
+async def asubmit(base, join_url, payload):
+    """Async counterpart of submit(); returns an async iterator."""
+    if ENABLED:
+        return await amux_for(base).submit(join_url, payload)
+
+    res = await transport.aclient(base).post(join_url, json=payload, timeout=deadlines.timeout())
+    res.raise_for_status()
+    return _asolo_events(
+        base, f"{base}/gradio_api/queue/data", payload["session_hash"],
+        payload.get("fn_index"), res.json().get("event_id")
+    )
@@ -0,0 +1,127 @@
+"""
+Hedging policy for time-to-first-token tails.
+
+Space queues have long tails: most calls start within a second, a few wait
+in the queue for twenty. With hedging on, a call that has not produced its
+first token by the HEDGE_PERCENTILE of that model's recent first-token
+times starts a duplicate on another replica (or another session on the same
+one). Whichever produces a token first wins and the other is cancelled.
+
+Hedges are paid for out of a budget: every call earns HEDGE_BUDGET of a
+hedge and a hedge spends one, so at most that fraction of extra upstream
+calls is added. Unused budget is capped at HEDGE_BURST hedges.
+
+    HEDGE               "1" enables hedging (off by default)
+    HEDGE_PERCENTILE    first-token percentile that triggers a hedge (0.95)
+    HEDGE_MIN_SAMPLES   first-token samples needed before a model is hedged (20)
+    HEDGE_MIN_DELAY     never hedge sooner than this many seconds (0.5)
+    HEDGE_BUDGET        extra calls allowed per call (0.1)
+    HEDGE_BURST         most hedges that can be saved up (5)
+"""
+import os
+import threading
+from collections import deque
+
+
+ENABLED = os.environ.get("HEDGE", "0") == "1"
+PERCENTILE = float(os.environ.get("HEDGE_PERCENTILE", 0.95))
+MIN_SAMPLES = int(os.environ.get("HEDGE_MIN_SAMPLES", 20))
+MIN_DELAY = float(os.environ.get("HEDGE_MIN_DELAY", 0.5))
+BUDGET = float(os.environ.get("HEDGE_BUDGET", 0.1))
+BURST = float(os.environ.get("HEDGE_BURST", 5))
+
+# First-token samples kept per model
+WINDOW = 256
+
+
+class _ModelStats:
+    def __init__(self):
+        self.samples = deque(maxlen=WINDOW)
+        self.calls = 0
+        self.hedged = 0
+        self.won = 0
+        self.over_budget = 0
+        self.cancelled = 0
+
+    def as_dict(self):
+        return {
+            "calls": self.calls,
+            "hedged": self.hedged,
+            "won": self.won,
+            "over_budget": self.over_budget,
+            "cancelled": self.cancelled,
+            "hedge_rate": round(self.hedged / self.calls, 4) if self.calls else 0.0,
+            "win_rate": round(self.won / self.hedged, 4) if self.hedged else 0.0,
+        }
+
+
+class Hedger:
+    """Per-model first-token history, hedge delays and the hedge budget."""
+
+    def __init__(self, percentile=PERCENTILE, min_samples=MIN_SAMPLES, min_delay=MIN_DELAY,
+                 budget=BUDGET, burst=BURST):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.budget = budget
+        self.burst = burst
+        self._credit = 0.0
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def _model(self, model):
+        stats = self._models.get(model)
+        if stats is None:
+            stats = self._models[model] = _ModelStats()
+        return stats
+
+    def delay(self, model):
+        """Seconds to wait for a first token before hedging this call, or None.
+
+        Counts the call and earns its share of the budget.
+        """
+        with self._lock:
+            stats = self._model(model)
+            stats.calls += 1
+            self._credit = min(self._credit + self.budget, self.burst)
+            if len(stats.samples) < self.min_samples:
+                return None
+            ordered = sorted(stats.samples)
+            cutoff = ordered[min(int(len(ordered) * self.percentile), len(ordered) - 1)]
+            return max(cutoff, self.min_delay)
+
+    def record(self, model, seconds):
+        with self._lock:
+            self._model(model).samples.append(seconds)
+
+    def fire(self, model):
+        """Spend a hedge if the budget allows; returns whether to hedge."""
+        with self._lock:
+            stats = self._model(model)
+            if self._credit < 1.0:
+                stats.over_budget += 1
+                return False
+            self._credit -= 1.0
+            stats.hedged += 1
+            return True
+
+    def won(self, model):
+        with self._lock:
+            self._model(model).won += 1
+
+    def cancelled(self, model):
+        with self._lock:
+            self._model(model).cancelled += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": True,
+                "percentile": self.percentile,
+                "budget": self.budget,
+                "credit": round(self._credit, 3),
+                "models": {model: s.as_dict() for model, s in self._models.items()},
+            }
+
+
+hedger = Hedger() if ENABLED else None
@@ -0,0 +1,294 @@
+"""
+Prometheus metrics.
+
+A small in-process registry rendered in the Prometheus text format at
+/metrics. Recording an observation takes a lock, a tuple lookup and, for
+histograms, a bisect into the bucket bounds, so instrumentation stays on in
+production.
+
+Request metrics are labelled by provider, model and api_user. Every
+provider setup step decorated with @timed_phase (joining a Gradio queue,
+opening a conversation, pushing chat state...) is timed separately under
+its method name, so you can see which step the latency comes from.
+
+    METRICS     "0" turns recording off (/metrics then only has replica gauges)
+"""
+import asyncio
+import bisect
+import functools
+import os
+import threading
+import time
+
+
+ENABLED = os.environ.get("METRICS", "1") != "0"
+
+LATENCY_BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+RATE_BUCKETS = (1, 2.5, 5, 10, 20, 40, 80, 160, 320)
+
+REQUEST_LABELS = ("provider", "model", "api_user")
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        with self._lock:
+            values = list(self._values.items())
+        return self._header() + [f"{self.name}{_labels(self.labelnames, k)} {v}" for k, v in values]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, labels=(), amount=1):
+        self.inc(labels, -amount)
+
+    def set(self, labels, value):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, labels, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                series = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        with self._lock:
+            values = [(k, list(counts), total, n) for k, (counts, total, n) in self._values.items()]
+        lines = self._header()
+        for labels, counts, total, n in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                le = 'le="%s"' % bound
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {n}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def collector(self, collect):
+        """Add a callable returning metrics built fresh at every scrape."""
+        self._collectors.append(collect)
+        return collect
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines += metric.render()
+        for collect in self._collectors:
+            for metric in collect():
+                lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+REQUEST_SECONDS = registry.register(Histogram(
+    "gateway_request_duration_seconds", "Time from request to the end of the response.", REQUEST_LABELS))
+TTFT_SECONDS = registry.register(Histogram(
+    "gateway_time_to_first_token_seconds", "Time from request to the first token.", REQUEST_LABELS))
+STREAM_SECONDS = registry.register(Histogram(
+    "gateway_stream_duration_seconds", "Time from the first token to the last.", REQUEST_LABELS))
+TOKENS_PER_SECOND = registry.register(Histogram(
+    "gateway_tokens_per_second", "Completion tokens per second after the first token.", REQUEST_LABELS, RATE_BUCKETS))
+IN_FLIGHT = registry.register(Gauge(
+    "gateway_in_flight_streams", "Responses currently streaming.", REQUEST_LABELS))
+REQUESTS = registry.register(Counter(
+    "gateway_requests_total", "Completed responses by outcome (ok, error, cancelled).", REQUEST_LABELS + ("outcome",)))
+UPSTREAM_ERRORS = registry.register(Counter(
+    "gateway_upstream_errors_total", "Responses that failed upstream, by exception type.", REQUEST_LABELS + ("error",)))
+PHASE_SECONDS = registry.register(Histogram(
+    "upstream_phase_duration_seconds", "Duration of each provider setup step.", ("provider", "phase")))
+PHASE_ERRORS = registry.register(Counter(
+    "upstream_phase_errors_total", "Provider setup steps that raised.", ("provider", "phase")))
+REPLICA_FAILURES = registry.register(Counter(
+    "upstream_replica_failures_total", "Calls that failed on a replica.", ("endpoint",)))
+
+
+# =======================
+# PROVIDER PHASES
+# =======================
+def timed_phase(method):
+    """Time a provider setup method under its name; `__ajoin_queue__` counts as join_queue."""
+    if not ENABLED:
+        return method
+    is_async = asyncio.iscoroutinefunction(method)
+    phase = method.__name__.strip("_")
+    if is_async and phase.startswith("a"):
+        phase = phase[1:]
+
+    if is_async:
+        @functools.wraps(method)
+        async def timed(self, *args, **kwargs):
+            labels = (type(self).__name__, phase)
+            started = time.perf_counter()
+            try:
+                return await method(self, *args, **kwargs)
+            except Exception:
+                PHASE_ERRORS.inc(labels)
+                raise
+            finally:
+                PHASE_SECONDS.observe(labels, time.perf_counter() - started)
+    else:
+        @functools.wraps(method)
+        def timed(self, *args, **kwargs):
+            labels = (type(self).__name__, phase)
+            started = time.perf_counter()
+            try:
+                return method(self, *args, **kwargs)
+            except Exception:
+                PHASE_ERRORS.inc(labels)
+                raise
+            finally:
+                PHASE_SECONDS.observe(labels, time.perf_counter() - started)
+    return timed
+
+
+# =======================
+# RESPONSE STREAMS
+# =======================
+class _StreamTimer:
+    """Timings of one response, recorded once when it ends."""
+
+    def __init__(self, labels, started, meter=None):
+        self.labels = labels
+        self.started = started
+        self.meter = meter
+        self.first = None
+        self.first_tokens = 0
+        IN_FLIGHT.inc(labels)
+
+    def token(self):
+        if self.first is None:
+            self.first = time.perf_counter()
+            TTFT_SECONDS.observe(self.labels, self.first - self.started)
+            if self.meter is not None:
+                self.first_tokens = self.meter.completion_tokens
+
+    def end(self, outcome, error=None):
+        now = time.perf_counter()
+        IN_FLIGHT.dec(self.labels)
+        REQUEST_SECONDS.observe(self.labels, now - self.started)
+        if self.first is not None:
+            duration = now - self.first
+            STREAM_SECONDS.observe(self.labels, duration)
+            if self.meter is not None and duration > 0:
+                tokens = self.meter.completion_tokens - self.first_tokens
+                if tokens > 0:
+                    TOKENS_PER_SECOND.observe(self.labels, tokens / duration)
+        REQUESTS.inc(self.labels + (outcome,))
+        if error is not None:
+            UPSTREAM_ERRORS.inc(self.labels + (type(error).__name__,))
+
+
+def observe_stream(tokens, labels, started, meter=None):
+    """Pass `tokens` through, recording the response metrics for `labels`.
+
+    `started` is the request's time.perf_counter() on arrival. `meter`, with
+    the response's `completion_tokens` so far, feeds the token rate; without
+    one the rate is not recorded.
+    """
+    if not ENABLED:
+        return tokens
+
+    def observed():
+        timer = _StreamTimer(labels, started, meter)
+        outcome, error = "cancelled", None
+        try:
+            for token in tokens:
+                timer.token()
+                yield token
+            outcome = "ok"
+        except Exception as e:
+            outcome, error = "error", e
+            raise
+        finally:
+            timer.end(outcome, error)
+    return observed()
+
+
+def aobserve_stream(tokens, labels, started, meter=None):
+    """Async counterpart of observe_stream()."""
+    if not ENABLED:
+        return tokens
+
+    async def observed():
+        timer = _StreamTimer(labels, started, meter)
+        outcome, error = "cancelled", None
+        try:
+            async for token in tokens:
+                timer.token()
+                yield token
+            outcome = "ok"
+        except Exception as e:
+            outcome, error = "error", e
+            raise
+        finally:
+            timer.end(outcome, error)
+            if hasattr(tokens, "aclose"):
+                await tokens.aclose()
+    return observed()
+
+
+def record_failure(labels, error):
+    """A response that failed before its stream started."""
+    if ENABLED:
+        REQUESTS.inc(labels + ("error",))
+        UPSTREAM_ERRORS.inc(labels + (type(error).__name__,))
+
+
+def render():
+    return registry.render()
@@ -1,18 +1,28 @@
-import requests
-import uuid
-import json
+try:
+    from context import RequestContext, new_session_hash
+    from gradio_mux import submit, asubmit
+    from streamparse import append_tokens
+    from replicas import upstream_endpoints, failover, afailover
+    from metrics import timed_phase
+    from context_window import ContextWindow
+except ImportError:
+    from .context import RequestContext, new_session_hash
+    from .gradio_mux import submit, asubmit
+    from .streamparse import append_tokens
+    from .replicas import upstream_endpoints, failover, afailover
+    from .metrics import timed_phase
+    from .context_window import ContextWindow
 
 class Qwen3Omni:
+    model_aliases = ["Qwen3Omni", "Qwen3Omni-think"]
+    model_list = model_aliases
+    tokenizer_family = "qwen"
+
     def __init__(self):
-        self.url_base = "https://qwen-qwen3-omni-demo.hf.space"
-        self.model_aliases = ["Qwen3Omni", "Qwen3Omni-think"]
-        self.messages = []
+        self.endpoints = upstream_endpoints("Qwen3Omni", "https://qwen-qwen3-omni-demo.hf.space")
+        self.context = ContextWindow("Qwen3Omni", self.tokenizer_family, lambda role, content: content)
         self.default_model = "Qwen3Omni"
-        self.session_hash = str(uuid.uuid4()).replace('-', '')[:10]
-        self.model_list = self.model_aliases
 
-        self.prompt = None
-        self.system_prompt = None
         self.temperature = 0.6
         self.top_p = 0.95
         self.top_k = 20
@@ -27,21 +37,23 @@ class Qwen3Omni:
         """
 
     # -----------------------------------------------------
-    def __add_system_prompt__(self):
-        """Extract system prompt and remove it from messages."""
-        self.system_prompt = self.system_template.replace("{MAXTOKENS}", str(self.maxtoken))
-
-        for i, msg in enumerate(self.messages):
-            if msg.get("role") == "system":
-                self.system_prompt += "\n" + msg.get("content")
-                del self.messages[i]
-                break
+    def __add_system_prompt__(self, ctx):
+        """Build the system prompt from the template and the caller's system message."""
+        system_prompt = self.system_template.replace("{MAXTOKENS}", str(ctx.max_tokens))
+
+        system, _ = ctx.split_system()
+        if system is not None:
+            system_prompt += "\n" + system
+
+        return system_prompt
 
     # -----------------------------------------------------
-    def __prompt_and_messages_gen__(self):
+    def __prompt_and_messages_gen__(self, ctx):
+        """Return (last user prompt, Gradio chat history without it), trimmed to the context budget."""
         converted_messages = []
 
-        for msg in self.messages:
+        _, messages = ctx.split_system()
+        for msg in self.context.keep(messages, ctx.max_tokens, self.__add_system_prompt__(ctx)):
             converted_messages.append({
                 "role": "assistant" if msg.get("role") == "assistant" else "user",
                 "metadata": None,
@@ -57,111 +69,119 @@ class Qwen3Omni:
                 del converted_messages[i]
                 break
 
-        self.prompt = last_user_prompt
-        self.messages = converted_messages
+        return last_user_prompt, converted_messages
 
     # -----------------------------------------------------
-    def __model_alias__(self):
-        if self.default_model == "Qwen3Omni":
-            self.thinking = False
-        elif self.default_model == "Qwen3Omni-think":
-            self.thinking = True
+    def __model_alias__(self, ctx):
+        """Whether the requested alias runs in thinking mode."""
+        if ctx.model == "Qwen3Omni":
+            return False
+        elif ctx.model == "Qwen3Omni-think":
+            return True
         else:
             print("Invalid model. Using base model.")
-            self.thinking = False
+            return False
 
     # -----------------------------------------------------
-    def __join_queue__(self):
-        url = f"{self.url_base}/gradio_api/queue/join?"
+    def __build_payload__(self, ctx):
+        prompt, messages = self.__prompt_and_messages_gen__(ctx)
 
-        payload = {
+        return {
             "data": [
-                self.prompt,
+                prompt,
                 None,
                 None,
                 None,
-                self.messages,
-                self.system_prompt,
+                messages,
+                self.__add_system_prompt__(ctx),
                 "Cherry / 芊悦",
                 self.temperature,
                 self.top_p,
                 self.top_k,
                 False,
-                self.thinking
+                self.__model_alias__(ctx)
             ],
             "event_data": None,
             "fn_index": 4,
             "trigger_id": 37,
-            "session_hash": self.session_hash
+            "session_hash": ctx.session_hash
         }
-        res = requests.post(url, json=payload)
-        res.raise_for_status()
-        return res.json()
 
     # -----------------------------------------------------
-    def __get_response__(self):
-        url = f"{self.url_base}/gradio_api/queue/data?session_hash={self.session_hash}"
-        res = requests.get(url, stream=True)
-        res.raise_for_status()
+    @timed_phase
+    def __join_queue__(self, ctx):
+        """Join the queue; returns an iterator over this job's stream messages."""
+        url = f"{ctx.base}/gradio_api/queue/join?"
+        return submit(ctx.base, url, self.__build_payload__(ctx))
 
-        for line in res.iter_lines():
-            if not line or not line.startswith(b"data: "):
-                continue
-
-            data = json.loads(line[6:])
-            msg = data.get("msg")
+    # -----------------------------------------------------
+    def __get_response__(self, events):
+        for data in events:
+            yield from append_tokens(data, 4)   # <<< TOKEN STREAM HERE
 
-            if msg == "process_generating":
-                outputs = data.get("output", {}).get("data", [])
-                if not outputs:
-                    continue
+    # -----------------------------------------------------
+    @timed_phase
+    async def __ajoin_queue__(self, ctx):
+        url = f"{ctx.base}/gradio_api/queue/join?"
+        return await asubmit(ctx.base, url, self.__build_payload__(ctx))
 
-                delta_list = outputs[4]   # <<< TOKEN STREAM HERE
+    # -----------------------------------------------------
+    async def __aget_response__(self, events):
+        async for data in events:
+            for token in append_tokens(data, 4):
+                yield token
 
-                for patch in delta_list:
-                    if len(patch) == 3:
-                        op, path, value = patch
-                        if op == "append" and isinstance(value, str):
-                            yield value
+    # -----------------------------------------------------
+    def __attempt__(self, ctx, base):
+        """Run the call on replica `base`; returns its token iterator."""
+        return self.__get_response__(self.__join_queue__(ctx.on(base, new_session_hash())))
 
-                            
+    async def __aattempt__(self, ctx, base):
+        return self.__aget_response__(await self.__ajoin_queue__(ctx.on(base, new_session_hash())))
 
     # -----------------------------------------------------
     def create(self, message, model="Qwen3Omni",max_tokens=2000,stream:bool=True):
-        self.messages = message
-        self.default_model = model
-        self.maxtoken = max_tokens
+        ctx = RequestContext.new(message, model, max_tokens, stream)
+        tokens = failover(self.endpoints, lambda base: self.__attempt__(ctx, base), model=ctx.model)
 
-        self.__add_system_prompt__()
-        self.__prompt_and_messages_gen__()
-        self.__model_alias__()
-        self.__join_queue__()
+        if stream:
+            return tokens
+        else:
+            text=''
+            for chunk in tokens:
+                text += chunk
+
+            return text
+
+    # -----------------------------------------------------
+    async def acreate(self, message, model="Qwen3Omni",max_tokens=2000,stream:bool=True):
+        """Async counterpart of create(); streams through a non-blocking client."""
+        ctx = RequestContext.new(message, model, max_tokens, stream)
+        tokens = await afailover(self.endpoints, lambda base: self.__aattempt__(ctx, base), model=ctx.model)
 
         if stream:
-            return self.__get_response__()
+            return tokens
         else:
             text=''
-            for chunk in self.__get_response__():
+            async for chunk in tokens:
                 text += chunk
-            
+
             return text
 
 
 
 class Qwen3VL:
-    def __init__(self):
-        self.url_base = "https://qwen-qwen3-vl-demo.hf.space"
-        self.join_url = f"{self.url_base}/gradio_api/queue/join?__theme=dark"
-        self.stream_url = f"{self.url_base}/gradio_api/queue/data"
+    model_aliases = ["Qwen3VL"]
+    model_list = model_aliases
+    tokenizer_family = "qwen"
 
-        self.model_aliases = ["Qwen3VL"]
-        self.model_list = self.model_aliases
+    def __init__(self):
+        self.endpoints = upstream_endpoints("Qwen3VL", "https://qwen-qwen3-vl-demo.hf.space")
+        self.context = ContextWindow("Qwen3VL", self.tokenizer_family, self.__fragment__)
         self.default_model = "Qwen3VL"
-
-        self.messages = []
-        self.prompt = None
         self.max_tokens = 2048
-        self.system_prompt = """
+
+        self.system_template = """
         You must strictly ensure your response never exceeds {MAXTOKENS} tokens.
         If a user's request requires more than {MAXTOKENS} tokens, you must compress,
         summarize, or shorten the output so the entire response fits within {MAXTOKENS} tokens.
@@ -169,91 +189,92 @@ class Qwen3VL:
         and never ignore this constraint for any reason.
         """
 
-        self.session_hash = str(uuid.uuid4()).replace("-", "")[:10]
-        self.session = requests.Session()
-
     # -----------------------------------------------------
-    def __gen_prompt__(self):
-        """Generate prompt from messages."""
-        prompt = ""
-        self.system_prompt = self.system_prompt.replace("{MAXTOKENS}", str(self.max_tokens))
-
-        for msg in self.messages:
-            role = msg.get("role")
-            content = msg.get("content", "")
-
-            if role == "system":
-                prompt += f"<|System|>:{content}\n" + self.system_prompt + "\n"
-            elif role == "user":
-                prompt += f"<|User|>:{content}\n"
-            elif role == "assistant":
-                prompt += f"<|Assistant|>:{content}\n"
-
-        self.prompt = prompt.strip()
-
-    def __build_payload__(self):
+    @staticmethod
+    def __fragment__(role, content):
+        if role == "system":
+            return f"<|System|>:{content}\n"
+        elif role == "user":
+            return f"<|User|>:{content}\n"
+        elif role == "assistant":
+            return f"<|Assistant|>:{content}\n"
+        return None
+
+    def __gen_prompt__(self, ctx):
+        """Generate prompt from messages, trimmed to the context budget."""
+        system, messages = ctx.split_system()
+        head = ""
+        if system is not None:
+            system_prompt = self.system_template.replace("{MAXTOKENS}", str(ctx.max_tokens))
+            head = f"<|System|>:{system}\n" + system_prompt + "\n"
+
+        return (head + self.context.render(messages, ctx.max_tokens, head)).strip()
+
+    def __build_payload__(self, ctx):
         return {
             "data": [
-                {"files": None, "text": self.prompt},
+                {"files": None, "text": self.__gen_prompt__(ctx)},
                 None,
                 None
             ],
             "event_data": None,
             "fn_index": 11,
             "trigger_id": 31,
-            "session_hash": self.session_hash
+            "session_hash": ctx.session_hash
         }
 
-    def __join_queue__(self):
-        payload = self.__build_payload__()
-        res = self.session.post(self.join_url, json=payload)
-        res.raise_for_status()
-        return res.json().get("event_id")
+    @timed_phase
+    def __join_queue__(self, ctx):
+        """Join the queue; returns an iterator over this job's stream messages."""
+        url = f"{ctx.base}/gradio_api/queue/join?__theme=dark"
+        return submit(ctx.base, url, self.__build_payload__(ctx))
 
-    def __listen_stream__(self):
-        url = f"{self.stream_url}?session_hash={self.session_hash}"
-        res = self.session.get(url, stream=True)
-        res.raise_for_status()
+    def __listen_stream__(self, events):
+        for event in events:
+            # ['append', ['value', 1, 'content', 0, 'content'], 'text']
+            yield from append_tokens(event, 5)
 
-        for raw_line in res.iter_lines(decode_unicode=True):
-            if not raw_line or not raw_line.startswith("data:"):
-                continue
 
-            data = raw_line[5:].strip()
-            if data == "[DONE]":
-                break
-
-            try:
-                event = json.loads(data)
-            except json.JSONDecodeError:
-                continue
-
-    
+    @timed_phase
+    async def __ajoin_queue__(self, ctx):
+        url = f"{ctx.base}/gradio_api/queue/join?__theme=dark"
+        return await asubmit(ctx.base, url, self.__build_payload__(ctx))
 
-            if event.get("msg") != "process_generating":
-                continue
+    async def __alisten_stream__(self, events):
+        async for event in events:
+            for token in append_tokens(event, 5):
+                yield token
 
-            # Gradio diff ops
-            updates = event["output"]["data"][5]
+    def __attempt__(self, ctx, base):
+        """Run the call on replica `base`; returns its token iterator."""
+        return self.__listen_stream__(self.__join_queue__(ctx.on(base, new_session_hash())))
 
-            for op in updates:
-                # ['append', ['value', 1, 'content', 0, 'content'], 'text']
-                if op[0] == "append" and isinstance(op[2], str):
-                    yield op[2]
+    async def __aattempt__(self, ctx, base):
+        return self.__alisten_stream__(await self.__ajoin_queue__(ctx.on(base, new_session_hash())))
 
     # -----------------------------------------------------
     def create(self, message, model="Qwen3VL", max_tokens=10000000000, stream=True):
-        self.default_model = model
-        self.messages = message
-        self.max_tokens = max_tokens
+        ctx = RequestContext.new(message, model, max_tokens, stream)
+        tokens = failover(self.endpoints, lambda base: self.__attempt__(ctx, base), model=ctx.model)
 
-        self.__gen_prompt__()
-        self.__join_queue__()
+        if stream:
+            return tokens
+        else:
+            output = ""
+            for chunk in tokens:
+                output += chunk
+            return output
+
+    # -----------------------------------------------------
+    async def acreate(self, message, model="Qwen3VL", max_tokens=10000000000, stream=True):
+        """Async counterpart of create(); streams through a non-blocking client."""
+        ctx = RequestContext.new(message, model, max_tokens, stream)
+        tokens = await afailover(self.endpoints, lambda base: self.__aattempt__(ctx, base), model=ctx.model)
 
         if stream:
-            return self.__listen_stream__()
+            return tokens
         else:
             output = ""
-            for chunk in self.__listen_stream__():
+            async for chunk in tokens:
                 output += chunk
-            return output
\ No newline at end of file
+            return output
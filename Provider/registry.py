@@ -0,0 +1,149 @@
+"""
+Declarative model registry.
+
+Each provider is declared once with the models it serves and a lazy import
+target ("module:Class"). The model -> provider index is a plain dict built at
+registration time, so routing a request is a single hash lookup, and a
+provider module is only imported the first time one of its models is used.
+
+Third-party providers register themselves through `register_provider()`,
+either from code or by listing their modules in PROVIDER_PLUGINS
+(comma-separated import paths, imported when the Provider package loads).
+A provider may list its replica base URLs in `endpoints` for queue admission;
+one without them is never refused for a long upstream queue.
+"""
+import hashlib
+import importlib
+import json
+import os
+import threading
+
+
+class ProviderSpec:
+    """Registration record for one provider."""
+
+    def __init__(self, name: str, target, models):
+        self.name = name
+        self.target = target
+        self.models = tuple(models)
+        self._cls = None if isinstance(target, str) else target
+        self._engine = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Import (once) and return the provider class."""
+        if self._cls is None:
+            module_name, _, attr = self.target.partition(":")
+            if module_name.startswith(".") and not __package__:
+                module_name = module_name[1:]
+            cls = getattr(importlib.import_module(module_name, __package__), attr)
+
+            missing = set(self.models) - set(cls.model_aliases)
+            if missing:
+                raise ValueError(
+                    f"Provider '{self.name}' registered models it does not serve: {sorted(missing)}"
+                )
+            self._cls = cls
+        return self._cls
+
+    def engine(self):
+        """The shared provider instance.
+
+        Engines keep only configuration on `self` and take a fresh
+        RequestContext per call, so one instance serves every request.
+        """
+        if self._engine is None:
+            with self._lock:
+                if self._engine is None:
+                    self._engine = self.load()()
+        return self._engine
+
+
+_specs = {}
+_model_index = {}
+provider_and_models = {}
+provider_list = []
+_models_payload = None
+_lock = threading.Lock()
+
+
+def register_provider(name: str, target, models=None):
+    """Register a provider under `name`.
+
+    `target` is either the provider class itself, in which case its
+    class-level `model_aliases` are used, or a lazy "module:Class" string,
+    in which case `models` must be given.
+    """
+    global _models_payload
+
+    if models is None:
+        if isinstance(target, str):
+            raise ValueError("models are required for lazily imported providers")
+        models = target.model_aliases
+
+    spec = ProviderSpec(name, target, models)
+
+    with _lock:
+        for model in spec.models:
+            owner = _model_index.get(model)
+            if owner is not None and owner.name != name:
+                raise ValueError(f"Model '{model}' is already served by '{owner.name}'.")
+
+        old = _specs.get(name)
+        if old is not None:
+            for model in old.models:
+                _model_index.pop(model, None)
+
+        _specs[name] = spec
+        for model in spec.models:
+            _model_index[model] = spec
+        provider_and_models[name] = list(spec.models)
+        if name not in provider_list:
+            provider_list.append(name)
+        _models_payload = None
+
+    return spec
+
+
+def load_plugins(modules=None):
+    """Import plugin modules so they can call register_provider()."""
+    if modules is None:
+        modules = os.environ.get("PROVIDER_PLUGINS", "")
+    if isinstance(modules, str):
+        modules = [m.strip() for m in modules.split(",") if m.strip()]
+
+    for module_name in modules:
+        importlib.import_module(module_name)
+
+
+def lookup(model_name: str):
+    """Return the ProviderSpec serving `model_name`, or None."""
+    return _model_index.get(model_name)
+
+
+def provider_class(model_name: str):
+    spec = _model_index.get(model_name)
+    if spec is None:
+        raise ValueError(f"Model '{model_name}' not found in any provider.")
+    return spec.load()
+
+
+def engine(model_name: str):
+    """The shared engine serving `model_name`."""
+    spec = _model_index.get(model_name)
+    if spec is None:
+        raise ValueError(f"Model '{model_name}' not found in any provider.")
+    return spec.engine()
+
+
+def models_payload():
+    """Prebuilt (body, etag) for the /models endpoint."""
+    global _models_payload
+
+    payload = _models_payload
+    if payload is None:
+        all_models = [model for spec in list(_specs.values()) for model in spec.models]
+        body = json.dumps(all_models).encode()
+        etag = '"' + hashlib.sha1(body).hexdigest()[:16] + '"'
+        payload = _models_payload = (body, etag)
+    return payload
@@ -0,0 +1,730 @@
+"""
+Replica selection, circuit breaking and first-token failover.
+
+A provider can be served by several equivalent upstream endpoints (copies of
+the same Space). Each call picks one with power-of-two-choices: two random
+healthy replicas are compared on EWMA time-to-first-token, scaled up by
+requests already in flight and by the EWMA error rate. For Gradio Spaces the
+queue wait predicted from their `estimation` messages (Provider/space_queues.py)
+is added to the time to first token. A replica that fails
+REPLICA_BREAKER_FAILURES times in a row is ejected. After
+REPLICA_BREAKER_COOLDOWN seconds it gets a single half-open probe call: if
+the probe succeeds the replica is back, if it fails the replica is ejected
+again.
+
+Until the first token arrives nothing has been sent to the client, so a
+replica that errors or ends its stream empty is recorded as failed and the
+call moves on to the next replica. After the first token, errors propagate.
+
+With hedging enabled (Provider/hedging.py), a call still waiting for its
+first token after the hedge delay races a duplicate attempt on another
+replica, or on the same one when it is the only replica left. The first
+attempt to produce a token wins and the other one is closed, which cancels
+its upstream job.
+
+With UPSTREAM_ADAPTIVE_LIMIT=1 each replica also has an adaptive in-flight
+limit (Provider/adaptive_limit.py) learned from its first-token times and
+failures. Replicas at their limit are
+skipped. When every replica of a call is at its limit, the call waits in a
+local queue of at most UPSTREAM_QUEUE_MAX calls for up to
+UPSTREAM_QUEUE_TIMEOUT seconds, then fails with UpstreamSaturated.
+
+Calls run under the request's deadline budget (Provider/deadlines.py). The
+local queue wait is capped by the time the request has left. A setup or
+connect timeout counts as a replica failure and moves on like any other
+error; running out of the first-token limit or the request deadline ends
+the call with UpstreamTimeout, since another replica has no time left
+either. Only the first-token limit marks the replica failed.
+
+Endpoints default to the provider's built-in Space and are overridden with
+a comma-separated list in <PROVIDER>_ENDPOINTS, e.g. QWEN3OMNI_ENDPOINTS.
+
+    REPLICA_EWMA_ALPHA          weight of the newest sample (0.3)
+    REPLICA_BREAKER_FAILURES    consecutive failures that eject a replica (3)
+    REPLICA_BREAKER_COOLDOWN    seconds before an ejected replica is probed (30)
+    UPSTREAM_QUEUE_MAX          calls that may wait for a replica under its limit (128)
+    UPSTREAM_QUEUE_TIMEOUT      seconds a call may wait for one (10)
+"""
+import asyncio
+import contextvars
+import os
+import queue
+import random
+import threading
+import time
+import weakref
+
+try:
+    from hedging import hedger
+    from space_queues import space_queues
+    from adaptive_limit import AdaptiveLimit, ENABLED as ADAPTIVE_LIMIT
+    from metrics import Gauge, REPLICA_FAILURES, registry
+    import deadlines
+except ImportError:
+    from .hedging import hedger
+    from .space_queues import space_queues
+    from .adaptive_limit import AdaptiveLimit, ENABLED as ADAPTIVE_LIMIT
+    from .metrics import Gauge, REPLICA_FAILURES, registry
+    from . import deadlines
+
+
+EWMA_ALPHA = float(os.environ.get("REPLICA_EWMA_ALPHA", 0.3))
+BREAKER_FAILURES = int(os.environ.get("REPLICA_BREAKER_FAILURES", 3))
+BREAKER_COOLDOWN = float(os.environ.get("REPLICA_BREAKER_COOLDOWN", 30))
+QUEUE_MAX = int(os.environ.get("UPSTREAM_QUEUE_MAX", 128))
+QUEUE_TIMEOUT = float(os.environ.get("UPSTREAM_QUEUE_TIMEOUT", 10))
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+
+class UpstreamUnavailable(Exception):
+    """Every replica failed before producing a token."""
+
+
+class UpstreamSaturated(UpstreamUnavailable):
+    """Every replica is at its concurrency limit and the local queue is full or timed out."""
+
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def upstream_endpoints(name, default):
+    """Endpoints for a provider: <NAME>_ENDPOINTS if set, else [default]."""
+    configured = os.environ.get(f"{name.upper()}_ENDPOINTS", "")
+    endpoints = [url.strip().rstrip("/") for url in configured.split(",") if url.strip()]
+    return endpoints or [default]
+
+
+class Replica:
+    """Health and latency of one upstream endpoint."""
+
+    def __init__(self, url):
+        self.url = url
+        self.ttft = None        # EWMA seconds to first token
+        self.error_rate = 0.0   # EWMA of failures per call
+        self.in_flight = 0
+        self.state = CLOSED
+        self.failures_in_row = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.calls = 0
+        self.failures = 0
+        self.limit = AdaptiveLimit() if ADAPTIVE_LIMIT else None
+
+    def has_room(self):
+        return self.limit is None or self.limit.allows(self.in_flight)
+
+    def score(self, queue_wait=0.0):
+        ttft = self.ttft if self.ttft is not None else 0.0
+        return (ttft + queue_wait + 0.05) * (1 + self.in_flight) / max(1.0 - self.error_rate, 0.05)
+
+    def available(self, now):
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN and now - self.opened_at >= BREAKER_COOLDOWN:
+            return True  # due for a half-open probe
+        return False
+
+    def _sample(self, failed):
+        self.error_rate += EWMA_ALPHA * ((1.0 if failed else 0.0) - self.error_rate)
+
+    def as_dict(self):
+        return {
+            "state": self.state,
+            "ttft_ms": round(self.ttft * 1000, 1) if self.ttft is not None else None,
+            "error_rate": round(self.error_rate, 4),
+            "in_flight": self.in_flight,
+            "calls": self.calls,
+            "failures": self.failures,
+            "concurrency": self.limit.as_dict() if self.limit is not None else None,
+        }
+
+
+def _score(replica):
+    return replica.score(space_queues.wait(replica.url) if space_queues is not None else 0.0)
+
+
+class ReplicaTable:
+    """Replica health for every endpoint in the process, keyed by URL."""
+
+    def __init__(self):
+        self._replicas = {}
+        self._lock = threading.Lock()
+        self._room = threading.Condition(self._lock)
+        self._awaiting = []  # wake callbacks of async calls queued for room
+        self.failovers = 0
+        self.queued = 0
+        self.saturated = 0
+
+    def _get(self, url):
+        replica = self._replicas.get(url)
+        if replica is None:
+            replica = self._replicas[url] = Replica(url)
+        return replica
+
+    def pick(self, urls, exclude=(), prefer=None):
+        """Start a call on the best available replica of `urls`, or return None."""
+        with self._lock:
+            return self._pick(urls, exclude, prefer)
+
+    def _pick(self, urls, exclude, prefer):
+        now = time.monotonic()
+        replicas = [self._get(url) for url in urls if url not in exclude]
+        candidates = [r for r in replicas if r.available(now) and r.has_room()]
+        if not candidates:
+            if not replicas or exclude or any(r.available(now) for r in replicas):
+                return None
+            # Everything is ejected: probe the replica ejected longest ago
+            candidates = [min(replicas, key=lambda r: r.opened_at)]
+
+        preferred = [r for r in candidates if r.url == prefer]
+        if preferred:
+            replica = preferred[0]
+        elif len(candidates) == 1:
+            replica = candidates[0]
+        else:
+            a, b = random.sample(candidates, 2)
+            replica = a if _score(a) <= _score(b) else b
+
+        if replica.state != CLOSED:
+            replica.state = HALF_OPEN
+            replica.probing = True
+        replica.in_flight += 1
+        replica.calls += 1
+        return replica
+
+    def _full(self, urls, exclude):
+        """True if `urls` has usable replicas and every one is at its limit."""
+        now = time.monotonic()
+        return any(self._get(url).available(now) for url in urls if url not in exclude)
+
+    def _saturated(self, urls):
+        self.saturated += 1
+        return UpstreamSaturated(f"every replica of {list(urls)} is at its concurrency limit")
+
+    def acquire(self, urls, exclude=(), prefer=None, timeout=QUEUE_TIMEOUT):
+        """pick(), queueing while every usable replica is at its limit."""
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            while True:
+                replica = self._pick(urls, exclude, prefer)
+                if replica is not None or not self._full(urls, exclude):
+                    return replica
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or self.queued >= QUEUE_MAX:
+                    raise self._saturated(urls)
+                self.queued += 1
+                try:
+                    self._room.wait(remaining)
+                finally:
+                    self.queued -= 1
+
+    async def aacquire(self, urls, exclude=(), prefer=None, timeout=QUEUE_TIMEOUT):
+        """Async counterpart of acquire()."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            with self._lock:
+                replica = self._pick(urls, exclude, prefer)
+                if replica is not None or not self._full(urls, exclude):
+                    return replica
+                remaining = deadline - loop.time()
+                if remaining <= 0 or self.queued >= QUEUE_MAX:
+                    raise self._saturated(urls)
+                room = loop.create_future()
+                wake = _waker(loop, room)
+                self._awaiting.append(wake)
+                self.queued += 1
+            try:
+                await asyncio.wait_for(room, remaining)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                with self._lock:
+                    self.queued -= 1
+                    if wake in self._awaiting:
+                        self._awaiting.remove(wake)
+
+    def _wake(self):
+        """Room may have opened up: let queued calls look again. Called with the lock held."""
+        self._room.notify_all()
+        awaiting, self._awaiting = self._awaiting, []
+        for wake in awaiting:
+            wake()
+
+    def first_token(self, replica, seconds):
+        with self._lock:
+            replica.ttft = seconds if replica.ttft is None else replica.ttft + EWMA_ALPHA * (seconds - replica.ttft)
+            replica._sample(False)
+            replica.failures_in_row = 0
+            replica.state = CLOSED
+            replica.probing = False
+            if replica.limit is not None:
+                replica.limit.sample(seconds, replica.in_flight)
+                self._wake()
+
+    def failed(self, replica):
+        with self._lock:
+            replica._sample(True)
+            replica.failures += 1
+            replica.failures_in_row += 1
+            REPLICA_FAILURES.inc((replica.url,))
+            if replica.probing or replica.failures_in_row >= BREAKER_FAILURES:
+                replica.state = OPEN
+                replica.opened_at = time.monotonic()
+            replica.probing = False
+            if replica.limit is not None:
+                replica.limit.failed()
+
+    def done(self, replica):
+        with self._lock:
+            replica.in_flight -= 1
+            self._wake()
+
+    def abandoned(self, replica):
+        """The call was cancelled before its replica answered either way."""
+        with self._lock:
+            replica.in_flight -= 1
+            if replica.probing:
+                replica.state = OPEN  # still due for a probe
+                replica.probing = False
+            self._wake()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "failovers": self.failovers,
+                "queued": self.queued,
+                "saturated": self.saturated,
+                "replicas": {url: r.as_dict() for url, r in self._replicas.items()},
+            }
+
+
+def _waker(loop, future):
+    def wake():
+        loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+    return wake
+
+
+replica_table = ReplicaTable()
+
+
+@registry.collector
+def _replica_metrics():
+    labels = ("endpoint",)
+    in_flight = Gauge("upstream_replica_in_flight", "Calls running on each replica.", labels)
+    limit = Gauge("upstream_replica_concurrency_limit", "Adaptive in-flight limit of each replica.", labels)
+    ttft = Gauge("upstream_replica_ttft_seconds", "EWMA time to first token of each replica.", labels)
+    ejected = Gauge("upstream_replica_ejected", "1 while the replica's breaker is open.", labels)
+    with replica_table._lock:
+        for url, replica in replica_table._replicas.items():
+            in_flight.set((url,), replica.in_flight)
+            if replica.limit is not None:
+                limit.set((url,), round(replica.limit.limit, 3))
+            if replica.ttft is not None:
+                ttft.set((url,), round(replica.ttft, 4))
+            ejected.set((url,), int(replica.state != CLOSED))
+    return [in_flight, limit, ttft, ejected]
+
+
+# =======================
+# FAILOVER
+# =======================
+def _close(tokens):
+    if hasattr(tokens, "close"):
+        tokens.close()
+
+
+class _Release:
+    """Ends a call's in-flight count once, whether the stream finishes or is dropped unread."""
+
+    def __init__(self, replica):
+        self.replica = replica
+        self.released = False
+
+    def __call__(self):
+        if not self.released:
+            self.released = True
+            replica_table.done(self.replica)
+
+
+def _relay(replica, first, tokens, release, budget):
+    try:
+        yield first
+        for token in tokens:
+            if budget is not None:
+                budget.token()
+            yield token
+    except Exception as e:
+        if not _out_of_time(e):
+            replica_table.failed(replica)
+        timeout = deadlines.as_timeout(e, "token")
+        if timeout is e:
+            raise
+        raise timeout from e
+    finally:
+        _close(tokens)
+        release()
+
+
+def _winner(replica, first, tokens):
+    release = _Release(replica)
+    budget = deadlines.current()
+    if budget is not None:
+        budget.token()
+    relay = _relay(replica, first, tokens, release, budget)
+    weakref.finalize(relay, release)
+    return relay
+
+
+def _out_of_time(error):
+    """True if `error` is the request running out of time rather than the replica failing."""
+    return isinstance(error, deadlines.UpstreamTimeout) and error.phase == "deadline"
+
+
+def _final(error):
+    """True if the call should stop at `error` instead of trying another replica."""
+    return isinstance(error, deadlines.UpstreamTimeout) and error.phase in ("deadline", "first_token")
+
+
+def _queue_timeout():
+    budget = deadlines.current()
+    if budget is None:
+        return QUEUE_TIMEOUT
+    budget.check()
+    return min(QUEUE_TIMEOUT, budget.remaining())
+
+
+def failover(urls, attempt, prefer=None, model=None):
+    """Token iterator from the first replica of `urls` that produces a token.
+
+    `attempt(url)` runs the provider's setup against one replica and returns
+    its token iterator. This blocks until the first token, so setup errors
+    and empty streams move on to another replica instead of reaching the
+    client. `prefer` is tried first if it is available. `model` keys the
+    first-token history used for hedging.
+    """
+    delay = hedger.delay(model) if hedger is not None else None
+    if delay is not None:
+        return _hedged(urls, attempt, prefer, model, delay)
+
+    tried = []
+    error = None
+    while True:
+        replica = replica_table.acquire(urls, tried, prefer, timeout=_queue_timeout())
+        if replica is None:
+            raise error or UpstreamUnavailable(f"no upstream available among {list(urls)}")
+        if tried:
+            replica_table.failovers += 1
+        tried.append(replica.url)
+
+        started = time.monotonic()
+        tokens = None
+        try:
+            tokens = iter(attempt(replica.url))
+            first = next(tokens)
+        except StopIteration:
+            error = UpstreamUnavailable(f"{replica.url}: stream ended before the first token")
+        except Exception as e:
+            error = deadlines.as_timeout(e)
+        except BaseException:
+            replica_table.abandoned(replica)
+            raise
+        else:
+            ttft = time.monotonic() - started
+            replica_table.first_token(replica, ttft)
+            if hedger is not None:
+                hedger.record(model, ttft)
+            return _winner(replica, first, tokens)
+
+        print("UPSTREAM FAILOVER:", replica.url, error)
+        _close(tokens)
+        if not _out_of_time(error):
+            replica_table.failed(replica)
+        replica_table.done(replica)
+        if _final(error):
+            raise error
+
+
+# =======================
+# HEDGING
+# =======================
+def _hedge_replica(urls, tried):
+    """Another replica for a hedge, or the same one again if it is the only one left."""
+    return replica_table.pick(urls, tried) or replica_table.pick(urls)
+
+
+def _race(replica, attempt, results):
+    """Run one attempt up to its first token and report (replica, tokens, first, error, ttft)."""
+    started = time.monotonic()
+    tokens = None
+    try:
+        tokens = iter(attempt(replica.url))
+        first = next(tokens)
+    except StopIteration:
+        results.put((replica, tokens, None, UpstreamUnavailable(f"{replica.url}: stream ended before the first token"), 0.0))
+    except Exception as e:
+        results.put((replica, tokens, None, deadlines.as_timeout(e), 0.0))
+    else:
+        results.put((replica, tokens, first, None, time.monotonic() - started))
+
+
+def _reap(results, pending, model):
+    """Close the attempts that lost a race as they come in."""
+    for _ in range(pending):
+        replica, tokens, first, error, ttft = results.get()
+        _close(tokens)
+        if error is None:
+            replica_table.first_token(replica, ttft)
+        else:
+            replica_table.failed(replica)
+        replica_table.done(replica)
+        hedger.cancelled(model)
+
+
+def _hedged(urls, attempt, prefer, model, delay):
+    """failover() racing a second attempt once `delay` seconds pass without a token."""
+    results = queue.Queue()
+    tried = []
+    error = None
+    pending = 0
+    hedge = None
+    hedge_at = None
+    started = time.monotonic()
+
+    def launch(replica):
+        nonlocal pending
+        tried.append(replica.url)
+        pending += 1
+        context = contextvars.copy_context()
+        threading.Thread(target=context.run, args=(_race, replica, attempt, results), daemon=True).start()
+
+    replica = replica_table.acquire(urls, prefer=prefer, timeout=_queue_timeout())
+    if replica is None:
+        raise UpstreamUnavailable(f"no upstream available among {list(urls)}")
+    launch(replica)
+    hedge_at = started + delay
+
+    while pending:
+        timeout = max(0.0, hedge_at - time.monotonic()) if hedge_at is not None else None
+        try:
+            replica, tokens, first, failure, ttft = results.get(timeout=timeout)
+        except queue.Empty:
+            hedge_at = None
+            if hedger.fire(model):
+                hedge = _hedge_replica(urls, tried)
+                if hedge is not None:
+                    launch(hedge)
+            continue
+        pending -= 1
+
+        if failure is not None:
+            print("UPSTREAM FAILOVER:", replica.url, failure)
+            _close(tokens)
+            if not _out_of_time(failure):
+                replica_table.failed(replica)
+            replica_table.done(replica)
+            error = failure
+            if _final(failure):
+                if pending:
+                    threading.Thread(target=_reap, args=(results, pending, model), daemon=True).start()
+                raise failure
+            if not pending:
+                nxt = replica_table.acquire(urls, tried, timeout=_queue_timeout())
+                if nxt is not None:
+                    replica_table.failovers += 1
+                    launch(nxt)
+            continue
+
+        replica_table.first_token(replica, ttft)
+        hedger.record(model, time.monotonic() - started)
+        if replica is hedge:
+            hedger.won(model)
+        if pending:
+            threading.Thread(target=_reap, args=(results, pending, model), daemon=True).start()
+        return _winner(replica, first, tokens)
+
+    raise error or UpstreamUnavailable(f"no upstream available among {list(urls)}")
+
+
+async def _arelay(replica, first, tokens, release, budget):
+    try:
+        yield first
+        async for token in tokens:
+            if budget is not None:
+                budget.token()
+            yield token
+    except Exception as e:
+        if not _out_of_time(e):
+            replica_table.failed(replica)
+        timeout = deadlines.as_timeout(e, "token")
+        if timeout is e:
+            raise
+        raise timeout from e
+    finally:
+        release()
+        if hasattr(tokens, "aclose"):
+            await tokens.aclose()
+
+
+def _awinner(replica, first, tokens):
+    release = _Release(replica)
+    budget = deadlines.current()
+    if budget is not None:
+        budget.token()
+    relay = _arelay(replica, first, tokens, release, budget)
+    weakref.finalize(relay, release)
+    return relay
+
+
+async def afailover(urls, attempt, prefer=None, model=None):
+    """Async counterpart of failover(); `attempt(url)` is a coroutine function."""
+    delay = hedger.delay(model) if hedger is not None else None
+    if delay is not None:
+        return await _ahedged(urls, attempt, prefer, model, delay)
+
+    tried = []
+    error = None
+    while True:
+        replica = await replica_table.aacquire(urls, tried, prefer, timeout=_queue_timeout())
+        if replica is None:
+            raise error or UpstreamUnavailable(f"no upstream available among {list(urls)}")
+        if tried:
+            replica_table.failovers += 1
+        tried.append(replica.url)
+
+        started = time.monotonic()
+        tokens = None
+        try:
+            tokens = (await attempt(replica.url)).__aiter__()
+            first = await tokens.__anext__()
+        except StopAsyncIteration:
+            error = UpstreamUnavailable(f"{replica.url}: stream ended before the first token")
+        except Exception as e:
+            error = deadlines.as_timeout(e)
+        except BaseException:
+            replica_table.abandoned(replica)
+            raise
+        else:
+            ttft = time.monotonic() - started
+            replica_table.first_token(replica, ttft)
+            if hedger is not None:
+                hedger.record(model, ttft)
+            return _awinner(replica, first, tokens)
+
+        print("UPSTREAM FAILOVER:", replica.url, error)
+        if hasattr(tokens, "aclose"):
+            await tokens.aclose()
+        if not _out_of_time(error):
+            replica_table.failed(replica)
+        replica_table.done(replica)
+        if _final(error):
+            raise error
+
+
+async def _arace(replica, attempt):
+    """Async counterpart of _race(); returns (tokens, first, error, ttft).
+
+    Cancelling it closes the attempt's stream and releases the replica.
+    """
+    started = time.monotonic()
+    tokens = None
+    try:
+        tokens = (await attempt(replica.url)).__aiter__()
+        first = await tokens.__anext__()
+    except StopAsyncIteration:
+        return tokens, None, UpstreamUnavailable(f"{replica.url}: stream ended before the first token"), 0.0
+    except Exception as e:
+        return tokens, None, deadlines.as_timeout(e), 0.0
+    except BaseException:
+        replica_table.abandoned(replica)
+        if hasattr(tokens, "aclose"):
+            await tokens.aclose()
+        raise
+    return tokens, first, None, time.monotonic() - started
+
+
+async def _ahedged(urls, attempt, prefer, model, delay):
+    """Async counterpart of _hedged(); the losing attempt is cancelled outright."""
+    races = {}
+    tried = []
+    error = None
+    hedge = None
+    started = time.monotonic()
+    hedge_at = started + delay
+
+    def launch(replica):
+        tried.append(replica.url)
+        races[asyncio.ensure_future(_arace(replica, attempt))] = replica
+
+    replica = await replica_table.aacquire(urls, prefer=prefer, timeout=_queue_timeout())
+    if replica is None:
+        raise UpstreamUnavailable(f"no upstream available among {list(urls)}")
+    launch(replica)
+
+    winner = None
+    try:
+        while races and winner is None:
+            timeout = max(0.0, hedge_at - time.monotonic()) if hedge_at is not None else None
+            done, _ = await asyncio.wait(races, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                hedge_at = None
+                if hedger.fire(model):
+                    hedge = _hedge_replica(urls, tried)
+                    if hedge is not None:
+                        launch(hedge)
+                continue
+
+            for race in done:
+                replica = races.pop(race)
+                tokens, first, failure, ttft = race.result()
+                if failure is not None:
+                    print("UPSTREAM FAILOVER:", replica.url, failure)
+                    if hasattr(tokens, "aclose"):
+                        await tokens.aclose()
+                    if not _out_of_time(failure):
+                        replica_table.failed(replica)
+                    replica_table.done(replica)
+                    if _final(failure) and winner is None:
+                        raise failure
+                    error = failure
+                elif winner is None:
+                    replica_table.first_token(replica, ttft)
+                    hedger.record(model, time.monotonic() - started)
+                    if replica is hedge:
+                        hedger.won(model)
+                    winner = _awinner(replica, first, tokens)
+                else:
+                    # Both produced a token in the same wakeup
+                    replica_table.first_token(replica, ttft)
+                    replica_table.done(replica)
+                    hedger.cancelled(model)
+                    if hasattr(tokens, "aclose"):
+                        await tokens.aclose()
+
+            if winner is None and not races:
+                nxt = await replica_table.aacquire(urls, tried, timeout=_queue_timeout())
+                if nxt is not None:
+                    replica_table.failovers += 1
+                    launch(nxt)
+    finally:
+        for race, replica in races.items():
+            if not race.done():
+                race.cancel()
+            elif not race.cancelled() and race.exception() is None:
+                # Finished in the wakeup that ended the call but was never looked at
+                tokens, first, failure, ttft = race.result()
+                if hasattr(tokens, "aclose"):
+                    await tokens.aclose()
+                if failure is None:
+                    replica_table.first_token(replica, ttft)
+                elif not _out_of_time(failure):
+                    replica_table.failed(replica)
+                replica_table.done(replica)
+            if winner is not None:
+                hedger.cancelled(model)
+
+    if winner is None:
+        raise error or UpstreamUnavailable(f"no upstream available among {list(urls)}")
+    return winner
@@ -0,0 +1,219 @@
+"""
+Pre-warmed upstream sessions.
+
+Opening an upstream session costs round trips before the first token can
+arrive. A background filler keeps a few ready sessions per key (provider,
+model and whatever else the session depends on) and create() checks one out
+instead of paying the setup inline. Only keys that have been asked for more
+than once recently are filled, so one-off system prompts don't leave warm
+sessions behind.
+
+Only the c4ai provider pools sessions: a warm conversation there saves both
+setup round trips. The Gradio Spaces have nothing to pre-warm, since their
+setup calls carry the prompt and the multiplexer runs every job of a Space
+over one shared session.
+
+    UPSTREAM_SESSION_POOL           "0" disables pre-warming
+    UPSTREAM_SESSION_POOL_SIZE      warm sessions kept per key (2)
+    UPSTREAM_SESSION_POOL_MAX_IDLE  seconds a warm session stays usable (45)
+    UPSTREAM_SESSION_POOL_DEMAND    seconds a key is refilled after its last checkout (300)
+    UPSTREAM_SESSION_POOL_WORKERS   warm-ups run in parallel (4)
+"""
+import os
+import queue
+import threading
+import time
+from collections import deque
+
+
+ENABLED = os.environ.get("UPSTREAM_SESSION_POOL", "1") != "0"
+SIZE = int(os.environ.get("UPSTREAM_SESSION_POOL_SIZE", 2))
+MAX_IDLE = float(os.environ.get("UPSTREAM_SESSION_POOL_MAX_IDLE", 45))
+DEMAND_WINDOW = float(os.environ.get("UPSTREAM_SESSION_POOL_DEMAND", 300))
+WORKERS = int(os.environ.get("UPSTREAM_SESSION_POOL_WORKERS", 4))
+
+# A key is filled once it has been checked out this many times
+MIN_DEMAND = 2
+# Seconds between sweeps, and before retrying a key whose warm-up failed
+SWEEP_INTERVAL = 1.0
+RETRY_DELAY = 5.0
+
+
+class _Slot:
+    """Ready sessions for one key."""
+
+    def __init__(self, label, warm):
+        self.label = label
+        self.warm = warm
+        self.ready = deque()  # (session, warmed_at), newest on the right
+        self.pending = 0
+        self.demand = 0
+        self.last_demand = 0.0
+        self.failed_at = 0.0
+
+
+class _LabelStats:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.warmed = 0
+        self.warm_failures = 0
+        self.checkout_seconds = 0.0
+        self.warm_seconds = 0.0
+
+    def as_dict(self, depth):
+        checkouts = self.hits + self.misses
+        return {
+            "depth": depth,
+            "hits": self.hits,
+            "misses": self.misses,
+            "miss_rate": round(self.misses / checkouts, 4) if checkouts else 0.0,
+            "expired": self.expired,
+            "warmed": self.warmed,
+            "warm_failures": self.warm_failures,
+            "checkout_ms": round(self.checkout_seconds / checkouts * 1000, 3) if checkouts else 0.0,
+            "warm_ms": round(self.warm_seconds / self.warmed * 1000, 1) if self.warmed else 0.0,
+        }
+
+
+class SessionPool:
+    """Background-filled pool of ready upstream sessions."""
+
+    def __init__(self, size=SIZE, max_idle=MAX_IDLE, demand_window=DEMAND_WINDOW, workers=WORKERS):
+        self.size = size
+        self.max_idle = max_idle
+        self.demand_window = demand_window
+        self.workers = workers
+        self._slots = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._jobs = queue.Queue()
+        self._started = False
+
+    def _start(self):
+        if self._started:
+            return
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        threading.Thread(target=self._sweep_loop, name="session-pool", daemon=True).start()
+        for i in range(self.workers):
+            threading.Thread(target=self._worker, name=f"session-pool-{i}", daemon=True).start()
+
+    # -----------------------------------------------------
+    def checkout(self, key, warm, label=None):
+        """A warm session for `key`, or None if the caller has to open one.
+
+        `warm()` opens a session for `key` and is what the filler calls to
+        refill it; it must raise (or return None) if the upstream refused.
+        """
+        started = time.perf_counter()
+        now = time.time()
+        with self._lock:
+            slot = self._slots.get(key)
+            if slot is None:
+                slot = self._slots[key] = _Slot(label or "/".join(map(str, key[:2])), warm)
+            stats = self._stats.setdefault(slot.label, _LabelStats())
+            slot.demand += 1
+            slot.last_demand = now
+
+            session = None
+            while slot.ready:
+                candidate, warmed_at = slot.ready.pop()
+                if now - warmed_at < self.max_idle:
+                    session = candidate
+                    break
+                stats.expired += 1
+
+            if session is None:
+                stats.misses += 1
+            else:
+                stats.hits += 1
+            stats.checkout_seconds += time.perf_counter() - started
+            refill = slot.demand >= MIN_DEMAND
+
+        if refill:
+            self._start()
+            self._wake.set()
+        return session
+
+    # -----------------------------------------------------
+    def _sweep_loop(self):
+        while True:
+            self._wake.wait(SWEEP_INTERVAL)
+            self._wake.clear()
+            self._sweep()
+
+    def _sweep(self):
+        """Drop stale sessions and idle keys, then top up the rest."""
+        now = time.time()
+        with self._lock:
+            for key, slot in list(self._slots.items()):
+                stats = self._stats[slot.label]
+                while slot.ready and now - slot.ready[0][1] >= self.max_idle:
+                    slot.ready.popleft()
+                    stats.expired += 1
+
+                if now - slot.last_demand > self.demand_window:
+                    stats.expired += len(slot.ready)
+                    del self._slots[key]
+                    continue
+                if slot.demand < MIN_DEMAND or now - slot.failed_at < RETRY_DELAY:
+                    continue
+
+                for _ in range(self.size - len(slot.ready) - slot.pending):
+                    slot.pending += 1
+                    self._jobs.put((key, slot))
+
+    def _worker(self):
+        while True:
+            key, slot = self._jobs.get()
+            started = time.perf_counter()
+            try:
+                session = slot.warm()
+            except Exception as e:
+                print("SESSION WARM ERROR:", e)
+                session = None
+            elapsed = time.perf_counter() - started
+
+            with self._lock:
+                stats = self._stats[slot.label]
+                slot.pending -= 1
+                if session is None:
+                    stats.warm_failures += 1
+                    slot.failed_at = time.time()
+                    continue
+                stats.warmed += 1
+                stats.warm_seconds += elapsed
+                if self._slots.get(key) is slot:
+                    slot.ready.append((session, time.time()))
+
+    # -----------------------------------------------------
+    def stats(self):
+        with self._lock:
+            depth = {}
+            for slot in self._slots.values():
+                depth[slot.label] = depth.get(slot.label, 0) + len(slot.ready)
+            return {
+                "enabled": True,
+                "size": self.size,
+                "max_idle": self.max_idle,
+                "keys": len(self._slots),
+                "providers": {
+                    label: stats.as_dict(depth.get(label, 0))
+                    for label, stats in self._stats.items()
+                },
+            }
+
+
+session_pool = SessionPool() if ENABLED else None
+
+
+def checkout(key, warm, label=None):
+    """SessionPool.checkout() on the shared pool; always a miss when disabled."""
+    if session_pool is None:
+        return None
+    return session_pool.checkout(key, warm, label)
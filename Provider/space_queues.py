@@ -0,0 +1,128 @@
+"""
+Live queue model of each upstream Gradio Space.
+
+Gradio sends `estimation` messages while a job waits in a Space's queue:
+its `rank`, the whole `queue_size`, and `rank_eta`, the seconds until the
+job starts. They are recorded per Space as an EWMA of seconds per queue
+position plus the last queue size seen. Between messages the queue is
+assumed to drain at that rate, and an observation older than
+QUEUE_ESTIMATE_TTL is forgotten.
+
+The predicted wait feeds replica selection (Provider/replicas.py) and
+admission: a call whose predicted wait on the best replica exceeds its
+deadline is refused up front rather than left waiting on a queue it cannot
+clear in time.
+
+    QUEUE_ESTIMATES     "0" ignores estimation messages
+    QUEUE_ESTIMATE_TTL  seconds an observation stays valid (60)
+"""
+import math
+import os
+import threading
+import time
+
+
+ENABLED = os.environ.get("QUEUE_ESTIMATES", "1") != "0"
+ESTIMATE_TTL = float(os.environ.get("QUEUE_ESTIMATE_TTL", 60))
+
+# Weight of the newest seconds-per-position sample
+ALPHA = 0.3
+
+
+class SpaceQueue:
+    """Queue depth and drain rate of one Space."""
+
+    def __init__(self):
+        self.queue_size = 0
+        self.per_position = None  # EWMA seconds each queue position takes
+        self.observed_at = 0.0
+        self.estimations = 0
+
+    def observe(self, event, now):
+        rank = event.get("rank")
+        queue_size = event.get("queue_size")
+        rank_eta = event.get("rank_eta")
+        if queue_size is not None:
+            self.queue_size = queue_size
+        if rank is not None and rank_eta is not None and rank_eta >= 0:
+            sample = rank_eta / (rank + 1)
+            self.per_position = sample if self.per_position is None else self.per_position + ALPHA * (sample - self.per_position)
+        self.observed_at = now
+        self.estimations += 1
+
+    def depth(self, now):
+        """Queue size now, assuming it drained since the last observation."""
+        elapsed = now - self.observed_at
+        if elapsed > ESTIMATE_TTL:
+            return 0.0
+        if not self.per_position:
+            return float(self.queue_size)
+        return max(0.0, self.queue_size - elapsed / self.per_position)
+
+    def wait(self, now):
+        """Predicted seconds before a job joined now would start."""
+        if not self.per_position:
+            return 0.0
+        return self.depth(now) * self.per_position
+
+    def as_dict(self, now):
+        return {
+            "queue_size": self.queue_size,
+            "depth": round(self.depth(now), 2),
+            "per_position_s": round(self.per_position, 3) if self.per_position is not None else None,
+            "predicted_wait_s": round(self.wait(now), 2),
+            "age_s": round(now - self.observed_at, 1) if self.observed_at else None,
+            "estimations": self.estimations,
+        }
+
+
+class SpaceQueues:
+    """Queue models of every Space in the process, keyed by base URL."""
+
+    def __init__(self):
+        self._spaces = {}
+        self._lock = threading.Lock()
+        self.refused = 0
+
+    def observe(self, base, event):
+        """Record an `estimation` message from the Space at `base`."""
+        with self._lock:
+            space = self._spaces.get(base)
+            if space is None:
+                space = self._spaces[base] = SpaceQueue()
+            space.observe(event, time.monotonic())
+
+    def wait(self, base):
+        with self._lock:
+            space = self._spaces.get(base)
+            return space.wait(time.monotonic()) if space is not None else 0.0
+
+    def retry_after(self, urls, deadline):
+        """Seconds to back off if no replica of `urls` can start within `deadline`, else None."""
+        best = min((self.wait(url) for url in urls), default=0.0)
+        if best <= deadline:
+            return None
+        with self._lock:
+            self.refused += 1
+        return max(1, math.ceil(best - deadline))
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            return {
+                "enabled": True,
+                "refused": self.refused,
+                "spaces": {base: space.as_dict(now) for base, space in self._spaces.items()},
+            }
+
+
+space_queues = SpaceQueues() if ENABLED else None
+
+
+def observe(base, event):
+    """Record `event` if it is an estimation; returns True if it was one."""
+    if event.get("msg") != "estimation":
+        return False
+    if space_queues is not None:
+        space_queues.observe(base, event)
+    return True
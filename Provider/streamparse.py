@@ -0,0 +1,151 @@
+"""
+Incremental parsers for upstream token streams.
+
+The parsers take raw byte chunks straight off the socket and split lines
+themselves, so no str is built for lines that are thrown away. Every line is
+checked for its message type with a byte regex first, and only the lines that
+carry something wanted are JSON-decoded: Gradio heartbeats, `process_starts`
+messages, `estimation` messages unless asked for, and Cohere's status lines
+are skipped undecoded.
+
+orjson is used for decoding when it is installed, the stdlib json otherwise.
+"""
+import json
+import re
+
+try:
+    import orjson
+    loads = orjson.loads
+    JSON_BACKEND = "orjson"
+except ImportError:
+    loads = json.loads
+    JSON_BACKEND = "json"
+
+
+# Gradio queue/data messages that carry output or end an event
+GENERATING = b"process_generating"
+COMPLETED = b"process_completed"
+TOKEN_MESSAGES = frozenset({GENERATING, COMPLETED, b"unexpected_error"})
+# ...plus the queue position updates recorded by Provider/space_queues.py
+ESTIMATION = b"estimation"
+QUEUE_MESSAGES = TOKEN_MESSAGES | {ESTIMATION}
+
+_MSG = re.compile(rb'"msg"\s*:\s*"([a-z_]+)"')
+_STREAM_TYPE = re.compile(rb'"type"\s*:\s*"stream"')
+
+
+class _LineSplitter:
+    def __init__(self):
+        self._tail = b""
+        self.decoded = 0
+        self.skipped = 0
+
+    def feed(self, chunk):
+        """Parsed items from the lines completed by `chunk`."""
+        if self._tail:
+            chunk = self._tail + chunk
+        lines = chunk.split(b"\n")
+        self._tail = lines.pop()
+        return self._parse(lines)
+
+    def flush(self):
+        """Parsed items from a last line the stream did not terminate."""
+        tail, self._tail = self._tail, b""
+        return self._parse([tail]) if tail.strip() else []
+
+
+class GradioEvents(_LineSplitter):
+    """Gradio SSE bytes -> message dicts, decoding only the wanted `msg` types."""
+
+    def __init__(self, wanted=TOKEN_MESSAGES):
+        super().__init__()
+        self.wanted = frozenset(wanted)
+
+    def _parse(self, lines):
+        events = []
+        for line in lines:
+            if not line.startswith(b"data:"):
+                continue
+            match = _MSG.search(line)
+            if match is None or match.group(1) not in self.wanted:
+                self.skipped += 1
+                continue
+            try:
+                event = loads(line[5:])
+            except ValueError:
+                continue
+            self.decoded += 1
+            events.append(event)
+        return events
+
+
+class CohereTokens(_LineSplitter):
+    """Cohere chat NDJSON bytes -> token strings from `"type": "stream"` lines."""
+
+    def _parse(self, lines):
+        tokens = []
+        for line in lines:
+            if _STREAM_TYPE.search(line) is None:
+                self.skipped += 1
+                continue
+            try:
+                token = loads(line)["token"]
+            except (ValueError, KeyError, TypeError):
+                continue
+            self.decoded += 1
+            tokens.append(token.replace("\x00", ""))
+        return tokens
+
+
+def append_tokens(event, index, path=None):
+    """Text of the `append` diff ops in output.data[index] of a generating message.
+
+    `path`, if given, keeps only ops that append at that component path.
+    """
+    if event.get("msg") != "process_generating":
+        return ()
+    try:
+        ops = event["output"]["data"][index]
+    except (KeyError, IndexError, TypeError):
+        return ()
+    if not ops:
+        return ()
+    return [
+        op[2] for op in ops
+        if len(op) == 3 and op[0] == "append" and isinstance(op[2], str)
+        and (path is None or op[1] == path)
+    ]
+
+
+def gradio_events(byte_chunks, wanted=TOKEN_MESSAGES):
+    """Message dicts from an iterator of SSE byte chunks."""
+    parser = GradioEvents(wanted)
+    for chunk in byte_chunks:
+        yield from parser.feed(chunk)
+    yield from parser.flush()
+
+
+async def agradio_events(byte_chunks, wanted=TOKEN_MESSAGES):
+    parser = GradioEvents(wanted)
+    async for chunk in byte_chunks:
+        for event in parser.feed(chunk):
+            yield event
+    for event in parser.flush():
+        yield event
+
+
+def cohere_tokens(byte_chunks):
+    """Tokens from an iterator of Cohere NDJSON byte chunks."""
+    parser = CohereTokens()
+    for chunk in byte_chunks:
+        yield from parser.feed(chunk)
+    yield from parser.flush()
+
+
+async def acohere_tokens(byte_chunks):
+    parser = CohereTokens()
+    async for chunk in byte_chunks:
+        for token in parser.feed(chunk):
+            yield token
+    for token in parser.flush():
+        yield token
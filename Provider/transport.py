@@ -0,0 +1,216 @@
+"""
+Process-wide pooled HTTP transport shared by every provider.
+
+One keep-alive pool per upstream origin (scheme://host:port), for both the
+blocking client used by `create()` and the async client used by `acreate()`.
+HTTP/2 is negotiated through ALPN when the `h2` package is installed, and
+falls back to HTTP/1.1 for hosts that don't offer it.
+
+Pool sizes come from the environment and can be overridden per host:
+
+    UPSTREAM_POOL_MAX_CONNECTIONS   max open connections per host (100)
+    UPSTREAM_POOL_MAX_KEEPALIVE     idle connections kept per host (20)
+    UPSTREAM_POOL_KEEPALIVE_EXPIRY  seconds an idle connection is kept (60)
+    UPSTREAM_HTTP2                  "0" disables HTTP/2
+
+The pools never persist cookies: a shared jar would leak one caller's upstream
+session into another's. Providers that need cookies carry them per call.
+
+Requests that don't pass their own timeout get deadlines.DEFAULT_TIMEOUT
+(UPSTREAM_CONNECT_TIMEOUT to connect, UPSTREAM_TOKEN_TIMEOUT per read), so
+no upstream call can hang a worker forever.
+"""
+import asyncio
+import http.cookiejar
+import os
+import threading
+import weakref
+from urllib.parse import urlsplit
+
+import httpx
+
+try:
+    from deadlines import DEFAULT_TIMEOUT
+except ImportError:
+    from .deadlines import DEFAULT_TIMEOUT
+
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+MAX_CONNECTIONS = int(os.environ.get("UPSTREAM_POOL_MAX_CONNECTIONS", 100))
+MAX_KEEPALIVE = int(os.environ.get("UPSTREAM_POOL_MAX_KEEPALIVE", 20))
+KEEPALIVE_EXPIRY = float(os.environ.get("UPSTREAM_POOL_KEEPALIVE_EXPIRY", 60))
+HTTP2 = os.environ.get("UPSTREAM_HTTP2", "1") != "0"
+
+
+def origin_of(url: str) -> str:
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+def _no_cookies():
+    return http.cookiejar.CookieJar(
+        policy=http.cookiejar.DefaultCookiePolicy(allowed_domains=[])
+    )
+
+
+class _HostStats:
+    """Request and connection-reuse counters for one origin."""
+
+    def __init__(self):
+        self.requests = 0
+        self.connections = 0
+        self.reused = 0
+        self.http_versions = {}
+        self._seen = weakref.WeakSet()
+        self._lock = threading.Lock()
+
+    def record(self, response):
+        stream = response.extensions.get("network_stream")
+        with self._lock:
+            self.requests += 1
+            self.http_versions[response.http_version] = self.http_versions.get(response.http_version, 0) + 1
+
+            if stream is None:
+                return
+            if stream in self._seen:
+                self.reused += 1
+            else:
+                self._seen.add(stream)
+                self.connections += 1
+
+    def as_dict(self):
+        return {
+            "requests": self.requests,
+            "connections_opened": self.connections,
+            "connections_reused": self.reused,
+            "reuse_ratio": round(self.reused / self.requests, 4) if self.requests else 0.0,
+            "http_versions": dict(self.http_versions),
+        }
+
+
+class Transport:
+    """Lazily built per-origin httpx clients plus their reuse counters."""
+
+    def __init__(
+            self,
+            max_connections: int = MAX_CONNECTIONS,
+            max_keepalive: int = MAX_KEEPALIVE,
+            keepalive_expiry: float = KEEPALIVE_EXPIRY,
+            http2: bool = HTTP2
+            ):
+        self.defaults = {
+            "max_connections": max_connections,
+            "max_keepalive": max_keepalive,
+            "keepalive_expiry": keepalive_expiry,
+        }
+        self.http2 = http2 and HTTP2_AVAILABLE
+        self._host_limits = {}
+        self._clients = {}
+        self._aclients = weakref.WeakKeyDictionary()
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    # -----------------------------------------------------
+    def configure_host(self, url: str, **limits):
+        """Override pool limits for one origin. Applies to clients built afterwards."""
+        unknown = set(limits) - set(self.defaults)
+        if unknown:
+            raise ValueError(f"Unknown pool setting(s): {', '.join(sorted(unknown))}")
+        self._host_limits.setdefault(origin_of(url), {}).update(limits)
+
+    def _limits(self, origin):
+        conf = {**self.defaults, **self._host_limits.get(origin, {})}
+        return httpx.Limits(
+            max_connections=conf["max_connections"],
+            max_keepalive_connections=conf["max_keepalive"],
+            keepalive_expiry=conf["keepalive_expiry"],
+        )
+
+    def _stats_for(self, origin):
+        with self._lock:
+            stats = self._stats.get(origin)
+            if stats is None:
+                stats = self._stats[origin] = _HostStats()
+            return stats
+
+    # -----------------------------------------------------
+    def client(self, url: str) -> httpx.Client:
+        """Blocking pooled client for the origin of `url`."""
+        origin = origin_of(url)
+        client = self._clients.get(origin)
+        if client is not None:
+            return client
+
+        with self._lock:
+            client = self._clients.get(origin)
+            if client is None:
+                stats = self._stats.setdefault(origin, _HostStats())
+                client = httpx.Client(
+                    http2=self.http2,
+                    limits=self._limits(origin),
+                    timeout=DEFAULT_TIMEOUT,
+                    cookies=_no_cookies(),
+                    event_hooks={"response": [stats.record]},
+                )
+                self._clients[origin] = client
+            return client
+
+    def aclient(self, url: str) -> httpx.AsyncClient:
+        """Async pooled client for the origin of `url`, bound to the running loop."""
+        origin = origin_of(url)
+        loop = asyncio.get_running_loop()
+        clients = self._aclients.get(loop)
+        if clients is None:
+            clients = self._aclients[loop] = {}
+
+        client = clients.get(origin)
+        if client is None:
+            stats = self._stats_for(origin)
+
+            async def record(response):
+                stats.record(response)
+
+            client = httpx.AsyncClient(
+                http2=self.http2,
+                limits=self._limits(origin),
+                timeout=DEFAULT_TIMEOUT,
+                cookies=_no_cookies(),
+                event_hooks={"response": [record]},
+            )
+            clients[origin] = client
+        return client
+
+    # -----------------------------------------------------
+    def stats(self) -> dict:
+        with self._lock:
+            hosts = {origin: s.as_dict() for origin, s in self._stats.items()}
+
+        total = sum(h["requests"] for h in hosts.values())
+        reused = sum(h["connections_reused"] for h in hosts.values())
+        return {
+            "http2": self.http2,
+            "pool": dict(self.defaults),
+            "requests": total,
+            "connections_reused": reused,
+            "reuse_ratio": round(reused / total, 4) if total else 0.0,
+            "hosts": hosts,
+        }
+
+    def close(self):
+        with self._lock:
+            clients, self._clients = self._clients, {}
+        for client in clients.values():
+            client.close()
+
+    async def aclose(self):
+        clients = self._aclients.pop(asyncio.get_running_loop(), {})
+        for client in clients.values():
+            await client.aclose()
+
+
+transport = Transport()
@@ -0,0 +1,454 @@
+"""
+Asyncio serving mode.
+
+Same routes as app.py, served from an ASGI app (Quart) on top of the
+providers' `acreate()`. Streams are async generators over a non-blocking
+HTTP client, so an idle SSE stream costs a coroutine instead of a thread:
+
+    hypercorn asgi:app --bind 0.0.0.0:7860
+    uvicorn asgi:app --host 0.0.0.0 --port 7860
+"""
+from Provider import *
+from Provider.transport import transport
+from Provider.affinity import conversation_affinity
+from Provider.session_pool import session_pool
+from Provider import gradio_mux
+from Provider.replicas import replica_table, UpstreamSaturated
+from Provider.hedging import hedger
+from Provider.space_queues import space_queues
+from Provider import metrics
+from Provider import context_window
+from Provider import deadlines
+from gateway import *
+from quart import Quart, request, jsonify, Response, send_file
+from functools import wraps
+import asyncio
+import time
+
+app = Quart(__name__)
+context_window.use_tokenizers(tokenizer_for)
+key_store.start()
+usage_ledger = open_ledger()
+single_flight = AsyncSingleFlight() if SINGLE_FLIGHT else None
+
+# =======================
+# AUTH DECORATOR
+# =======================
+def require_api_key(f):
+    @wraps(f)
+    async def decorated(*args, **kwargs):
+        key_data, error = authenticate(request.headers.get("Authorization", ""))
+
+        if error:
+            return jsonify(auth_error(error)), 401
+
+        request.api_user = key_data["user"]
+        request.api_key_id = key_data.get("key_id")
+        request.api_admin = is_admin(key_data)
+        return await f(*args, **kwargs)
+    return decorated
+
+def require_admin(f):
+    @wraps(f)
+    async def decorated(*args, **kwargs):
+        if not request.api_admin:
+            return jsonify(auth_error("This endpoint needs an admin API key")), 403
+        return await f(*args, **kwargs)
+    return decorated
+
+# =======================
+# MODELS ENDPOINT
+# =======================
+@app.route("/models", methods=["GET"])
+async def get_models():
+    body, etag = models_payload()
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=60"}
+
+    if etag in request.headers.get("If-None-Match", ""):
+        return Response(status=304, headers=headers)
+    return Response(body, mimetype="application/json", headers=headers)
+
+# =======================
+# CHAT COMPLETIONS
+# =======================
+@app.route("/v1/chat/completions", methods=["POST"])
+@require_api_key
+async def chat_completions():
+    started = time.perf_counter()
+    data = await request.get_json(silent=True) or {}
+
+    model_name = data.get("model")
+    messages = data.get("messages", [])
+    stream = data.get("stream", False)
+    max_tokens = data.get("max_tokens", 2048)
+    include_usage = bool((data.get("stream_options") or {}).get("include_usage"))
+
+    if not model_name:
+        return jsonify({"error": "Model is required"}), 400
+    try:
+        stop = stop_sequences(data.get("stop"))
+        n = choice_count(data.get("n"))
+        timeout = request_timeout(request.headers, data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        provider = make_workable(model_name)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 400
+    labels = (type(provider).__name__, model_name, request.api_user)
+    budget = deadlines.Budget(timeout)
+    meter = usage_meter(provider, messages)
+    completion = Completion(meter, max_tokens, stop)
+    # n > 1: independent samples, each its own upstream job
+    choices = Choices([meter] + [usage_meter(provider, messages) for _ in range(n - 1)], max_tokens, stop) if n > 1 else None
+
+    # =======================
+    # RATE LIMITS
+    # =======================
+    reserve = max_tokens * n if isinstance(max_tokens, int) else max_tokens
+    admission, rejection = admit(request.api_user, choices or meter, reserve)
+    if rejection is not None:
+        return jsonify(rate_limit_error(rejection)), 429, {"Retry-After": str(rejection.retry_after)}
+
+    # =======================
+    # COMPLETION CACHE
+    # =======================
+    cache_status = "BYPASS"
+    cached = None
+    lookup, store = cache_policy(request.headers.get("Cache-Control", ""))
+    key = cache_key(model_name, messages, max_tokens)
+
+    if completion_cache is not None and choices is None:
+        if lookup:
+            cached = completion_cache.get(key, model_name)
+            cache_status = "HIT" if cached is not None else "MISS"
+        else:
+            completion_cache.bypass(model_name)
+
+    # =======================
+    # QUEUE ADMISSION
+    # =======================
+    if cached is None and space_queues is not None:
+        retry_after = space_queues.retry_after(getattr(provider, "endpoints", ()), request_deadline(request.headers, data))
+        if retry_after is not None:
+            admission.release()
+            return jsonify(overloaded_error(retry_after)), 503, {"Retry-After": str(retry_after)}
+
+    # Upstream slots are shared across keys and handed out in weighted-fair order
+    if cached is None and not await admission.aacquire_slot(budget.remaining(), slots=n):
+        admission.release()
+        rejection = slot_timeout_rejection()
+        return jsonify(rate_limit_error(rejection)), 429, {"Retry-After": str(rejection.retry_after)}
+
+    on_complete = None
+    if completion_cache is not None and store and choices is None:
+        on_complete = lambda seen: completion_cache.put(key, model_name, seen)
+
+    # Always pull the token stream so the cache keeps chunk boundaries
+    async def start():
+        return await provider.acreate(
+            message=messages,
+            model=model_name,
+            stream=True,
+            max_tokens=max_tokens
+        )
+
+    if cached is not None:
+        tokens = aiter_tokens(cached)
+    else:
+        # Identical requests already in flight share one upstream job
+        coalesce = single_flight is not None and lookup and choices is None
+        try:
+            with deadlines.within(budget):
+                if coalesce:
+                    tokens = await single_flight.join(key, start, on_complete, budget)
+                else:
+                    tokens = await start() if choices is None else await choices.astart(start)
+        except TimeoutError as e:
+            admission.release()
+            metrics.record_failure(labels, e)
+            return jsonify(timeout_error(str(e))), 504
+        except UpstreamSaturated as e:
+            admission.release()
+            metrics.record_failure(labels, e)
+            body = overloaded_error(e.retry_after, "Every upstream replica is at its concurrency limit")
+            return jsonify(body), 503, {"Retry-After": str(e.retry_after)}
+        except Exception as e:
+            admission.release()
+            metrics.record_failure(labels, e)
+            raise
+        if on_complete is not None and not coalesce:
+            tokens = arecord_stream(tokens, on_complete)
+    if choices is None:
+        tokens = completion.alimit(tokens)
+    tokens = metrics.aobserve_stream(admission.aguard(tokens), labels, started, choices or meter)
+    if usage_ledger is not None:
+        tokens = usage_ledger.atrack(tokens, request.api_key_id, request.api_user, model_name,
+                                     (choices or meter).usage, started)
+
+    # =======================
+    # STREAM RESPONSE (SSE)
+    # =======================
+    if stream:
+        if choices is None:
+            events = asse_stream(tokens, model_name, usage=meter.usage if include_usage else None,
+                                 finish_reason=lambda: completion.finish_reason)
+        else:
+            events = asse_choices(tokens, model_name, n, usage=choices.usage if include_usage else None,
+                                  finish_reason=choices.finish_reason)
+        sse = Response(
+            events,
+            mimetype="text/event-stream",
+            headers={
+                "Cache-Control": "no-cache",
+                "X-Accel-Buffering": "no",
+                "X-Cache": cache_status,
+                **admission.headers()
+            }
+        )
+        # Long generations must not be cut off by Quart's response timeout
+        sse.timeout = None
+        return sse
+
+    # =======================
+    # NON-STREAM RESPONSE
+    # =======================
+    try:
+        if choices is None:
+            assistant_text = "".join([token async for token in tokens])
+        else:
+            texts = [[] for _ in range(n)]
+            async for index, token in tokens:
+                texts[index].append(token)
+    except TimeoutError as e:
+        return jsonify(timeout_error(str(e))), 504
+    except UpstreamSaturated as e:
+        return jsonify(upstream_error(e)), 503, {"Retry-After": str(e.retry_after)}
+    except Exception as e:
+        return jsonify(upstream_error(e)), 502
+
+    if choices is None:
+        body = jsonify(completion_body(model_name, assistant_text, meter.usage(), completion.finish_reason))
+    else:
+        replies = [("".join(text), choices.finish_reason(index)) for index, text in enumerate(texts)]
+        body = jsonify(choices_body(model_name, replies, choices.usage()))
+    body.headers["X-Cache"] = cache_status
+    body.headers.update(admission.headers())
+    return body
+
+# =======================
+# FILES & BATCHES
+# =======================
+# Batch lines run on worker threads through the providers' blocking create()
+batch_runner = open_batches(make_workable, usage_ledger)
+
+def batch_api(f):
+    @wraps(f)
+    async def decorated(*args, **kwargs):
+        if batch_runner is None:
+            return jsonify(batch_error("The batch API is disabled")), 404
+        try:
+            return await f(*args, **kwargs)
+        except NotFound as e:
+            return jsonify(batch_error(str(e), "not_found")), 404
+        except ValueError as e:
+            return jsonify(batch_error(str(e))), 400
+    return decorated
+
+@app.route("/v1/files", methods=["POST"])
+@require_api_key
+@batch_api
+async def upload_file():
+    upload = (await request.files).get("file")
+    if upload is None:
+        raise ValueError("'file' is required")
+    purpose = (await request.form).get("purpose")
+    # Spooling the upload to disk blocks; keep it off the event loop
+    stored = await asyncio.to_thread(batch_runner.upload, request.api_user, upload.stream, upload.filename, purpose)
+    return jsonify(stored)
+
+@app.route("/v1/files", methods=["GET"])
+@require_api_key
+@batch_api
+async def list_files():
+    return jsonify(batch_runner.list_files(request.api_user, request.args.get("purpose")))
+
+@app.route("/v1/files/<file_id>", methods=["GET"])
+@require_api_key
+@batch_api
+async def get_file(file_id):
+    return jsonify(batch_runner.file(file_id, request.api_user))
+
+@app.route("/v1/files/<file_id>", methods=["DELETE"])
+@require_api_key
+@batch_api
+async def delete_file(file_id):
+    return jsonify(batch_runner.delete_file(file_id, request.api_user))
+
+@app.route("/v1/files/<file_id>/content", methods=["GET"])
+@require_api_key
+@batch_api
+async def file_content(file_id):
+    return await send_file(batch_runner.file_path(file_id, request.api_user), mimetype="application/jsonl")
+
+@app.route("/v1/batches", methods=["POST"])
+@require_api_key
+@batch_api
+async def create_batch():
+    data = await request.get_json(silent=True) or {}
+    return jsonify(batch_runner.create(
+        request.api_user,
+        data.get("input_file_id"),
+        data.get("endpoint"),
+        data.get("completion_window", "24h"),
+        data.get("metadata"),
+        request.api_key_id
+    ))
+
+@app.route("/v1/batches", methods=["GET"])
+@require_api_key
+@batch_api
+async def list_batches():
+    limit = request.args.get("limit", 20, type=int)
+    return jsonify(batch_runner.list(request.api_user, max(1, min(limit, 100)), request.args.get("after")))
+
+@app.route("/v1/batches/<batch_id>", methods=["GET"])
+@require_api_key
+@batch_api
+async def get_batch(batch_id):
+    return jsonify(batch_runner.get(batch_id, request.api_user))
+
+@app.route("/v1/batches/<batch_id>/cancel", methods=["POST"])
+@require_api_key
+@batch_api
+async def cancel_batch(batch_id):
+    return jsonify(batch_runner.cancel(batch_id, request.api_user))
+
+# =======================
+# METRICS
+# =======================
+@app.route("/metrics", methods=["GET"])
+async def prometheus_metrics():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+# =======================
+# STATS
+# =======================
+@app.route("/stats/transport", methods=["GET"])
+async def transport_stats():
+    return jsonify(transport.stats())
+
+@app.route("/stats/singleflight", methods=["GET"])
+async def single_flight_stats():
+    return jsonify(single_flight.stats() if single_flight else {"enabled": False})
+
+@app.route("/stats/cache", methods=["GET"])
+async def cache_stats():
+    return jsonify(completion_cache.stats() if completion_cache else {"enabled": False})
+
+@app.route("/stats/affinity", methods=["GET"])
+async def affinity_stats():
+    return jsonify(conversation_affinity.stats() if conversation_affinity else {"enabled": False})
+
+@app.route("/stats/sessions", methods=["GET"])
+async def session_pool_stats():
+    return jsonify(session_pool.stats() if session_pool else {"enabled": False})
+
+@app.route("/stats/gradio", methods=["GET"])
+async def gradio_stats():
+    return jsonify(gradio_mux.stats() if gradio_mux.ENABLED else {"enabled": False})
+
+@app.route("/stats/replicas", methods=["GET"])
+async def replica_stats():
+    return jsonify(replica_table.stats())
+
+@app.route("/stats/hedging", methods=["GET"])
+async def hedging_stats():
+    return jsonify(hedger.stats() if hedger else {"enabled": False})
+
+@app.route("/stats/queues", methods=["GET"])
+async def queue_stats():
+    return jsonify(space_queues.stats() if space_queues else {"enabled": False})
+
+@app.route("/stats/limits", methods=["GET"])
+@require_api_key
+@require_admin
+async def limit_stats():
+    return jsonify({
+        "keys": rate_limiter.stats() if rate_limiter else {"enabled": False},
+        "upstream_slots": fair_scheduler.stats() if fair_scheduler else {"enabled": False}
+    })
+
+@app.route("/stats/tokens", methods=["GET"])
+async def token_accounting_stats():
+    return jsonify(token_stats())
+
+@app.route("/stats/context", methods=["GET"])
+async def context_stats():
+    return jsonify(context_window.stats())
+
+@app.route("/stats/keys", methods=["GET"])
+@require_api_key
+@require_admin
+async def key_store_stats():
+    return jsonify(key_store.stats())
+
+@app.route("/stats/usage", methods=["GET"])
+@require_api_key
+@require_admin
+async def usage_stats():
+    if usage_ledger is None:
+        return jsonify({"enabled": False})
+    since = request.args.get("since", type=float)
+    totals = await asyncio.to_thread(usage_ledger.totals, since)
+    return jsonify({"ledger": usage_ledger.stats(), "keys": totals})
+
+@app.route("/stats/batches", methods=["GET"])
+@require_api_key
+@require_admin
+async def batch_stats():
+    return jsonify(batch_runner.stats() if batch_runner else {"enabled": False})
+
+# =======================
+# HEALTH CHECK
+# =======================
+@app.route("/")
+async def home():
+    return "Server is alive"
+
+# =======================
+# HF KEEP ALIVE
+# =======================
+SERVERS = ["https://techbitforge-m.hf.space/"]
+PING_INTERVAL = 60
+HEADERS = {"User-Agent": "HF-KeepAlive"}
+
+async def background_worker():
+    while True:
+        print("🔄 Pinging servers...")
+        for url in SERVERS:
+            try:
+                r = await transport.aclient(url).get(url, headers=HEADERS, timeout=10)
+                print(f"{url} → {r.status_code}")
+            except Exception as e:
+                print(f"{url} → ERROR: {e}")
+        print("✅ Cycle complete\n")
+        await asyncio.sleep(PING_INTERVAL)
+
+
+@app.before_serving
+async def start_background_worker():
+    app.keep_alive_task = asyncio.create_task(background_worker())
+
+
+@app.after_serving
+async def stop_background_worker():
+    app.keep_alive_task.cancel()
+    await transport.aclose()
+
+# =======================
+# MAIN
+# =======================
+if __name__ == "__main__":
+    app.run(host="0.0.0.0", port=7860)
@@ -0,0 +1,69 @@
+from .auth import VALID_API_KEYS, key_store, verify_api_key, authenticate, is_admin, auth_error
+from .keys import KeyStore, hash_key
+from .ledger import UsageLedger, open_ledger
+from .responses import new_completion_id, completion_chunk, completion_body, choices_body, aiter_tokens
+from .sse import ChunkEncoder, sse_stream, asse_stream, sse_choices, asse_choices
+from .cache import completion_cache, cache_key, cache_policy, record_stream, arecord_stream
+from .singleflight import SingleFlight, AsyncSingleFlight, ENABLED as SINGLE_FLIGHT
+from .admission import request_deadline, request_timeout, overloaded_error, timeout_error, upstream_error
+from .limits import rate_limiter, fair_scheduler, admit, rate_limit_error, slot_timeout_rejection
+from .stopping import Completion, stop_sequences
+from .tokens import UsageMeter, usage_meter, register_tokenizer, tokenizer_for, stats as token_stats
+from .choices import Choices, choice_count
+from .batches import BatchRunner, open_batches, NotFound, batch_error, ENABLED as BATCHES
+
+
+__all__ = [
+    "VALID_API_KEYS",
+    "key_store",
+    "KeyStore",
+    "hash_key",
+    "UsageLedger",
+    "open_ledger",
+    "verify_api_key",
+    "authenticate",
+    "is_admin",
+    "auth_error",
+    "new_completion_id",
+    "completion_chunk",
+    "completion_body",
+    "choices_body",
+    "ChunkEncoder",
+    "sse_stream",
+    "asse_stream",
+    "sse_choices",
+    "asse_choices",
+    "aiter_tokens",
+    "completion_cache",
+    "cache_key",
+    "cache_policy",
+    "record_stream",
+    "arecord_stream",
+    "SingleFlight",
+    "AsyncSingleFlight",
+    "SINGLE_FLIGHT",
+    "request_deadline",
+    "request_timeout",
+    "overloaded_error",
+    "timeout_error",
+    "upstream_error",
+    "rate_limiter",
+    "fair_scheduler",
+    "admit",
+    "rate_limit_error",
+    "slot_timeout_rejection",
+    "UsageMeter",
+    "usage_meter",
+    "register_tokenizer",
+    "tokenizer_for",
+    "Completion",
+    "stop_sequences",
+    "Choices",
+    "choice_count",
+    "BatchRunner",
+    "open_batches",
+    "NotFound",
+    "batch_error",
+    "BATCHES",
+    "token_stats"
+]
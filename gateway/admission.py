@@ -0,0 +1,94 @@
+"""
+Request deadlines and admission refusals.
+
+A request's deadline is how long its client is prepared to wait, in seconds:
+the `X-Request-Timeout` header, else `X-Stainless-Timeout` (sent by the OpenAI
+SDKs with their configured timeout), else the `timeout` body parameter, else
+ADMISSION_DEADLINE. Calls predicted to wait longer than that in an upstream
+queue are refused with 503 and a `Retry-After` instead of being queued.
+
+The same client timeout, or REQUEST_TIMEOUT when there is none, is the hard
+budget of the request. A client may ask for less than REQUEST_TIMEOUT but not
+more, and a timeout that is not a positive number is refused with 400. Once
+the budget runs out the upstream call is closed and the
+client gets a `timeout` error, 504 before the stream starts and an error
+event in it after. Other upstream failures that surface once the response is
+under way get an upstream_error() body the same way.
+
+    ADMISSION_DEADLINE  seconds assumed for admission when a request names no timeout (60)
+    REQUEST_TIMEOUT     seconds a request may run when it names no timeout (600)
+"""
+import os
+
+
+ADMISSION_DEADLINE = float(os.environ.get("ADMISSION_DEADLINE", 60))
+REQUEST_TIMEOUT = float(os.environ.get("REQUEST_TIMEOUT", 600))
+
+DEADLINE_HEADERS = ("X-Request-Timeout", "X-Stainless-Timeout")
+
+
+def client_timeout(headers, body=None):
+    """Seconds the client said it will wait, capped at REQUEST_TIMEOUT; None if it named none.
+
+    Raises ValueError if the timeout it named is not a positive number.
+    """
+    values = [headers.get(name) for name in DEADLINE_HEADERS]
+    if isinstance(body, dict):
+        values.append(body.get("timeout"))
+    for value in values:
+        if value is None or value == "":
+            continue
+        try:
+            seconds = float(value)
+        except (TypeError, ValueError):
+            seconds = None
+        if isinstance(value, bool) or seconds is None or not seconds > 0:
+            raise ValueError(f"Request timeout must be a positive number of seconds, got {value!r}")
+        return min(seconds, REQUEST_TIMEOUT)
+    return None
+
+
+def request_deadline(headers, body=None):
+    """Seconds the client will wait for this request."""
+    return client_timeout(headers, body) or ADMISSION_DEADLINE
+
+
+def request_timeout(headers, body=None):
+    """Seconds this request may run before it is cut off."""
+    return client_timeout(headers, body) or REQUEST_TIMEOUT
+
+
+def overloaded_error(retry_after, reason="Upstream queue is too long to start within the request deadline"):
+    return {
+        "error": {
+            "message": f"{reason}; retry after {retry_after}s",
+            "type": "server_error",
+            "code": "upstream_overloaded"
+        }
+    }
+
+
+def timeout_error(message="Request deadline exceeded"):
+    return {
+        "error": {
+            "message": message,
+            "type": "timeout",
+            "code": "request_timeout"
+        }
+    }
+
+
+def upstream_error(error):
+    """Error body for an upstream call that failed while its tokens were being read."""
+    if isinstance(error, TimeoutError):
+        return timeout_error(str(error))
+    retry_after = getattr(error, "retry_after", None)
+    if retry_after is not None:
+        return overloaded_error(retry_after, "Every upstream replica is at its concurrency limit")
+    return {
+        "error": {
+            "message": f"Upstream error: {error}" if str(error) else "Upstream error",
+            "type": "server_error",
+            "code": "upstream_error"
+        }
+    }
@@ -0,0 +1,49 @@
+import os
+
+from .keys import KeyStore, API_KEYS_PATH
+
+# =======================
+# API KEYS
+# =======================
+# Used when no API_KEYS_PATH is configured
+VALID_API_KEYS = {
+    "sk-apinow-tbfgenrated1": {"user": "demo"},
+    "sk-apinow-tbfgenratedpro": {"user": "pro"}
+}
+
+key_store = KeyStore(API_KEYS_PATH, builtin=None if API_KEYS_PATH else VALID_API_KEYS)
+
+# Users whose keys may read the key store and usage stats (none by default);
+# a key file can also mark a single key with "admin": true
+ADMIN_USERS = {user.strip() for user in os.environ.get("ADMIN_USERS", "").split(",") if user.strip()}
+
+
+def verify_api_key(key: str):
+    return key_store.lookup(key)
+
+
+def authenticate(auth_header: str):
+    """Resolve an Authorization header to (key_data, error_message)."""
+    if not auth_header.startswith("Bearer "):
+        return None, "Missing API key"
+
+    api_key = auth_header.replace("Bearer ", "").strip()
+    key_data = verify_api_key(api_key)
+
+    if not key_data:
+        return None, "Invalid API key"
+
+    return key_data, None
+
+
+def is_admin(key_data):
+    return key_data.get("admin") is True or key_data["user"] in ADMIN_USERS
+
+
+def auth_error(message: str):
+    return {
+        "error": {
+            "message": message,
+            "type": "authentication_error"
+        }
+    }
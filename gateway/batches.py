@@ -0,0 +1,703 @@
+"""
+Offline batch completions: OpenAI-style /v1/files and /v1/batches.
+
+A batch is an uploaded JSONL file with one chat completion request per line,
+in the format of OpenAI's batch API:
+
+    {"custom_id": "q-1", "method": "POST", "url": "/v1/chat/completions", "body": {...}}
+
+BATCH_WORKERS threads drain every running batch through the provider's
+`create()`, the same call /v1/chat/completions makes. The workers are the
+batches' own concurrency budget: a line is charged to the owning key's
+request and token limits, but not its concurrency cap, and waits for an
+upstream slot as a low-weight flow of its own (see limits.admit), so a
+nightly job gets its share of the Spaces without starving interactive
+traffic, the key's included. Finished lines are recorded in the usage ledger
+under the key that created the batch. A line refused for rate limits or upstream
+saturation waits and tries again. Other upstream errors are retried up to
+BATCH_MAX_ATTEMPTS times, and then the line goes to the batch's error file.
+
+Results are appended to the batch's directory as each line completes, and
+the batch object is saved on every status change. After a restart, running
+batches resume with the lines not yet in their output or error file.
+Progress is in the batch's `request_counts`; throughput is in
+/stats/batches.
+
+BATCH_DIR must be owned by one process. The batch API is off unless BATCHES
+is "1", and the runner takes a lock on BATCH_DIR/.lock when it starts: with
+several worker processes, only the first serves batches, and the others
+answer 404 as if batches were off.
+
+    BATCHES               "1" enables the batch API
+    BATCH_DIR             uploaded files and batch state (./batches)
+    BATCH_WORKERS         lines run concurrently across all batches (4)
+    BATCH_MAX_ATTEMPTS    tries per line before it goes to the error file (3)
+    BATCH_MAX_FILE_BYTES  largest accepted upload (200 MiB)
+    BATCH_MAX_LINES       most requests in one batch (50000)
+"""
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+
+try:
+    import fcntl
+except ImportError:  # Windows: nothing stops a second process, keep to one by hand
+    fcntl = None
+
+from .cache import completion_cache, cache_key, record_stream
+from .limits import admit
+from .responses import completion_body
+from .stopping import Completion, stop_sequences
+from .tokens import usage_meter
+
+
+ENABLED = os.environ.get("BATCHES", "0") == "1"
+BATCH_DIR = os.environ.get("BATCH_DIR", os.path.join(os.getcwd(), "batches"))
+WORKERS = int(os.environ.get("BATCH_WORKERS", 4))
+MAX_ATTEMPTS = int(os.environ.get("BATCH_MAX_ATTEMPTS", 3))
+MAX_FILE_BYTES = int(os.environ.get("BATCH_MAX_FILE_BYTES", 200 * 1024 * 1024))
+MAX_LINES = int(os.environ.get("BATCH_MAX_LINES", 50000))
+
+ENDPOINTS = ("/v1/chat/completions",)
+COMPLETION_WINDOWS = ("24h",)
+MAX_REPORTED_ERRORS = 100
+
+RUNNING = ("validating", "in_progress", "finalizing", "cancelling")
+
+
+class NotFound(LookupError):
+    """No file or batch with that id for this key."""
+
+
+def batch_error(message, code=None, param=None):
+    return {
+        "error": {
+            "message": message,
+            "type": "invalid_request_error",
+            "param": param,
+            "code": code
+        }
+    }
+
+
+def _new_id(prefix):
+    return f"{prefix}{uuid.uuid4().hex[:24]}"
+
+
+def _write_json(path, value):
+    """Replace `path` with `value` as JSON, atomically."""
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(value, f, separators=(",", ":"))
+    os.replace(tmp, path)
+
+
+def _read_json(path):
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _public(obj):
+    return {k: v for k, v in obj.items() if k not in ("owner", "key_id")}
+
+
+# =======================
+# FILES
+# =======================
+class FileStore:
+    """Uploaded and generated JSONL files: <id>.jsonl beside its <id>.json object."""
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self._files = {}
+        self._lock = threading.Lock()
+        for name in os.listdir(root):
+            if name.endswith(".json"):
+                try:
+                    obj = _read_json(os.path.join(root, name))
+                except (OSError, ValueError):
+                    continue
+                self._files[obj["id"]] = obj
+
+    def path(self, file_id):
+        return os.path.join(self.root, file_id + ".jsonl")
+
+    def _add(self, file_id, filename, purpose, owner):
+        obj = {
+            "id": file_id,
+            "object": "file",
+            "bytes": os.path.getsize(self.path(file_id)),
+            "created_at": int(time.time()),
+            "filename": filename,
+            "purpose": purpose,
+            "owner": owner,
+        }
+        _write_json(os.path.join(self.root, file_id + ".json"), obj)
+        with self._lock:
+            self._files[file_id] = obj
+        return obj
+
+    def create(self, stream, filename, purpose, owner):
+        """Store an upload read from `stream`; raises ValueError if it is too large."""
+        file_id = _new_id("file-")
+        path = self.path(file_id)
+        size = 0
+        with open(path, "wb") as f:
+            while True:
+                chunk = stream.read(1 << 20)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > MAX_FILE_BYTES:
+                    f.close()
+                    os.remove(path)
+                    raise ValueError(f"File is larger than {MAX_FILE_BYTES} bytes")
+                f.write(chunk)
+        return self._add(file_id, filename, purpose, owner)
+
+    def adopt(self, path, filename, purpose, owner):
+        """Move a file written elsewhere (a batch's results) into the store."""
+        file_id = _new_id("file-")
+        os.replace(path, self.path(file_id))
+        return self._add(file_id, filename, purpose, owner)
+
+    def get(self, file_id, owner):
+        with self._lock:
+            obj = self._files.get(file_id)
+        if obj is None or obj["owner"] != owner:
+            raise NotFound(f"No such file: {file_id}")
+        return obj
+
+    def list(self, owner, purpose=None):
+        with self._lock:
+            files = [f for f in self._files.values() if f["owner"] == owner]
+        return sorted(
+            (f for f in files if purpose is None or f["purpose"] == purpose),
+            key=lambda f: f["created_at"], reverse=True,
+        )
+
+    def delete(self, file_id, owner):
+        self.get(file_id, owner)
+        with self._lock:
+            self._files.pop(file_id, None)
+        for path in (self.path(file_id), os.path.join(self.root, file_id + ".json")):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+# =======================
+# BATCHES
+# =======================
+def _recover(path):
+    """Results already in a batch's output or error file, dropping a torn last line."""
+    results = []
+    if not os.path.exists(path):
+        return results
+    with open(path, "rb+") as f:
+        data = f.read()
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            f.truncate(end)
+    for line in data[:end].splitlines():
+        try:
+            results.append(json.loads(line))
+        except ValueError:
+            pass
+    return results
+
+
+class Batch:
+    """One batch: its OpenAI batch object plus the progress of this run."""
+
+    def __init__(self, obj, directory):
+        self.obj = obj
+        self.dir = directory
+        self.lock = threading.Lock()
+        self.cancelled = threading.Event()
+        self.done = set()           # custom_ids with a result
+        self.outstanding = 0        # lines queued or running
+        self.fed = False            # every line has been queued
+        self.started = time.monotonic()
+        self.finished_here = 0      # lines finished since this process started it
+        self.tokens_here = 0
+        self._files = {}
+
+    @property
+    def id(self):
+        return self.obj["id"]
+
+    def save(self):
+        _write_json(os.path.join(self.dir, "batch.json"), self.obj)
+
+    def path(self, kind):
+        return os.path.join(self.dir, kind + ".jsonl")
+
+    def recover(self):
+        """Count the results of an earlier run; returns the custom_ids already done."""
+        counts = self.obj["request_counts"]
+        usage = self.obj["usage"]
+        counts["completed"] = counts["failed"] = 0
+        usage.update(input_tokens=0, output_tokens=0, total_tokens=0)
+        for kind in ("output", "errors"):
+            for result in _recover(self.path(kind)):
+                self._count(result)
+        return self.done
+
+    def _count(self, result):
+        self.done.add(result["custom_id"])
+        response = result.get("response") or {}
+        if result.get("error") is None and response.get("status_code") == 200:
+            self.obj["request_counts"]["completed"] += 1
+            usage = response["body"].get("usage", {})
+            self.obj["usage"]["input_tokens"] += usage.get("prompt_tokens", 0)
+            self.obj["usage"]["output_tokens"] += usage.get("completion_tokens", 0)
+            self.obj["usage"]["total_tokens"] += usage.get("total_tokens", 0)
+            return usage.get("total_tokens", 0)
+        self.obj["request_counts"]["failed"] += 1
+        return 0
+
+    def record(self, result):
+        """Append one line's result to the output or error file and count it."""
+        ok = result.get("error") is None and (result.get("response") or {}).get("status_code") == 200
+        kind = "output" if ok else "errors"
+        line = json.dumps(result, separators=(",", ":"), ensure_ascii=False) + "\n"
+        with self.lock:
+            f = self._files.get(kind)
+            if f is None:
+                f = self._files[kind] = open(self.path(kind), "a", encoding="utf-8")
+            f.write(line)
+            f.flush()
+            self.tokens_here += self._count(result)
+            self.finished_here += 1
+
+    def close(self):
+        with self.lock:
+            for f in self._files.values():
+                f.close()
+            self._files.clear()
+
+    def progress(self):
+        counts = self.obj["request_counts"]
+        elapsed = time.monotonic() - self.started
+        rate = self.finished_here / elapsed if elapsed > 0 else 0.0
+        left = counts["total"] - counts["completed"] - counts["failed"]
+        return {
+            "status": self.obj["status"],
+            "total": counts["total"],
+            "completed": counts["completed"],
+            "failed": counts["failed"],
+            "outstanding": self.outstanding,
+            "requests_per_second": round(rate, 3),
+            "tokens_per_second": round(self.tokens_here / elapsed, 1) if elapsed > 0 else 0.0,
+            "eta_seconds": round(left / rate) if rate and self.obj["status"] == "in_progress" else None,
+        }
+
+
+class BatchRunner:
+    """Runs batches with a bounded pool of worker threads.
+
+    `provider_for(model)` returns the provider for a model name (the app's
+    make_workable), or raises for an unknown model. Finished lines go to
+    `ledger`, a ledger.UsageLedger, when there is one.
+    """
+
+    def __init__(self, provider_for, root=BATCH_DIR, workers=WORKERS, ledger=None):
+        self.provider_for = provider_for
+        self.ledger = ledger
+        self.dir = root
+        self.files = FileStore(os.path.join(root, "files"))
+        self.root = os.path.join(root, "batches")
+        os.makedirs(self.root, exist_ok=True)
+        self.workers = workers
+        self._batches = {}
+        self._lock = threading.Lock()
+        self._lines = queue.Queue(maxsize=workers * 2)
+        self._busy = 0
+        self._started = False
+        self._owner_lock = None
+
+    def _own(self):
+        """Lock the batch directory for the life of this process; False if another holds it."""
+        if fcntl is None:
+            return True
+        f = open(os.path.join(self.dir, ".lock"), "w")
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return False
+        self._owner_lock = f
+        return True
+
+    def start(self):
+        """Start the workers and resume the batches a previous run left unfinished.
+
+        Returns False, starting nothing, if another process owns the directory.
+        """
+        with self._lock:
+            if self._started:
+                return True
+            if not self._own():
+                return False
+            self._started = True
+        for name in os.listdir(self.root):
+            directory = os.path.join(self.root, name)
+            try:
+                batch = Batch(_read_json(os.path.join(directory, "batch.json")), directory)
+            except (OSError, ValueError):
+                continue
+            self._batches[batch.id] = batch
+            if batch.obj["status"] == "finalizing":
+                # Stopped while writing out its results: finish it again
+                batch.obj["status"] = "cancelling" if batch.obj["cancelling_at"] else "in_progress"
+            if batch.obj["status"] == "cancelling":
+                batch.cancelled.set()
+            if batch.obj["status"] in RUNNING:
+                self._launch(batch)
+        for _ in range(self.workers):
+            threading.Thread(target=self._work, daemon=True).start()
+        return True
+
+    # -----------------------------------------------------
+    def upload(self, owner, stream, filename, purpose):
+        """Store an uploaded file; raises ValueError."""
+        if purpose != "batch":
+            raise ValueError("Only files with purpose 'batch' can be uploaded")
+        return _public(self.files.create(stream, filename, purpose, owner))
+
+    def file(self, file_id, owner):
+        return _public(self.files.get(file_id, owner))
+
+    def file_path(self, file_id, owner):
+        """Path of a file's content on disk."""
+        self.files.get(file_id, owner)
+        return self.files.path(file_id)
+
+    def list_files(self, owner, purpose=None):
+        return {"object": "list", "data": [_public(f) for f in self.files.list(owner, purpose)]}
+
+    def delete_file(self, file_id, owner):
+        self.files.delete(file_id, owner)
+        return {"id": file_id, "object": "file", "deleted": True}
+
+    # -----------------------------------------------------
+    def create(self, owner, input_file_id, endpoint, completion_window="24h", metadata=None, key_id=None):
+        """Start a batch over an uploaded file; raises ValueError or NotFound.
+
+        `key_id` is the creating key's, which the batch's usage is recorded under.
+        """
+        if endpoint not in ENDPOINTS:
+            raise ValueError(f"Unsupported endpoint {endpoint!r}; supported: {', '.join(ENDPOINTS)}")
+        if completion_window not in COMPLETION_WINDOWS:
+            raise ValueError(f"Unsupported completion_window {completion_window!r}")
+        if metadata is not None and not isinstance(metadata, dict):
+            raise ValueError("'metadata' must be an object")
+        input_file = self.files.get(input_file_id, owner)
+        if input_file["purpose"] != "batch":
+            raise ValueError(f"File {input_file_id} was not uploaded with purpose 'batch'")
+
+        batch_id = _new_id("batch_")
+        directory = os.path.join(self.root, batch_id)
+        os.makedirs(directory)
+        batch = Batch({
+            "id": batch_id,
+            "object": "batch",
+            "endpoint": endpoint,
+            "errors": None,
+            "input_file_id": input_file_id,
+            "completion_window": completion_window,
+            "status": "validating",
+            "output_file_id": None,
+            "error_file_id": None,
+            "created_at": int(time.time()),
+            "in_progress_at": None,
+            "finalizing_at": None,
+            "completed_at": None,
+            "failed_at": None,
+            "cancelling_at": None,
+            "cancelled_at": None,
+            "request_counts": {"total": 0, "completed": 0, "failed": 0},
+            "usage": {"input_tokens": 0, "output_tokens": 0, "total_tokens": 0},
+            "metadata": metadata,
+            "owner": owner,
+            "key_id": key_id,
+        }, directory)
+        batch.save()
+        with self._lock:
+            self._batches[batch_id] = batch
+        self._launch(batch)
+        return _public(batch.obj)
+
+    def _get(self, batch_id, owner):
+        with self._lock:
+            batch = self._batches.get(batch_id)
+        if batch is None or batch.obj["owner"] != owner:
+            raise NotFound(f"No such batch: {batch_id}")
+        return batch
+
+    def get(self, batch_id, owner):
+        return _public(self._get(batch_id, owner).obj)
+
+    def list(self, owner, limit=20, after=None):
+        with self._lock:
+            batches = [b.obj for b in self._batches.values() if b.obj["owner"] == owner]
+        batches.sort(key=lambda b: (b["created_at"], b["id"]), reverse=True)
+        if after is not None:
+            ids = [b["id"] for b in batches]
+            batches = batches[ids.index(after) + 1:] if after in ids else []
+        page = batches[:limit]
+        return {
+            "object": "list",
+            "data": [_public(b) for b in page],
+            "first_id": page[0]["id"] if page else None,
+            "last_id": page[-1]["id"] if page else None,
+            "has_more": len(batches) > len(page),
+        }
+
+    def cancel(self, batch_id, owner):
+        """Stop queueing lines of a batch; it is cancelled once its running lines finish."""
+        batch = self._get(batch_id, owner)
+        with batch.lock:
+            if batch.obj["status"] not in ("validating", "in_progress"):
+                return _public(batch.obj)
+            batch.obj["status"] = "cancelling"
+            batch.obj["cancelling_at"] = int(time.time())
+            batch.save()
+        batch.cancelled.set()
+        self._maybe_finish(batch)
+        return _public(batch.obj)
+
+    # -----------------------------------------------------
+    def _launch(self, batch):
+        threading.Thread(target=self._feed, args=(batch,), daemon=True).start()
+
+    def _lines_of(self, batch):
+        with open(self.files.path(batch.obj["input_file_id"]), encoding="utf-8") as f:
+            for number, line in enumerate(f, 1):
+                if line.strip():
+                    yield number, line
+
+    def _validate(self, batch):
+        """Check every line of the input; returns the batch's errors (empty if valid)."""
+        errors = []
+        seen = set()
+        total = 0
+
+        def error(code, message, line):
+            if len(errors) < MAX_REPORTED_ERRORS:
+                errors.append({"code": code, "message": message, "param": None, "line": line})
+
+        for number, line in self._lines_of(batch):
+            total += 1
+            try:
+                item = json.loads(line)
+            except ValueError:
+                error("invalid_json_line", "Line is not valid JSON", number)
+                continue
+            custom_id = item.get("custom_id") if isinstance(item, dict) else None
+            if not isinstance(custom_id, str) or not custom_id:
+                error("missing_required_parameter", "Line has no 'custom_id'", number)
+            elif custom_id in seen:
+                error("duplicate_custom_id", f"custom_id {custom_id!r} is used more than once", number)
+            else:
+                seen.add(custom_id)
+            if isinstance(item, dict) and item.get("method") != "POST":
+                error("invalid_method", "Only POST requests are supported", number)
+            if isinstance(item, dict) and item.get("url") != batch.obj["endpoint"]:
+                error("mismatched_endpoint", f"Line url does not match the batch endpoint {batch.obj['endpoint']}", number)
+            body = item.get("body") if isinstance(item, dict) else None
+            if not isinstance(body, dict) or not body.get("model"):
+                error("missing_required_parameter", "Line body has no 'model'", number)
+        if total == 0:
+            error("empty_file", "The input file has no requests", None)
+        elif total > MAX_LINES:
+            error("too_many_requests", f"A batch holds at most {MAX_LINES} requests", None)
+        batch.obj["request_counts"]["total"] = total
+        return errors
+
+    def _feed(self, batch):
+        """Validate a new batch, then queue the lines that have no result yet."""
+        try:
+            if batch.obj["status"] == "validating":
+                errors = self._validate(batch)
+                with batch.lock:
+                    if errors:
+                        batch.obj.update(status="failed", failed_at=int(time.time()),
+                                         errors={"object": "list", "data": errors})
+                    elif batch.obj["status"] == "validating":
+                        batch.obj.update(status="in_progress", in_progress_at=int(time.time()))
+                    batch.save()
+                if errors:
+                    return
+
+            done = batch.recover()
+            for _, line in self._lines_of(batch):
+                if batch.cancelled.is_set():
+                    break
+                item = json.loads(line)
+                if item["custom_id"] in done:
+                    continue
+                with batch.lock:
+                    batch.outstanding += 1
+                self._lines.put((batch, item))
+        except Exception as e:
+            print("BATCH ERROR:", batch.id, e)
+            with batch.lock:
+                batch.obj.update(status="failed", failed_at=int(time.time()), errors={
+                    "object": "list",
+                    "data": [{"code": "server_error", "message": str(e), "param": None, "line": None}],
+                })
+                batch.save()
+            return
+        finally:
+            batch.fed = True
+        self._maybe_finish(batch)
+
+    def _maybe_finish(self, batch):
+        """Write out the result files once every queued line of the batch is done."""
+        with batch.lock:
+            if not batch.fed or batch.outstanding or batch.obj["status"] not in ("in_progress", "cancelling"):
+                return
+            cancelled = batch.obj["status"] == "cancelling"
+            batch.obj.update(status="finalizing", finalizing_at=int(time.time()))
+            batch.save()
+        batch.close()
+
+        owner = batch.obj["owner"]
+        for kind, field in (("output", "output_file_id"), ("errors", "error_file_id")):
+            path = batch.path(kind)
+            if os.path.exists(path) and os.path.getsize(path):
+                name = f"{batch.id}_{'output' if kind == 'output' else 'error'}.jsonl"
+                batch.obj[field] = self.files.adopt(path, name, "batch_output", owner)["id"]
+        with batch.lock:
+            if cancelled:
+                batch.obj.update(status="cancelled", cancelled_at=int(time.time()))
+            else:
+                batch.obj.update(status="completed", completed_at=int(time.time()))
+            batch.save()
+
+    # -----------------------------------------------------
+    def _work(self):
+        while True:
+            batch, item = self._lines.get()
+            with self._lock:
+                self._busy += 1
+            try:
+                result = None if batch.cancelled.is_set() else self._run(batch, item)
+                if result is not None:
+                    batch.record(result)
+            except Exception as e:
+                print("BATCH ERROR:", batch.id, item.get("custom_id"), e)
+            finally:
+                with self._lock:
+                    self._busy -= 1
+                with batch.lock:
+                    batch.outstanding -= 1
+                self._maybe_finish(batch)
+
+    def _run(self, batch, item):
+        """Run one line; returns its result line, or None if the batch was cancelled first."""
+        result = {"id": _new_id("batch_req_"), "custom_id": item["custom_id"], "response": None, "error": None}
+        attempts = 0
+        while True:
+            try:
+                status, body = self._complete(batch, item["body"])
+            except Exception as e:
+                retry_after = getattr(e, "retry_after", None)
+                if retry_after is not None:
+                    # Saturated upstream: wait like a queued request, not a failure
+                    if batch.cancelled.wait(retry_after):
+                        return None
+                    continue
+                attempts += 1
+                if attempts < MAX_ATTEMPTS:
+                    if batch.cancelled.wait(2 ** attempts):
+                        return None
+                    continue
+                status = 504 if isinstance(e, TimeoutError) else 502
+                result["error"] = {"code": "upstream_error", "message": str(e) or type(e).__name__}
+                result["response"] = {"status_code": status, "request_id": None, "body": None}
+                return result
+            if status is None:
+                # Rate limited: `body` is the seconds to wait
+                if batch.cancelled.wait(body):
+                    return None
+                continue
+            result["response"] = {"status_code": status, "request_id": body.get("id"), "body": body}
+            if status != 200:
+                result["error"] = body.get("error")
+            return result
+
+    def _complete(self, batch, body):
+        """(status, response body) of one request; (None, seconds) if it must wait for its limits."""
+        model_name = body.get("model")
+        messages = body.get("messages", [])
+        max_tokens = body.get("max_tokens", 2048)
+        try:
+            stop = stop_sequences(body.get("stop"))
+            provider = self.provider_for(model_name)
+        except Exception as e:
+            return 400, batch_error(str(e))
+
+        started = time.perf_counter()
+        key = cache_key(model_name, messages, max_tokens)
+        cached = completion_cache.get(key, model_name) if completion_cache is not None else None
+        meter = usage_meter(provider, messages)
+        completion = Completion(meter, max_tokens, stop)
+        if cached is not None:
+            text = "".join(self._track(batch, model_name, meter, started, completion.limit(iter(cached))))
+            return 200, completion_body(model_name, text, meter.usage(), completion.finish_reason)
+
+        admission, rejection = admit(batch.obj["owner"], meter, max_tokens, batch=True)
+        if rejection is not None:
+            return None, rejection.retry_after
+        if not admission.acquire_slot():
+            admission.release()
+            return None, 1
+
+        try:
+            tokens = provider.create(message=messages, model=model_name, stream=True, max_tokens=max_tokens)
+        except Exception:
+            admission.release()
+            raise
+        if completion_cache is not None:
+            tokens = record_stream(tokens, lambda seen: completion_cache.put(key, model_name, seen))
+        tokens = admission.guard(completion.limit(tokens))
+        text = "".join(self._track(batch, model_name, meter, started, tokens))
+        return 200, completion_body(model_name, text, meter.usage(), completion.finish_reason)
+
+    def _track(self, batch, model_name, meter, started, tokens):
+        if self.ledger is None:
+            return tokens
+        return self.ledger.track(tokens, batch.obj.get("key_id"), batch.obj["owner"], model_name, meter.usage, started)
+
+    # -----------------------------------------------------
+    def stats(self):
+        with self._lock:
+            batches = list(self._batches.values())
+            busy = self._busy
+        return {
+            "enabled": True,
+            "workers": self.workers,
+            "busy_workers": busy,
+            "queued_lines": self._lines.qsize(),
+            "batches": {b.id: b.progress() for b in batches if b.obj["status"] in RUNNING},
+            "finished_batches": sum(1 for b in batches if b.obj["status"] not in RUNNING),
+        }
+
+
+def open_batches(provider_for, ledger=None):
+    """A started BatchRunner, or None when batches are off or another process owns BATCH_DIR."""
+    if not ENABLED:
+        return None
+    runner = BatchRunner(provider_for, ledger=ledger)
+    if not runner.start():
+        print("BATCHES: another process owns", BATCH_DIR, "- the batch API is off in this one")
+        return None
+    return runner
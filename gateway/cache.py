@@ -0,0 +1,252 @@
+"""
+Exact-match completion cache.
+
+Keyed on a canonical hash of (model, normalized messages, max_tokens). The
+memory tier is an LRU bounded by a byte budget, every entry expires after a
+TTL, and an optional SQLite tier keeps entries across restarts. Entries hold
+the upstream token chunks rather than just the text, so a cached `stream: true`
+request replays as the same sequence of SSE chunks.
+
+    COMPLETION_CACHE            "0" disables the cache
+    COMPLETION_CACHE_TTL        seconds an entry stays valid (600)
+    COMPLETION_CACHE_MAX_BYTES  memory budget in bytes (64 MiB)
+    COMPLETION_CACHE_PATH       SQLite file for the disk tier (unset: memory only)
+    COMPLETION_CACHE_DISK_MAX_BYTES  disk budget in bytes (512 MiB)
+
+Clients skip the cache with `Cache-Control: no-store` (no lookup, no store)
+or `Cache-Control: no-cache` (no lookup, result still stored).
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+ENABLED = os.environ.get("COMPLETION_CACHE", "1") != "0"
+TTL = float(os.environ.get("COMPLETION_CACHE_TTL", 600))
+MAX_BYTES = int(os.environ.get("COMPLETION_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+DISK_PATH = os.environ.get("COMPLETION_CACHE_PATH") or None
+DISK_MAX_BYTES = int(os.environ.get("COMPLETION_CACHE_DISK_MAX_BYTES", 512 * 1024 * 1024))
+
+# Rough per-entry bookkeeping cost on top of the token payload
+ENTRY_OVERHEAD = 256
+
+
+def normalize_messages(messages):
+    """Keep only what reaches the upstream: role and content."""
+    normalized = []
+    for msg in messages or []:
+        content = msg.get("content", "")
+        if isinstance(content, str):
+            content = content.strip()
+        normalized.append({"role": msg.get("role"), "content": content})
+    return normalized
+
+
+def cache_key(model_name, messages, max_tokens):
+    canonical = json.dumps(
+        [model_name, normalize_messages(messages), max_tokens],
+        sort_keys=True,
+        separators=(",", ":"),
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def cache_policy(cache_control: str):
+    """Map a Cache-Control request header to (lookup, store)."""
+    directives = {d.strip().lower() for d in (cache_control or "").split(",")}
+    if "no-store" in directives:
+        return False, False
+    if "no-cache" in directives:
+        return False, True
+    return True, True
+
+
+class _Entry:
+    __slots__ = ("model", "tokens", "expires", "size")
+
+    def __init__(self, model, tokens, expires):
+        self.model = model
+        self.tokens = tokens
+        self.expires = expires
+        self.size = sum(len(t.encode()) for t in tokens) + ENTRY_OVERHEAD
+
+
+class DiskTier:
+    """SQLite-backed second tier; survives restarts."""
+
+    def __init__(self, path, max_bytes=DISK_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS completions ("
+            " key TEXT PRIMARY KEY, model TEXT, tokens TEXT,"
+            " expires REAL, size INTEGER, stored REAL)"
+        )
+        self.prune()
+
+    def get(self, key):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT model, tokens, expires FROM completions WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        model, tokens, expires = row
+        if expires <= time.time():
+            self.delete(key)
+            return None
+        return _Entry(model, json.loads(tokens), expires)
+
+    def put(self, key, entry):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?, ?, ?)",
+                (key, entry.model, json.dumps(entry.tokens), entry.expires, entry.size, time.time()),
+            )
+
+    def delete(self, key):
+        with self._lock:
+            self._db.execute("DELETE FROM completions WHERE key = ?", (key,))
+
+    def prune(self):
+        """Drop expired rows, then the oldest rows until under the byte budget."""
+        with self._lock:
+            self._db.execute("DELETE FROM completions WHERE expires <= ?", (time.time(),))
+            total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            for key, size in self._db.execute(
+                "SELECT key, size FROM completions ORDER BY stored"
+            ).fetchall():
+                self._db.execute("DELETE FROM completions WHERE key = ?", (key,))
+                total -= size
+                if total <= self.max_bytes:
+                    break
+
+
+class CompletionCache:
+    """LRU + TTL + byte-budget cache of completed token streams."""
+
+    def __init__(self, ttl=TTL, max_bytes=MAX_BYTES, disk_path=DISK_PATH):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.disk = DiskTier(disk_path) if disk_path else None
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._model_stats = {}
+        self.evictions = 0
+        self._puts = 0
+
+    # -----------------------------------------------------
+    def _count(self, model, outcome):
+        stats = self._model_stats.setdefault(model, {"hits": 0, "misses": 0, "bypass": 0})
+        stats[outcome] += 1
+
+    def _evict_over_budget(self):
+        while self._bytes > self.max_bytes and self._entries:
+            _, old = self._entries.popitem(last=False)
+            self._bytes -= old.size
+            self.evictions += 1
+
+    def _insert(self, key, entry):
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= old.size
+        self._entries[key] = entry
+        self._bytes += entry.size
+        self._evict_over_budget()
+
+    # -----------------------------------------------------
+    def get(self, key, model):
+        """Cached token list for `key`, or None."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires <= now:
+                del self._entries[key]
+                self._bytes -= entry.size
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self._count(model, "hits")
+                return entry.tokens
+
+        entry = self.disk.get(key) if self.disk else None
+        with self._lock:
+            if entry is None:
+                self._count(model, "misses")
+                return None
+            self._insert(key, entry)
+            self._count(model, "hits")
+            return entry.tokens
+
+    def put(self, key, model, tokens):
+        if not tokens:
+            return  # an upstream failure, not an answer
+        entry = _Entry(model, list(tokens), time.time() + self.ttl)
+        if entry.size > self.max_bytes:
+            return
+
+        with self._lock:
+            self._insert(key, entry)
+            self._puts += 1
+            prune = self.disk is not None and self._puts % 1000 == 0
+
+        if self.disk is not None:
+            self.disk.put(key, entry)
+            if prune:
+                self.disk.prune()
+
+    def bypass(self, model):
+        with self._lock:
+            self._count(model, "bypass")
+
+    # -----------------------------------------------------
+    def stats(self):
+        with self._lock:
+            models = {}
+            for model, s in self._model_stats.items():
+                lookups = s["hits"] + s["misses"]
+                models[model] = {**s, "hit_ratio": round(s["hits"] / lookups, 4) if lookups else 0.0}
+            return {
+                "enabled": True,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                "evictions": self.evictions,
+                "disk": self.disk is not None,
+                "models": models,
+            }
+
+
+completion_cache = CompletionCache() if ENABLED else None
+
+
+def record_stream(tokens, on_complete):
+    """Pass tokens through; hand the full list to `on_complete` if the stream finishes."""
+    seen = []
+    for token in tokens:
+        seen.append(token)
+        yield token
+    on_complete(seen)
+
+
+async def arecord_stream(tokens, on_complete):
+    seen = []
+    try:
+        async for token in tokens:
+            seen.append(token)
+            yield token
+    finally:
+        if hasattr(tokens, "aclose"):
+            await tokens.aclose()
+    on_complete(seen)
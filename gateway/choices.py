@@ -0,0 +1,180 @@
+"""
+`n` > 1: several choices for one request.
+
+Each choice is its own upstream job, with its own session hash or
+conversation, so the samples are independent. All of them are started at
+once and the request waits for the slowest first token, not the sum of
+them. If any choice fails to start, the others are closed and the request
+fails as a single-choice one would. Their tokens are then merged into one
+stream of (index, text) in arrival order. Each choice keeps its own
+max_tokens, stop sequences and finish reason. The prompt is counted once
+in `usage`, and the completion tokens of every choice are summed.
+
+Choices are never served from the completion cache or coalesced with
+other requests, since identical requests should get different samples.
+
+    MAX_CHOICES     largest `n` accepted (8)
+"""
+import asyncio
+import contextvars
+import os
+import queue
+import threading
+
+from .stopping import Completion
+
+
+MAX_CHOICES = int(os.environ.get("MAX_CHOICES", 8))
+
+
+def choice_count(value):
+    """The `n` parameter as an int; raises ValueError if malformed."""
+    if value is None:
+        return 1
+    if isinstance(value, bool) or not isinstance(value, int) or not 1 <= value <= MAX_CHOICES:
+        raise ValueError(f"'n' must be an integer from 1 to {MAX_CHOICES}")
+    return value
+
+
+class Choices:
+    """The completions of one request with `n` > 1; usable as its meter for admit()."""
+
+    def __init__(self, meters, max_tokens=None, stop=()):
+        self.meters = meters
+        self.completions = [Completion(meter, max_tokens, stop) for meter in meters]
+        self.prompt_tokens = meters[0].prompt_tokens
+
+    def __len__(self):
+        return len(self.completions)
+
+    @property
+    def completion_tokens(self):
+        return sum(meter.completion_tokens for meter in self.meters)
+
+    def usage(self):
+        completion = self.completion_tokens
+        return {
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": completion,
+            "total_tokens": self.prompt_tokens + completion,
+        }
+
+    def finish_reason(self, index):
+        return self.completions[index].finish_reason
+
+    def start(self, start):
+        """Run `start()` once per choice, concurrently; returns the merged (index, text) stream.
+
+        Blocks until every choice has its first token. Each call runs in a
+        copy of the caller's context, so it keeps the request's deadline.
+        """
+        results = [None] * len(self)
+
+        def run(i):
+            try:
+                results[i] = (start(), None)
+            except Exception as e:
+                results[i] = (None, e)
+
+        threads = [
+            threading.Thread(target=contextvars.copy_context().run, args=(run, i), daemon=True)
+            for i in range(len(self))
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        errors = [error for _, error in results if error is not None]
+        if errors:
+            for tokens, _ in results:
+                if hasattr(tokens, "close"):
+                    tokens.close()
+            raise errors[0]
+        return self._merge([c.limit(tokens) for c, (tokens, _) in zip(self.completions, results)])
+
+    async def astart(self, start):
+        """Async counterpart of start(); `start` is a coroutine function."""
+        results = await asyncio.gather(*(start() for _ in range(len(self))), return_exceptions=True)
+        errors = [r for r in results if isinstance(r, BaseException)]
+        if errors:
+            for tokens in results:
+                if hasattr(tokens, "aclose"):
+                    await tokens.aclose()
+            raise errors[0]
+        return self._amerge([c.alimit(tokens) for c, tokens in zip(self.completions, results)])
+
+    @staticmethod
+    def _merge(streams):
+        """(index, text) from every stream as it arrives; one pump thread per stream.
+
+        Closing the merged stream stops the pumps and returns once each has
+        closed its stream, after the token it is waiting on.
+        """
+        merged = queue.Queue()
+        stop = threading.Event()
+        end = object()
+
+        def pump(i, tokens):
+            try:
+                for token in tokens:
+                    merged.put((i, token))
+                    if stop.is_set():
+                        break
+            except Exception as e:
+                merged.put((i, e))
+            finally:
+                tokens.close()
+                merged.put((i, end))
+
+        pumps = [threading.Thread(target=pump, args=(i, tokens), daemon=True) for i, tokens in enumerate(streams)]
+        for thread in pumps:
+            thread.start()
+
+        def events():
+            running = len(streams)
+            try:
+                while running:
+                    i, item = merged.get()
+                    if item is end:
+                        running -= 1
+                    elif isinstance(item, Exception):
+                        raise item
+                    else:
+                        yield i, item
+            finally:
+                stop.set()
+                for thread in pumps:
+                    thread.join()
+        return events()
+
+    @staticmethod
+    async def _amerge(streams):
+        merged = asyncio.Queue()
+        end = object()
+
+        async def pump(i, tokens):
+            try:
+                async for token in tokens:
+                    merged.put_nowait((i, token))
+            except Exception as e:
+                merged.put_nowait((i, e))
+            finally:
+                await tokens.aclose()
+                merged.put_nowait((i, end))
+
+        pumps = [asyncio.ensure_future(pump(i, tokens)) for i, tokens in enumerate(streams)]
+        running = len(streams)
+        try:
+            while running:
+                i, item = await merged.get()
+                if item is end:
+                    running -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield i, item
+        finally:
+            for task in pumps:
+                task.cancel()
+            await asyncio.gather(*pumps, return_exceptions=True)
@@ -0,0 +1,148 @@
+"""
+API key store.
+
+Keys are kept as sha256 hashes only. Every lookup hashes the presented key
+and reads a dict, so authentication never touches the disk. The keys come
+from API_KEYS_PATH, either a JSON file mapping hashes to key data:
+
+    {"<sha256 of the key>": {"user": "pro"}, ...}
+
+or, for a path ending in .db / .sqlite / .sqlite3, a SQLite database with a
+table `api_keys (key_hash TEXT PRIMARY KEY, user TEXT NOT NULL, disabled
+INTEGER NOT NULL DEFAULT 0)`. A watcher thread checks the file every
+API_KEYS_RELOAD seconds and swaps in the new keys when it has changed, so
+keys are added, rotated and revoked without a redeploy. A file that fails to
+load keeps the previous keys in place. Without API_KEYS_PATH the built-in
+VALID_API_KEYS are used.
+
+Hash a key for the file with hash_key("sk-..."). Each key's data carries a
+`key_id`, a prefix of its hash, which is what usage is recorded under. A
+JSON entry with `"admin": true` may read /stats/keys and /stats/usage, as may
+the keys of users listed in ADMIN_USERS.
+
+    API_KEYS_PATH       JSON or SQLite file of hashed keys (unset: built-in keys)
+    API_KEYS_RELOAD     seconds between checks for a changed file (2)
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+API_KEYS_PATH = os.environ.get("API_KEYS_PATH") or None
+RELOAD_INTERVAL = float(os.environ.get("API_KEYS_RELOAD", 2))
+
+SQLITE_SUFFIXES = (".db", ".sqlite", ".sqlite3")
+
+
+def hash_key(key):
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def _entry(key_hash, data):
+    return {**data, "key_id": key_hash[:12]}
+
+
+def _load_json(path):
+    with open(path, encoding="utf-8") as f:
+        raw = json.load(f)
+    if not isinstance(raw, dict):
+        raise ValueError("key file must be a JSON object of key hashes")
+    keys = {}
+    for key_hash, data in raw.items():
+        if not isinstance(data, dict) or not isinstance(data.get("user"), str):
+            raise ValueError(f"key {key_hash[:12]} needs a 'user'")
+        keys[key_hash.lower()] = _entry(key_hash.lower(), data)
+    return keys
+
+
+def _load_sqlite(path):
+    db = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        rows = db.execute("SELECT key_hash, user FROM api_keys WHERE NOT disabled").fetchall()
+    finally:
+        db.close()
+    return {key_hash.lower(): _entry(key_hash.lower(), {"user": user}) for key_hash, user in rows}
+
+
+class KeyStore:
+    """Hashed API keys held in memory, reloaded when their file changes."""
+
+    def __init__(self, path=API_KEYS_PATH, builtin=None, interval=RELOAD_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self._keys = {hash_key(k): _entry(hash_key(k), v) for k, v in (builtin or {}).items()}
+        self._version = None
+        self._lock = threading.Lock()
+        self._started = False
+        self.reloads = 0
+        self.errors = 0
+        self.last_error = None
+        self.loaded_at = time.time()
+        if path is not None:
+            self.reload()
+
+    def lookup(self, key):
+        """The key data for `key`, or None."""
+        return self._keys.get(hash_key(key))
+
+    def _file_version(self):
+        """What changes when the file does; SQLite commits may only touch its -wal."""
+        version = []
+        for path in (self.path, self.path + "-wal"):
+            try:
+                st = os.stat(path)
+            except OSError:
+                version.append(None)
+            else:
+                version.append((st.st_mtime_ns, st.st_size))
+        return tuple(version)
+
+    def reload(self, force=True):
+        """Load the key file if it changed (or always with `force`); returns whether keys were swapped."""
+        with self._lock:
+            version = self._file_version()
+            if not force and version == self._version:
+                return False
+            try:
+                load = _load_sqlite if self.path.endswith(SQLITE_SUFFIXES) else _load_json
+                keys = load(self.path)
+            except (OSError, ValueError, sqlite3.Error) as e:
+                self.errors += 1
+                self.last_error = str(e)
+                self._version = version
+                print("API KEYS ERROR:", self.path, e)
+                return False
+            self._keys = keys
+            self._version = version
+            self.reloads += 1
+            self.last_error = None
+            self.loaded_at = time.time()
+            return True
+
+    def start(self):
+        """Watch the key file for changes."""
+        if self.path is None:
+            return
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        threading.Thread(target=self._watch, name="api-keys", daemon=True).start()
+
+    def _watch(self):
+        while True:
+            time.sleep(self.interval)
+            self.reload(force=False)
+
+    def stats(self):
+        return {
+            "source": self.path or "builtin",
+            "keys": len(self._keys),
+            "reloads": self.reloads,
+            "errors": self.errors,
+            "last_error": self.last_error,
+            "loaded_at": self.loaded_at,
+        }
@@ -0,0 +1,208 @@
+"""
+Per-key usage ledger.
+
+Every response is recorded with its key, user, model, prompt and completion
+tokens, latency and outcome. Recording only appends to an in-memory buffer.
+A writer thread flushes the buffer to SQLite in one transaction every
+USAGE_LEDGER_FLUSH seconds, or sooner once USAGE_LEDGER_BATCH rows are
+waiting, so accounting adds no disk I/O to the request path. Rows still
+buffered at exit are flushed then. If the disk falls behind, the buffer is
+capped at USAGE_LEDGER_MAX_PENDING rows, and rows past the cap are dropped
+and counted rather than allowed to grow memory.
+
+The ledger is off unless USAGE_LEDGER_PATH names its file. The app opens it
+with open_ledger() at startup, so importing this module touches no disk and
+starts no thread. The `usage` table can be queried directly, and
+/stats/usage sums it per key and model for admin keys.
+
+    USAGE_LEDGER_PATH           SQLite file (unset: no ledger)
+    USAGE_LEDGER_FLUSH          seconds between flushes (2)
+    USAGE_LEDGER_BATCH          buffered rows that trigger an early flush (500)
+    USAGE_LEDGER_MAX_PENDING    buffered rows kept while the disk is behind (100000)
+"""
+import atexit
+import os
+import sqlite3
+import threading
+import time
+
+
+LEDGER_PATH = os.environ.get("USAGE_LEDGER_PATH") or None
+FLUSH_INTERVAL = float(os.environ.get("USAGE_LEDGER_FLUSH", 2))
+BATCH_SIZE = int(os.environ.get("USAGE_LEDGER_BATCH", 500))
+MAX_PENDING = int(os.environ.get("USAGE_LEDGER_MAX_PENDING", 100_000))
+
+
+class UsageLedger:
+    """Write-behind buffer of usage rows over a SQLite table."""
+
+    def __init__(self, path, interval=FLUSH_INTERVAL, batch=BATCH_SIZE, max_pending=MAX_PENDING):
+        self.path = path
+        self.interval = interval
+        self.batch = batch
+        self.max_pending = max_pending
+        self._pending = []
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._started = False
+        self.written = 0
+        self.dropped = 0
+        self.flushes = 0
+        self.failures = 0
+        self.last_flush_seconds = 0.0
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS usage ("
+            " ts REAL, key_id TEXT, user TEXT, model TEXT,"
+            " prompt_tokens INTEGER, completion_tokens INTEGER,"
+            " latency REAL, status TEXT)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS usage_key_ts ON usage (key_id, ts)")
+
+    # -----------------------------------------------------
+    def record(self, key_id, user, model, usage, latency, status="ok"):
+        """Buffer one response's usage; `usage` is a UsageMeter.usage() dict."""
+        row = (
+            time.time(), key_id, user, model,
+            usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0),
+            round(latency, 4), status,
+        )
+        with self._lock:
+            if len(self._pending) >= self.max_pending:
+                self.dropped += 1
+                return
+            self._pending.append(row)
+            full = len(self._pending) >= self.batch
+        if full:
+            self._wake.set()
+
+    def _outcome(self, error):
+        return "timeout" if isinstance(error, TimeoutError) else "error"
+
+    def track(self, tokens, key_id, user, model, usage, started):
+        """Pass `tokens` through, recording usage() once the stream ends.
+
+        `started` is the request's time.perf_counter() on arrival.
+        """
+        def tracked():
+            status = "cancelled"
+            try:
+                for token in tokens:
+                    yield token
+                status = "ok"
+            except Exception as e:
+                status = self._outcome(e)
+                raise
+            finally:
+                self.record(key_id, user, model, usage(), time.perf_counter() - started, status)
+        return tracked()
+
+    def atrack(self, tokens, key_id, user, model, usage, started):
+        """Async counterpart of track()."""
+        async def tracked():
+            status = "cancelled"
+            try:
+                async for token in tokens:
+                    yield token
+                status = "ok"
+            except Exception as e:
+                status = self._outcome(e)
+                raise
+            finally:
+                self.record(key_id, user, model, usage(), time.perf_counter() - started, status)
+                if hasattr(tokens, "aclose"):
+                    await tokens.aclose()
+        return tracked()
+
+    # -----------------------------------------------------
+    def start(self):
+        """Start the writer; whatever is buffered at exit is flushed then."""
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        threading.Thread(target=self._writer, name="usage-ledger", daemon=True).start()
+        atexit.register(self.flush)
+
+    def _writer(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self):
+        """Write the buffered rows in one transaction."""
+        with self._lock:
+            rows, self._pending = self._pending, []
+        if not rows:
+            return
+        started = time.perf_counter()
+        try:
+            with self._db_lock:
+                self._db.execute("BEGIN")
+                try:
+                    self._db.executemany("INSERT INTO usage VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+                    self._db.execute("COMMIT")
+                except BaseException:
+                    self._db.execute("ROLLBACK")
+                    raise
+        except sqlite3.Error as e:
+            print("USAGE LEDGER ERROR:", e)
+            with self._lock:
+                # Retry with the next flush, ahead of newer rows, within the cap
+                self.failures += 1
+                keep = max(0, self.max_pending - len(self._pending))
+                self.dropped += max(0, len(rows) - keep)
+                self._pending[:0] = rows[-keep:] if keep else []
+            return
+        with self._lock:
+            self.written += len(rows)
+            self.flushes += 1
+            self.last_flush_seconds = round(time.perf_counter() - started, 6)
+
+    # -----------------------------------------------------
+    def totals(self, since=None):
+        """Summed usage per key and model, from the flushed rows."""
+        with self._db_lock:
+            rows = self._db.execute(
+                "SELECT key_id, user, model, COUNT(*), SUM(prompt_tokens), SUM(completion_tokens),"
+                " AVG(latency), SUM(status != 'ok')"
+                " FROM usage WHERE ts >= ? GROUP BY key_id, user, model",
+                (since or 0,),
+            ).fetchall()
+        keys = {}
+        for key_id, user, model, requests, prompt, completion, latency, failed in rows:
+            key = keys.setdefault(key_id or "-", {"user": user, "models": {}})
+            key["models"][model] = {
+                "requests": requests,
+                "failed": failed,
+                "prompt_tokens": prompt,
+                "completion_tokens": completion,
+                "avg_latency": round(latency or 0.0, 4),
+            }
+        return keys
+
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": True,
+                "path": self.path,
+                "pending": len(self._pending),
+                "written": self.written,
+                "dropped": self.dropped,
+                "flushes": self.flushes,
+                "failures": self.failures,
+                "last_flush_seconds": self.last_flush_seconds,
+            }
+
+
+def open_ledger(path=LEDGER_PATH):
+    """A started ledger writing to `path`, or None when no path is configured."""
+    if path is None:
+        return None
+    ledger = UsageLedger(path)
+    ledger.start()
+    return ledger
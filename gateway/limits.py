@@ -0,0 +1,470 @@
+"""
+Per-API-key admission control. Both parts are opt-in: with the defaults,
+requests are neither rate limited nor queued for upstream slots.
+
+With RATE_LIMITS=1 every authenticated user has a tier of limits:
+
+    concurrency     streams the key may have open at once
+    rpm             requests per minute (token bucket, bursts up to one minute's worth)
+    tpm             tokens per minute: the prompt's tokens plus max_tokens are
+                    reserved up front and the unused part refunded when the
+                    response ends
+    weight          share of upstream slots under contention
+
+Requests over a limit get an OpenAI-style 429 with `Retry-After`.
+
+With UPSTREAM_SLOTS set, that many upstream slots are shared by all keys.
+While there are free slots a request takes one straight away. Once they run
+out, waiting requests are served in weighted-fair order: each key's requests
+are stamped with a virtual finish time that advances by 1/weight per
+request, and the smallest stamp goes next, so a `pro` key gets four slots
+for every one a waiting `demo` key gets without either starving. A request
+that cannot get a slot within FAIR_QUEUE_TIMEOUT seconds is rejected with a
+429.
+
+    RATE_LIMITS         "1" enables the per-key limits
+    UPSTREAM_SLOTS      upstream calls in flight across all keys (0: unlimited)
+    FAIR_QUEUE_TIMEOUT  seconds a request may wait for a slot (30)
+"""
+import asyncio
+import heapq
+import itertools
+import math
+import os
+import threading
+import time
+import weakref
+from typing import NamedTuple
+
+
+ENABLED = os.environ.get("RATE_LIMITS", "0") == "1"
+UPSTREAM_SLOTS = int(os.environ.get("UPSTREAM_SLOTS", 0))
+FAIR_QUEUE_TIMEOUT = float(os.environ.get("FAIR_QUEUE_TIMEOUT", 30))
+
+
+class Limits(NamedTuple):
+    concurrency: int
+    rpm: int
+    tpm: int
+    weight: float
+
+
+TIERS = {
+    "demo": Limits(concurrency=4, rpm=30, tpm=60_000, weight=1),
+    "pro": Limits(concurrency=32, rpm=600, tpm=2_000_000, weight=4),
+}
+DEFAULT_LIMITS = Limits(concurrency=2, rpm=10, tpm=20_000, weight=1)
+
+
+def limits_for(user):
+    return TIERS.get(user, DEFAULT_LIMITS)
+
+
+# =======================
+# TOKEN BUCKETS
+# =======================
+class TokenBucket:
+    """`rate` units per minute, holding at most one minute's worth."""
+
+    def __init__(self, rate):
+        self.rate = rate / 60.0
+        self.capacity = float(rate)
+        self.level = float(rate)
+        self.updated = time.monotonic()
+
+    def _fill(self, now):
+        if now > self.updated:
+            self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def take(self, amount, now):
+        """Take `amount` and return 0, or return the seconds until it would fit."""
+        self._fill(now)
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            self.level -= amount
+            return 0.0
+        return (amount - self.level) / self.rate
+
+    def give(self, amount):
+        self.level = min(self.capacity, self.level + amount)
+
+    def reset_after(self, now):
+        """Seconds until the bucket is full again."""
+        self._fill(now)
+        return (self.capacity - self.level) / self.rate
+
+
+class Rejection(NamedTuple):
+    kind: str           # "concurrency", "requests" or "tokens"
+    message: str
+    retry_after: int
+
+
+class _KeyState:
+    def __init__(self, limits):
+        self.limits = limits
+        self.requests = TokenBucket(limits.rpm)
+        self.tokens = TokenBucket(limits.tpm)
+        self.open = 0
+        self.admitted = 0
+        self.rejected = {"concurrency": 0, "requests": 0, "tokens": 0}
+
+
+class Lease:
+    """One admitted request: holds a concurrency slot and a token reservation."""
+
+    def __init__(self, limiter, state, reserved, meter, concurrent=True):
+        self._limiter = limiter
+        self._state = state
+        self.reserved = reserved
+        self.meter = meter
+        self.concurrent = concurrent
+        self.released = False
+
+    def used(self):
+        return self.meter.prompt_tokens + self.meter.completion_tokens
+
+    def __call__(self):
+        self._limiter._release(self)
+
+    def headers(self):
+        return self._limiter._headers(self._state)
+
+
+class RateLimiter:
+    """Concurrency caps and request/token buckets per user."""
+
+    def __init__(self):
+        self._keys = {}
+        self._lock = threading.Lock()
+
+    def _state(self, user):
+        state = self._keys.get(user)
+        if state is None:
+            state = self._keys[user] = _KeyState(limits_for(user))
+        return state
+
+    def admit(self, user, meter, max_tokens, concurrent=True):
+        """Reserve a request for `user`; returns (Lease, None) or (None, Rejection).
+
+        The prompt tokens of `meter` plus `max_tokens` are taken from the
+        token bucket; what the meter has counted when the lease is released
+        is charged. Without `concurrent` the request does not count against
+        the key's concurrency cap.
+        """
+        tokens = meter.prompt_tokens + max_tokens
+        now = time.monotonic()
+        with self._lock:
+            state = self._state(user)
+            limits = state.limits
+
+            if concurrent and state.open >= limits.concurrency:
+                state.rejected["concurrency"] += 1
+                return None, Rejection(
+                    "concurrency",
+                    f"Too many concurrent requests for this key: limit {limits.concurrency}",
+                    1,
+                )
+
+            wait = state.requests.take(1, now)
+            if wait:
+                state.rejected["requests"] += 1
+                return None, Rejection(
+                    "requests",
+                    f"Rate limit reached for requests: limit {limits.rpm} per minute",
+                    max(1, math.ceil(wait)),
+                )
+
+            wait = state.tokens.take(tokens, now)
+            if wait:
+                state.requests.give(1)
+                state.rejected["tokens"] += 1
+                return None, Rejection(
+                    "tokens",
+                    f"Rate limit reached for tokens: limit {limits.tpm} per minute, requested {tokens}",
+                    max(1, math.ceil(wait)),
+                )
+
+            if concurrent:
+                state.open += 1
+            state.admitted += 1
+            return Lease(self, state, min(tokens, state.tokens.capacity), meter, concurrent), None
+
+    def _release(self, lease):
+        with self._lock:
+            if lease.released:
+                return
+            lease.released = True
+            if lease.concurrent:
+                lease._state.open -= 1
+            used = lease.used()
+            if used < lease.reserved:
+                lease._state.tokens.give(lease.reserved - used)
+
+    def _headers(self, state):
+        now = time.monotonic()
+        with self._lock:
+            return {
+                "x-ratelimit-limit-requests": str(state.limits.rpm),
+                "x-ratelimit-remaining-requests": str(int(state.requests.level)),
+                "x-ratelimit-reset-requests": f"{state.requests.reset_after(now):.1f}s",
+                "x-ratelimit-limit-tokens": str(state.limits.tpm),
+                "x-ratelimit-remaining-tokens": str(int(state.tokens.level)),
+                "x-ratelimit-reset-tokens": f"{state.tokens.reset_after(now):.1f}s",
+            }
+
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": True,
+                "keys": {
+                    user: {
+                        "open": s.open,
+                        "admitted": s.admitted,
+                        "rejected": dict(s.rejected),
+                        "requests_remaining": int(s.requests.level),
+                        "tokens_remaining": int(s.tokens.level),
+                    }
+                    for user, s in self._keys.items()
+                },
+            }
+
+
+# =======================
+# WEIGHTED FAIR QUEUEING
+# =======================
+class _Waiter:
+    def __init__(self, wake):
+        self.wake = wake
+        self.granted = False
+        self.cancelled = False
+
+
+class FairScheduler:
+    """Shared upstream slots handed out in weighted-fair order when they run short."""
+
+    def __init__(self, slots):
+        self.slots = slots
+        self.in_use = 0
+        self._queue = []          # (finish tag, seq, user, waiter)
+        self._finish = {}         # user -> last finish tag
+        self._vtime = 0.0
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self.granted = {}
+        self.waited = {}
+        self.timeouts = {}
+
+    def _enqueue(self, user, weight, wake):
+        """Take a slot now (returns None) or queue a waiter for one."""
+        with self._lock:
+            if self.in_use < self.slots and not self._queue:
+                self.in_use += 1
+                self.granted[user] = self.granted.get(user, 0) + 1
+                return None
+            tag = max(self._vtime, self._finish.get(user, 0.0)) + 1.0 / weight
+            self._finish[user] = tag
+            waiter = _Waiter(wake)
+            heapq.heappush(self._queue, (tag, next(self._seq), user, waiter))
+            self.waited[user] = self.waited.get(user, 0) + 1
+            return waiter
+
+    def _dispatch(self):
+        """Hand free slots to the front of the queue. Called with the lock held."""
+        while self.in_use < self.slots and self._queue:
+            tag, _, user, waiter = heapq.heappop(self._queue)
+            if waiter.cancelled:
+                continue
+            self._vtime = tag
+            self.in_use += 1
+            self.granted[user] = self.granted.get(user, 0) + 1
+            waiter.granted = True
+            waiter.wake()
+
+    def _give_up(self, user, waiter):
+        """A waiter timed out; returns True if it got a slot after all."""
+        with self._lock:
+            if waiter.granted:
+                return True
+            waiter.cancelled = True
+            self.timeouts[user] = self.timeouts.get(user, 0) + 1
+            return False
+
+    def acquire(self, user, weight, timeout=FAIR_QUEUE_TIMEOUT):
+        """Wait for a slot; returns a release callable, or None on timeout."""
+        event = threading.Event()
+        waiter = self._enqueue(user, weight, event.set)
+        if waiter is not None and not event.wait(timeout) and not self._give_up(user, waiter):
+            return None
+        return self._releaser()
+
+    async def aacquire(self, user, weight, timeout=FAIR_QUEUE_TIMEOUT):
+        """Async counterpart of acquire()."""
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: ready.done() or ready.set_result(True))
+
+        waiter = self._enqueue(user, weight, wake)
+        if waiter is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(ready), timeout)
+            except asyncio.TimeoutError:
+                if not self._give_up(user, waiter):
+                    return None
+            except asyncio.CancelledError:
+                if self._give_up(user, waiter):
+                    self._release()
+                raise
+        return self._releaser()
+
+    def _releaser(self):
+        released = []
+
+        def release():
+            if not released:
+                released.append(True)
+                self._release()
+        return release
+
+    def _release(self):
+        with self._lock:
+            self.in_use -= 1
+            self._dispatch()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": True,
+                "slots": self.slots,
+                "in_use": self.in_use,
+                "waiting": sum(1 for *_, w in self._queue if not w.cancelled),
+                "granted": dict(self.granted),
+                "waited": dict(self.waited),
+                "timeouts": dict(self.timeouts),
+            }
+
+
+# =======================
+# ADMISSION
+# =======================
+class Admission:
+    """The limits one request holds, released together once its response is done."""
+
+    def __init__(self, user, lease=None, flow=None, weight=None):
+        self.user = user
+        self.lease = lease
+        # Who the request queues as for upstream slots, and at what weight
+        self.flow = flow or user
+        self.weight = weight or limits_for(user).weight
+        self._releases = [lease] if lease is not None else []
+
+    def headers(self):
+        return self.lease.headers() if self.lease is not None else {}
+
+    def acquire_slot(self, deadline=None, slots=1):
+        """Wait for `slots` upstream slots; returns False if they did not come free in time.
+
+        The wait is FAIR_QUEUE_TIMEOUT, or `deadline` seconds if that is sooner,
+        for all of them together. Slots already taken are kept for release().
+        """
+        if fair_scheduler is None:
+            return True
+        timeout = FAIR_QUEUE_TIMEOUT if deadline is None else min(FAIR_QUEUE_TIMEOUT, deadline)
+        give_up = time.monotonic() + timeout
+        for _ in range(slots):
+            left = max(0.0, give_up - time.monotonic())
+            release = fair_scheduler.acquire(self.flow, self.weight, left)
+            if release is None:
+                return False
+            self._releases.append(release)
+        return True
+
+    async def aacquire_slot(self, deadline=None, slots=1):
+        if fair_scheduler is None:
+            return True
+        timeout = FAIR_QUEUE_TIMEOUT if deadline is None else min(FAIR_QUEUE_TIMEOUT, deadline)
+        give_up = time.monotonic() + timeout
+        for _ in range(slots):
+            left = max(0.0, give_up - time.monotonic())
+            release = await fair_scheduler.aacquire(self.flow, self.weight, left)
+            if release is None:
+                return False
+            self._releases.append(release)
+        return True
+
+    def release(self):
+        for release in self._releases:
+            release()
+
+    def guard(self, tokens):
+        """Pass `tokens` through, releasing once the stream ends or is dropped."""
+        def guarded():
+            try:
+                for token in tokens:
+                    yield token
+            finally:
+                self.release()
+
+        stream = guarded()
+        weakref.finalize(stream, self.release)
+        return stream
+
+    def aguard(self, tokens):
+        """Async counterpart of guard()."""
+        async def guarded():
+            try:
+                async for token in tokens:
+                    yield token
+            finally:
+                self.release()
+                if hasattr(tokens, "aclose"):
+                    await tokens.aclose()
+
+        stream = guarded()
+        weakref.finalize(stream, self.release)
+        return stream
+
+
+def admit(user, meter, max_tokens, batch=False):
+    """Admit a request under `user`'s limits; returns (Admission, None) or (None, Rejection).
+
+    `meter` is the request's tokens.UsageMeter, or its choices.Choices when `n` > 1.
+    A `batch` line is charged to the key's request and token buckets but not
+    its concurrency cap, which is for interactive requests; the batch
+    workers bound it instead. It queues for upstream slots as a flow of its
+    own at weight 1, so batches never take from the key's interactive share.
+    """
+    flow, weight = (f"{user}/batch", 1) if batch else (None, None)
+    if rate_limiter is None:
+        return Admission(user, flow=flow, weight=weight), None
+    max_tokens = max_tokens if isinstance(max_tokens, int) else 0
+    lease, rejection = rate_limiter.admit(user, meter, max_tokens, concurrent=not batch)
+    if rejection is not None:
+        return None, rejection
+    return Admission(user, lease, flow, weight), None
+
+
+def rate_limit_error(rejection):
+    return {
+        "error": {
+            "message": rejection.message,
+            "type": rejection.kind,
+            "param": None,
+            "code": "rate_limit_exceeded"
+        }
+    }
+
+
+def slot_timeout_rejection():
+    return Rejection(
+        "requests",
+        f"Upstream capacity is exhausted; no slot became free within {FAIR_QUEUE_TIMEOUT:g}s",
+        1,
+    )
+
+
+rate_limiter = RateLimiter() if ENABLED else None
+fair_scheduler = FairScheduler(UPSTREAM_SLOTS) if UPSTREAM_SLOTS > 0 else None
@@ -0,0 +1,51 @@
+import time
+import uuid
+
+
+def new_completion_id():
+    return f"gen-{int(time.time())}-{uuid.uuid4().hex[:20]}"
+
+
+def completion_chunk(completion_id, created, model_name, delta, finish_reason=None):
+    """One `chat.completion.chunk` object for the SSE stream."""
+    return {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": created,
+        "model": model_name,
+        "choices": [{
+            "index": 0,
+            "delta": delta,
+            "finish_reason": finish_reason
+        }]
+    }
+
+
+async def aiter_tokens(tokens):
+    """Async iterator over an in-memory token list."""
+    for token in tokens:
+        yield token
+
+
+def completion_body(model_name, assistant_text, usage, finish_reason="stop"):
+    """Full non-stream `chat.completion` response; `usage` as from tokens.UsageMeter.usage()."""
+    return choices_body(model_name, [(assistant_text, finish_reason)], usage)
+
+
+def choices_body(model_name, choices, usage):
+    """completion_body() with one choice per (assistant text, finish reason) in `choices`."""
+    return {
+        "id": new_completion_id(),
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model_name,
+        "choices": [{
+            "index": index,
+            "message": {
+                "role": "assistant",
+                "content": assistant_text
+            },
+            "finish_reason": finish_reason
+        } for index, (assistant_text, finish_reason) in enumerate(choices)],
+        "usage": {**usage, "cost": 0}
+    }
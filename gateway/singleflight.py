@@ -0,0 +1,245 @@
+"""
+Single-flight coalescing of identical in-flight completions.
+
+The first request for a key starts one upstream job and a pump (a thread in
+the Flask app, a task in the ASGI app) that copies its tokens into a shared
+buffer. Every request for that key, the first included, reads the buffer:
+late arrivals get the tokens produced so far and then the live tail. Joining
+waits for the first token, so a job that fails before streaming (saturated
+replicas, a timeout) raises from join() like a direct call would, before any
+response has started. Each reader waits under its own request budget, so a
+follower times out on its own deadline while the job goes on for the others.
+If every reader goes away before the job finishes, the pump stops and the
+upstream stream is closed.
+
+    SINGLE_FLIGHT   "0" disables coalescing
+"""
+import asyncio
+import contextvars
+import os
+import threading
+
+
+ENABLED = os.environ.get("SINGLE_FLIGHT", "1") != "0"
+
+
+class _Flight:
+    def __init__(self):
+        self.tokens = []
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+
+
+class _Stats:
+    def __init__(self):
+        self.flights = 0
+        self.coalesced = 0
+
+    def as_dict(self, in_flight):
+        total = self.flights + self.coalesced
+        return {
+            "enabled": True,
+            "in_flight": in_flight,
+            "flights": self.flights,
+            "coalesced": self.coalesced,
+            "coalesced_ratio": round(self.coalesced / total, 4) if total else 0.0,
+        }
+
+
+class SingleFlight:
+    """Thread-based coalescer for the blocking app."""
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+        self._stats = _Stats()
+
+    def join(self, key, start, on_complete=None, budget=None):
+        """Return a token iterator for `key`, starting `start()` if nothing is in flight.
+
+        `start` returns the upstream token iterator. `on_complete(tokens)` runs
+        once, in the pump, if the upstream stream finishes cleanly. Blocks until
+        the flight has a token or has ended, and raises its error if it ended
+        without producing any. `budget` is the caller's deadlines.Budget: waits
+        on the flight raise its UpstreamTimeout once it runs out.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight()
+                flight.cond = threading.Condition()
+                self._stats.flights += 1
+                leader = True
+            else:
+                self._stats.coalesced += 1
+                leader = False
+            flight.subscribers += 1
+
+        if leader:
+            # The pump runs in the caller's context, so start() sees its request deadline
+            context = contextvars.copy_context()
+            threading.Thread(
+                target=context.run, args=(self._pump, key, flight, start, on_complete), daemon=True
+            ).start()
+
+        with flight.cond:
+            try:
+                self._wait(flight, 0, budget)
+            except BaseException:
+                flight.subscribers -= 1
+                raise
+            failed = not flight.tokens and flight.error is not None
+            if failed:
+                flight.subscribers -= 1
+        if failed:
+            raise flight.error
+        return self._follow(flight, budget)
+
+    def _pump(self, key, flight, start, on_complete):
+        upstream = None
+        try:
+            upstream = start()
+            for token in upstream:
+                with flight.cond:
+                    flight.tokens.append(token)
+                    flight.cond.notify_all()
+                    if flight.subscribers == 0:
+                        break
+            else:
+                if on_complete is not None:
+                    on_complete(list(flight.tokens))
+        except Exception as e:
+            flight.error = e
+        finally:
+            if hasattr(upstream, "close"):
+                upstream.close()
+            with self._lock:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+            with flight.cond:
+                flight.done = True
+                flight.cond.notify_all()
+
+    @staticmethod
+    def _wait(flight, seen, budget):
+        """Under flight.cond, wait for tokens past `seen` or the end of the flight."""
+        while seen >= len(flight.tokens) and not flight.done:
+            # Without a budget the wait has no timeout
+            if not flight.cond.wait(budget.wait() if budget is not None else None):
+                budget.check()
+
+    def _follow(self, flight, budget):
+        i = 0
+        try:
+            while True:
+                with flight.cond:
+                    self._wait(flight, i, budget)
+                    chunk = flight.tokens[i:]
+                    finished = flight.done
+
+                i += len(chunk)
+                if chunk and budget is not None:
+                    budget.token()
+                yield from chunk
+
+                if finished:
+                    if flight.error is not None:
+                        raise flight.error
+                    return
+        finally:
+            with flight.cond:
+                flight.subscribers -= 1
+
+    def stats(self):
+        with self._lock:
+            return self._stats.as_dict(len(self._flights))
+
+
+class AsyncSingleFlight:
+    """Task-based coalescer for the asyncio app. Lives on one event loop."""
+
+    def __init__(self):
+        self._flights = {}
+        self._stats = _Stats()
+
+    async def join(self, key, start, on_complete=None, budget=None):
+        """Async counterpart of SingleFlight.join(); `start` is a coroutine function."""
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._flights[key] = _Flight()
+            flight.changed = asyncio.Event()
+            flight.task = asyncio.create_task(self._pump(key, flight, start, on_complete))
+            self._stats.flights += 1
+        else:
+            self._stats.coalesced += 1
+        flight.subscribers += 1
+
+        try:
+            await self._wait(flight, 0, budget)
+        except BaseException:
+            self._leave(flight)
+            raise
+        if not flight.tokens and flight.error is not None:
+            self._leave(flight)
+            raise flight.error
+        return self._follow(flight, budget)
+
+    async def _pump(self, key, flight, start, on_complete):
+        upstream = None
+        try:
+            upstream = await start()
+            async for token in upstream:
+                flight.tokens.append(token)
+                flight.changed.set()
+            if on_complete is not None:
+                on_complete(list(flight.tokens))
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            flight.error = e
+        finally:
+            if hasattr(upstream, "aclose"):
+                await upstream.aclose()
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            flight.done = True
+            flight.changed.set()
+
+    @staticmethod
+    async def _wait(flight, seen, budget):
+        """Wait for tokens past `seen` or the end of the flight."""
+        while seen >= len(flight.tokens) and not flight.done:
+            flight.changed.clear()
+            try:
+                await asyncio.wait_for(flight.changed.wait(), budget.wait() if budget is not None else None)
+            except asyncio.TimeoutError:
+                budget.check()
+
+    async def _follow(self, flight, budget):
+        i = 0
+        try:
+            while True:
+                await self._wait(flight, i, budget)
+
+                chunk = flight.tokens[i:]
+                i += len(chunk)
+                if chunk and budget is not None:
+                    budget.token()
+                for token in chunk:
+                    yield token
+
+                if flight.done and i >= len(flight.tokens):
+                    if flight.error is not None:
+                        raise flight.error
+                    return
+        finally:
+            self._leave(flight)
+
+    def _leave(self, flight):
+        flight.subscribers -= 1
+        if flight.subscribers == 0 and not flight.done:
+            flight.task.cancel()
+
+    def stats(self):
+        return self._stats.as_dict(len(self._flights))
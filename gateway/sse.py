@@ -0,0 +1,303 @@
+"""
+Server-sent event framing for streamed chat completions.
+
+ChunkEncoder renders the fixed part of a `chat.completion.chunk` (id, object,
+created, model, choice index) once per response, so each token costs one
+string escape and two byte concatenations instead of building a dict and
+running json.dumps on it.
+
+Coalescing is opt-in. The first token is always sent on its own. After that,
+tokens are buffered and sent as one chunk every SSE_COALESCE_MS
+milliseconds, or sooner once SSE_COALESCE_BYTES bytes are waiting. That means
+fewer frames, writes and proxy flushes, at the cost of up to one interval of
+extra latency per token.
+
+When the request sets `stream_options.include_usage`, a last chunk with empty
+`choices` and the token `usage` follows the finish chunk, as OpenAI sends it.
+
+With `n` > 1 every choice gets its role chunk up front, then content chunks
+with its `index` as its tokens arrive, and its finish chunk once all of them
+are done. Such streams are not coalesced.
+
+A stream that fails after its headers are sent (a timeout, saturated
+replicas, any other upstream error) sends an OpenAI-style error event and
+`[DONE]` instead of the finish chunk. Either way, or when the client goes
+away, the token stream is closed, which closes the upstream call.
+
+    SSE_COALESCE_MS     flush interval in milliseconds (0: one frame per token)
+    SSE_COALESCE_BYTES  flush early once this many bytes are buffered (1024)
+"""
+import asyncio
+import json
+import os
+import queue
+import threading
+import time
+from json.encoder import encode_basestring_ascii
+
+from .responses import new_completion_id
+from .admission import upstream_error
+
+
+COALESCE_MS = float(os.environ.get("SSE_COALESCE_MS", 0))
+COALESCE_BYTES = int(os.environ.get("SSE_COALESCE_BYTES", 1024))
+
+DONE = b"data: [DONE]\n\n"
+
+
+class ChunkEncoder:
+    """Byte templates for the chunks of one streamed completion."""
+
+    def __init__(self, completion_id, created, model_name, index=0):
+        fixed = json.dumps(
+            {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model_name},
+            separators=(",", ":"),
+        )
+        self._fixed = f"data: {fixed[:-1]}".encode()
+        self._head = self._fixed + f',"choices":[{{"index":{index},"delta":'.encode()
+        self._content_head = self._head + b'{"content":'
+        self._content_tail = b'},"finish_reason":null}]}\n\n'
+
+    def role(self, role="assistant"):
+        return self._head + b'{"role":' + encode_basestring_ascii(role).encode() + self._content_tail
+
+    def content(self, token):
+        return self._content_head + encode_basestring_ascii(token).encode() + self._content_tail
+
+    def finish(self, finish_reason="stop"):
+        return self._head + b'{},"finish_reason":' + json.dumps(finish_reason).encode() + b"}]}\n\n"
+
+    def usage(self, usage):
+        return self._fixed + b',"choices":[],"usage":' + json.dumps(usage, separators=(",", ":")).encode() + b"}\n\n"
+
+
+def error_event(body):
+    return b"data: " + json.dumps(body, separators=(",", ":")).encode() + b"\n\n"
+
+
+# =======================
+# COALESCING
+# =======================
+class _Failed:
+    def __init__(self, error):
+        self.error = error
+
+
+_END = object()
+
+
+def coalesce(tokens, interval, max_bytes=COALESCE_BYTES):
+    """Yield the first token alone, then the rest joined per `interval` seconds or `max_bytes`.
+
+    A pump thread reads the upstream so a flush can happen while the next
+    token is still on its way. Closing the coalesced stream stops the pump
+    and returns once it has closed the upstream; a generator can only be
+    closed by the thread running it, so that waits out the token in flight.
+    """
+    pending = queue.Queue()
+    stop = threading.Event()
+
+    def pump():
+        try:
+            for token in tokens:
+                pending.put(token)
+                if stop.is_set():
+                    break
+        except Exception as e:
+            pending.put(_Failed(e))
+        finally:
+            if hasattr(tokens, "close"):
+                tokens.close()
+            pending.put(_END)
+
+    pumping = threading.Thread(target=pump, daemon=True)
+    pumping.start()
+
+    buffered, size, deadline, first = [], 0, 0.0, True
+    try:
+        while True:
+            try:
+                item = pending.get(timeout=max(0.0, deadline - time.monotonic()) if buffered else None)
+            except queue.Empty:
+                yield "".join(buffered)
+                buffered, size = [], 0
+                continue
+
+            if item is _END:
+                break
+            if isinstance(item, _Failed):
+                raise item.error
+            if first:
+                first = False
+                yield item
+                continue
+
+            if not buffered:
+                deadline = time.monotonic() + interval
+            buffered.append(item)
+            size += len(item.encode())
+            if size >= max_bytes:
+                yield "".join(buffered)
+                buffered, size = [], 0
+
+        if buffered:
+            yield "".join(buffered)
+    finally:
+        stop.set()
+        pumping.join()
+
+
+async def acoalesce(tokens, interval, max_bytes=COALESCE_BYTES):
+    """Async counterpart of coalesce(); waits on the next token with a deadline."""
+    upstream = tokens.__aiter__()
+    loop = asyncio.get_running_loop()
+    step = None
+    buffered, size, deadline, first = [], 0, 0.0, True
+    try:
+        while True:
+            if step is None:
+                step = asyncio.ensure_future(upstream.__anext__())
+            timeout = max(0.0, deadline - loop.time()) if buffered else None
+            done, _ = await asyncio.wait({step}, timeout=timeout)
+            if not done:
+                yield "".join(buffered)
+                buffered, size = [], 0
+                continue
+
+            finished, step = step, None
+            try:
+                token = finished.result()
+            except StopAsyncIteration:
+                break
+            if first:
+                first = False
+                yield token
+                continue
+
+            if not buffered:
+                deadline = loop.time() + interval
+            buffered.append(token)
+            size += len(token.encode())
+            if size >= max_bytes:
+                yield "".join(buffered)
+                buffered, size = [], 0
+
+        if buffered:
+            yield "".join(buffered)
+    finally:
+        if step is not None:
+            step.cancel()
+            await asyncio.wait({step})
+        if hasattr(upstream, "aclose"):
+            await upstream.aclose()
+
+
+# =======================
+# STREAMS
+# =======================
+def sse_stream(tokens, model_name, coalesce_ms=COALESCE_MS, coalesce_bytes=COALESCE_BYTES, usage=None,
+               finish_reason=None):
+    """Frame an iterable of tokens as an OpenAI-style SSE byte stream.
+
+    `usage` and `finish_reason`, if given, are called once the tokens run
+    out: the first for the dict sent in a usage chunk, the second for the
+    finish reason ("stop" otherwise).
+    """
+    encoder = ChunkEncoder(new_completion_id(), int(time.time()), model_name)
+    yield encoder.role()
+
+    if coalesce_ms > 0:
+        tokens = coalesce(tokens, coalesce_ms / 1000, coalesce_bytes)
+    try:
+        for token in tokens:
+            yield encoder.content(token)
+    except Exception as e:
+        yield error_event(upstream_error(e))
+        yield DONE
+        return
+    finally:
+        if hasattr(tokens, "close"):
+            tokens.close()
+
+    yield encoder.finish(finish_reason() if finish_reason is not None else "stop")
+    if usage is not None:
+        yield encoder.usage(usage())
+    yield DONE
+
+
+async def asse_stream(tokens, model_name, coalesce_ms=COALESCE_MS, coalesce_bytes=COALESCE_BYTES, usage=None,
+                      finish_reason=None):
+    """Async counterpart of sse_stream() over an async iterable of tokens."""
+    encoder = ChunkEncoder(new_completion_id(), int(time.time()), model_name)
+    yield encoder.role()
+
+    if coalesce_ms > 0:
+        tokens = acoalesce(tokens, coalesce_ms / 1000, coalesce_bytes)
+    try:
+        async for token in tokens:
+            yield encoder.content(token)
+    except Exception as e:
+        yield error_event(upstream_error(e))
+        yield DONE
+        return
+    finally:
+        if hasattr(tokens, "aclose"):
+            await tokens.aclose()
+
+    yield encoder.finish(finish_reason() if finish_reason is not None else "stop")
+    if usage is not None:
+        yield encoder.usage(usage())
+    yield DONE
+
+
+def sse_choices(events, model_name, n, usage=None, finish_reason=None):
+    """sse_stream() for `n` choices from an iterable of (index, token).
+
+    `finish_reason(index)`, if given, returns the finish reason of a choice.
+    """
+    completion_id, created = new_completion_id(), int(time.time())
+    encoders = [ChunkEncoder(completion_id, created, model_name, index) for index in range(n)]
+    for encoder in encoders:
+        yield encoder.role()
+
+    try:
+        for index, token in events:
+            yield encoders[index].content(token)
+    except Exception as e:
+        yield error_event(upstream_error(e))
+        yield DONE
+        return
+    finally:
+        if hasattr(events, "close"):
+            events.close()
+
+    for index, encoder in enumerate(encoders):
+        yield encoder.finish(finish_reason(index) if finish_reason is not None else "stop")
+    if usage is not None:
+        yield encoders[0].usage(usage())
+    yield DONE
+
+
+async def asse_choices(events, model_name, n, usage=None, finish_reason=None):
+    """Async counterpart of sse_choices()."""
+    completion_id, created = new_completion_id(), int(time.time())
+    encoders = [ChunkEncoder(completion_id, created, model_name, index) for index in range(n)]
+    for encoder in encoders:
+        yield encoder.role()
+
+    try:
+        async for index, token in events:
+            yield encoders[index].content(token)
+    except Exception as e:
+        yield error_event(upstream_error(e))
+        yield DONE
+        return
+    finally:
+        if hasattr(events, "aclose"):
+            await events.aclose()
+
+    for index, encoder in enumerate(encoders):
+        yield encoder.finish(finish_reason(index) if finish_reason is not None else "stop")
+    if usage is not None:
+        yield encoders[0].usage(usage())
+    yield DONE
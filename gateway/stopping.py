@@ -0,0 +1,129 @@
+"""
+Gateway-side max_tokens and stop sequences.
+
+Providers are asked to keep to max_tokens in their system prompt, but
+nothing holds the model to it, and the Spaces have no notion of `stop`.
+Completion sits on the token stream of every provider and ends it itself:
+
+    length  when a chunk would take the reply past max_tokens tokens
+            (counted by the request's UsageMeter), it is cut at the limit
+            and the stream ends
+    stop    at the first stop sequence, which is left out of the reply.
+            Text that could be the start of a stop sequence is held back
+            until the next chunk shows whether it is one, so matches across
+            chunk boundaries are found
+
+Either way the upstream stream is closed at once, which cancels the Gradio
+job or stops the conversation and frees the Space for the next call.
+"""
+import re
+
+
+MAX_STOP_SEQUENCES = 4
+
+
+def stop_sequences(value):
+    """The `stop` parameter as a tuple of strings; raises ValueError if malformed."""
+    if value is None:
+        return ()
+    if isinstance(value, str):
+        value = [value]
+    if not isinstance(value, list) or not all(isinstance(s, str) for s in value):
+        raise ValueError("'stop' must be a string or a list of strings")
+    if len(value) > MAX_STOP_SEQUENCES:
+        raise ValueError(f"'stop' accepts at most {MAX_STOP_SEQUENCES} sequences")
+    return tuple(s for s in value if s)
+
+
+class Completion:
+    """Ends one token stream at max_tokens or a stop sequence; `finish_reason` says which."""
+
+    def __init__(self, meter, max_tokens=None, stop=()):
+        self.meter = meter
+        self.max_tokens = max_tokens if isinstance(max_tokens, int) and max_tokens > 0 else None
+        self.stop = stop
+        self.finish_reason = "stop"
+        self._held = ""
+        self._hold = max((len(s) for s in stop), default=1) - 1
+        self._stop = re.compile("|".join(map(re.escape, stop))) if stop else None
+
+    def _split(self, text):
+        """(text to send, whether a stop sequence was hit); keeps a possible partial match."""
+        text = self._held + text
+        self._held = ""
+        if self._stop is None:
+            return text, False
+        hit = self._stop.search(text)
+        if hit is not None:
+            return text[:hit.start()], True
+        for k in range(min(self._hold, len(text)), 0, -1):
+            tail = text[-k:]
+            if any(s.startswith(tail) for s in self.stop):
+                self._held = tail
+                return text[:-k], False
+        return text, False
+
+    def _take(self, text):
+        """Count `text`; returns the part within max_tokens and whether some was cut."""
+        if self.max_tokens is None or not text:
+            self.meter.feed(text)
+            return text, False
+        if self.meter.peek(text) > self.max_tokens:
+            lo, hi = 0, len(text)
+            while lo < hi:
+                mid = (lo + hi + 1) // 2
+                if self.meter.peek(text[:mid]) <= self.max_tokens:
+                    lo = mid
+                else:
+                    hi = mid - 1
+            self.meter.feed(text[:lo])
+            return text[:lo], True
+        self.meter.feed(text)
+        return text, False
+
+    def _step(self, token):
+        """(text to send, whether the stream is finished) for one upstream token."""
+        text, stopped = self._split(token)
+        text, full = self._take(text)
+        if full:
+            self.finish_reason = "length"
+        return text, stopped or full
+
+    def _flush(self):
+        text, _ = self._take(self._held)
+        self._held = ""
+        if self.max_tokens is not None and self.meter.completion_tokens >= self.max_tokens:
+            self.finish_reason = "length"
+        return text
+
+    def limit(self, tokens):
+        """Pass `tokens` through up to max_tokens or a stop sequence, then close them."""
+        try:
+            for token in tokens:
+                text, done = self._step(token)
+                if text:
+                    yield text
+                if done:
+                    return
+            text = self._flush()
+            if text:
+                yield text
+        finally:
+            if hasattr(tokens, "close"):
+                tokens.close()
+
+    async def alimit(self, tokens):
+        """Async counterpart of limit()."""
+        try:
+            async for token in tokens:
+                text, done = self._step(token)
+                if text:
+                    yield text
+                if done:
+                    return
+            text = self._flush()
+            if text:
+                yield text
+        finally:
+            if hasattr(tokens, "aclose"):
+                await tokens.aclose()
@@ -0,0 +1,233 @@
+"""
+Token accounting.
+
+Prompt and completion tokens are counted with the tokenizer of the model's
+family (a provider names it in its `tokenizer_family` attribute: "qwen",
+"cohere", "gpt-oss"). Tokenizers are loaded offline, once, from
+TOKENIZER_DIR/<family>/tokenizer.json with the `tokenizers` library. Another
+loader can be plugged in with register_tokenizer(). If the library or the
+file is missing, an approximate counter is used, and the tokenizer names
+itself "approximate" in /stats/tokens.
+
+Prompt counts are memoized per message by a hash of its role and content,
+so a long history sent again on every turn is only tokenized once. Chat
+template tokens are added per message and for the reply header.
+
+Completion tokens are counted incrementally as the stream passes. Text is
+cut where a run of whitespace starts, a boundary BPE pre-tokenizers split at
+anyway, so the pieces add up to the count for the whole reply. Text without
+whitespace (CJK, long URLs) is cut once more than 2 * PENDING_CHARS of it
+waits, keeping the last PENDING_CHARS; such a cut may be off by a token, but
+keeps the work per streamed token bounded.
+
+    TOKENIZER_DIR       directory of <family>/tokenizer.json files (./tokenizers)
+    TOKEN_COUNT_CACHE   memoized message counts (16384)
+"""
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+
+try:
+    from tokenizers import Tokenizer as _HFTokenizer
+except ImportError:
+    _HFTokenizer = None
+
+
+TOKENIZER_DIR = os.environ.get("TOKENIZER_DIR", os.path.join(os.getcwd(), "tokenizers"))
+COUNT_CACHE_SIZE = int(os.environ.get("TOKEN_COUNT_CACHE", 16384))
+
+# Chat template tokens per message and for the reply header, by family
+TEMPLATE_OVERHEAD = {
+    "qwen": (5, 3),      # <|im_start|>role\n ... <|im_end|>\n
+    "cohere": (3, 3),    # <|START_OF_TURN_TOKEN|><|USER_TOKEN|> ... <|END_OF_TURN_TOKEN|>
+    "gpt-oss": (4, 3),   # <|start|>role<|message|> ... <|end|>
+}
+DEFAULT_OVERHEAD = (4, 3)
+
+# Characters of a completion kept uncounted when there is no whitespace to cut at
+PENDING_CHARS = 256
+
+
+# =======================
+# TOKENIZERS
+# =======================
+_PIECES = re.compile(r"\s*[^\W\d_]+|\s*\d{1,3}|\s*[^\w\s]+|\s+")
+
+
+class ApproximateTokenizer:
+    """BPE-like estimate: words and digit runs split the way BPE pre-tokenizers do, long words ~4 chars a token."""
+
+    name = "approximate"
+
+    def count(self, text):
+        return sum(max(1, (len(piece.strip()) + 1) // 4) for piece in _PIECES.findall(text))
+
+
+class FileTokenizer:
+    """A `tokenizers` tokenizer.json loaded from disk."""
+
+    def __init__(self, path):
+        self.name = path
+        self._tokenizer = _HFTokenizer.from_file(path)
+
+    def count(self, text):
+        return len(self._tokenizer.encode(text, add_special_tokens=False).ids)
+
+
+def _from_dir(family):
+    path = os.path.join(TOKENIZER_DIR, family, "tokenizer.json")
+    if _HFTokenizer is None or not os.path.exists(path):
+        return None
+    return FileTokenizer(path)
+
+
+_loaders = {}
+_tokenizers = {}
+_lock = threading.Lock()
+
+
+def register_tokenizer(family, loader):
+    """Use `loader()` (returning an object with count(text)) for `family`."""
+    with _lock:
+        _loaders[family] = loader
+        _tokenizers.pop(family, None)
+
+
+def tokenizer_for(family):
+    """The tokenizer for `family`, loaded on first use."""
+    tokenizer = _tokenizers.get(family)
+    if tokenizer is None:
+        with _lock:
+            tokenizer = _tokenizers.get(family)
+            if tokenizer is None:
+                try:
+                    tokenizer = _loaders.get(family, _from_dir)(family) if family else None
+                except Exception as e:
+                    print("TOKENIZER ERROR:", family, e)
+                    tokenizer = None
+                tokenizer = _tokenizers[family] = tokenizer or ApproximateTokenizer()
+    return tokenizer
+
+
+# =======================
+# PROMPTS
+# =======================
+def _text(content):
+    if isinstance(content, list):
+        return "".join(part.get("text", "") for part in content if isinstance(part, dict))
+    return content if isinstance(content, str) else str(content or "")
+
+
+class _CountCache:
+    """LRU of message token counts keyed by family and content hash."""
+
+    def __init__(self, size):
+        self.size = size
+        self._counts = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def count(self, family, tokenizer, role, text):
+        key = (family, hashlib.blake2b(f"{role}\0{text}".encode(), digest_size=16).digest())
+        with self._lock:
+            n = self._counts.get(key)
+            if n is not None:
+                self._counts.move_to_end(key)
+                self.hits += 1
+                return n
+            self.misses += 1
+        n = tokenizer.count(role) + tokenizer.count(text)
+        with self._lock:
+            self._counts[key] = n
+            while len(self._counts) > self.size:
+                self._counts.popitem(last=False)
+        return n
+
+
+_message_counts = _CountCache(COUNT_CACHE_SIZE)
+
+
+def count_messages(family, messages):
+    """Prompt tokens of `messages` under `family`'s tokenizer and chat template."""
+    tokenizer = tokenizer_for(family)
+    per_message, reply = TEMPLATE_OVERHEAD.get(family, DEFAULT_OVERHEAD)
+    total = reply
+    for message in messages:
+        total += per_message + _message_counts.count(
+            family, tokenizer, message.get("role", ""), _text(message.get("content", ""))
+        )
+    return total
+
+
+# =======================
+# COMPLETIONS
+# =======================
+class UsageMeter:
+    """Token usage of one response: prompt counted up front, completion as it streams."""
+
+    def __init__(self, family, messages):
+        self.family = family
+        self.tokenizer = tokenizer_for(family)
+        self.prompt_tokens = count_messages(family, messages)
+        self._completion = 0
+        self._pending = ""
+
+    def feed(self, text):
+        """Count `text` as the next piece of the completion."""
+        pending = self._pending + text
+        cut = max(pending.rfind(" "), pending.rfind("\n"))
+        while cut > 0 and pending[cut - 1].isspace():
+            cut -= 1
+        if len(pending) - max(cut, 0) > 2 * PENDING_CHARS:
+            cut = len(pending) - PENDING_CHARS
+        if cut > 0:
+            self._completion += self.tokenizer.count(pending[:cut])
+            pending = pending[cut:]
+        self._pending = pending
+
+    def peek(self, text):
+        """Completion tokens there would be after feed(text)."""
+        return self._completion + self.tokenizer.count(self._pending + text)
+
+    @property
+    def completion_tokens(self):
+        return self._completion + (self.tokenizer.count(self._pending) if self._pending else 0)
+
+    def usage(self):
+        completion = self.completion_tokens
+        return {
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": completion,
+            "total_tokens": self.prompt_tokens + completion,
+        }
+
+    def count(self, tokens):
+        """Pass `tokens` through, counting them."""
+        for token in tokens:
+            self.feed(token)
+            yield token
+
+    async def acount(self, tokens):
+        async for token in tokens:
+            self.feed(token)
+            yield token
+
+
+def usage_meter(provider, messages):
+    return UsageMeter(getattr(provider, "tokenizer_family", None), messages)
+
+
+def stats():
+    with _lock:
+        loaded = {family or "default": t.name for family, t in _tokenizers.items()}
+    return {
+        "tokenizers": loaded,
+        "message_cache": {
+            "size": len(_message_counts._counts),
+            "hits": _message_counts.hits,
+            "misses": _message_counts.misses,
+        },
+    }
@@ -0,0 +1,26 @@
+import pytest
+
+from gateway.admission import REQUEST_TIMEOUT, client_timeout, request_timeout
+
+
+def test_header_wins_over_the_body_timeout():
+    assert client_timeout({"X-Request-Timeout": "30"}, {"timeout": 5}) == 30
+
+
+def test_no_timeout_falls_back_to_request_timeout():
+    assert client_timeout({}, {}) is None
+    assert request_timeout({}, {}) == REQUEST_TIMEOUT
+
+
+@pytest.mark.parametrize("value", [REQUEST_TIMEOUT * 10, float("inf")])
+def test_client_timeout_is_capped_at_request_timeout(value):
+    assert client_timeout({}, {"timeout": value}) == REQUEST_TIMEOUT
+
+
+@pytest.mark.parametrize("value", ["soon", "0", "-5", "nan", True, [30]])
+def test_timeout_that_is_not_a_positive_number_is_refused(value):
+    with pytest.raises(ValueError):
+        client_timeout({}, {"timeout": value})
+    if isinstance(value, str):
+        with pytest.raises(ValueError):
+            client_timeout({"X-Stainless-Timeout": value})
@@ -0,0 +1,96 @@
+from types import SimpleNamespace
+
+import pytest
+
+from gateway import cache
+from gateway.cache import CompletionCache, cache_key, cache_policy
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Wall clock of the cache module, moved by hand."""
+    now = SimpleNamespace(value=1_000_000.0)
+    monkeypatch.setattr(cache, "time", SimpleNamespace(time=lambda: now.value))
+    return now
+
+
+def messages(*contents):
+    return [{"role": "user", "content": c} for c in contents]
+
+
+# =======================
+# KEYS
+# =======================
+def test_key_ignores_surrounding_whitespace_and_extra_fields():
+    plain = cache_key("m", messages("hi"), 100)
+    padded = cache_key("m", [{"role": "user", "content": "  hi\n", "name": "x"}], 100)
+    assert plain == padded
+
+
+@pytest.mark.parametrize("other", [
+    ("n", messages("hi"), 100),
+    ("m", messages("hi"), 101),
+    ("m", messages("hello"), 100),
+    ("m", messages("hi", "hi"), 100),
+    ("m", [{"role": "system", "content": "hi"}], 100),
+])
+def test_key_changes_with_model_messages_and_max_tokens(other):
+    assert cache_key("m", messages("hi"), 100) != cache_key(*other)
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("", (True, True)),
+    ("max-age=0", (True, True)),
+    ("no-cache", (False, True)),
+    ("No-Cache, max-age=0", (False, True)),
+    ("no-store", (False, False)),
+    ("no-cache, no-store", (False, False)),
+])
+def test_cache_control_policy(header, expected):
+    assert cache_policy(header) == expected
+
+
+# =======================
+# ENTRIES
+# =======================
+def test_hit_returns_the_stored_chunks(clock):
+    c = CompletionCache(ttl=60)
+    c.put("k", "m", ["Hel", "lo"])
+    assert c.get("k", "m") == ["Hel", "lo"]
+    assert c.stats()["models"]["m"]["hits"] == 1
+
+
+def test_entry_expires_after_its_ttl(clock):
+    c = CompletionCache(ttl=60)
+    c.put("k", "m", ["a"])
+    clock.value += 59
+    assert c.get("k", "m") == ["a"]
+    clock.value += 1
+    assert c.get("k", "m") is None
+    assert c.stats()["entries"] == 0
+
+
+def test_empty_stream_is_not_stored(clock):
+    c = CompletionCache(ttl=60)
+    c.put("k", "m", [])
+    assert c.get("k", "m") is None
+
+
+def test_least_recently_used_entry_is_evicted_over_the_byte_budget(clock):
+    c = CompletionCache(ttl=60, max_bytes=2 * (cache.ENTRY_OVERHEAD + 1))
+    c.put("a", "m", ["a"])
+    c.put("b", "m", ["b"])
+    c.get("a", "m")
+    c.put("c", "m", ["c"])
+    assert c.get("b", "m") is None
+    assert c.get("a", "m") == ["a"]
+    assert c.get("c", "m") == ["c"]
+    assert c.stats()["evictions"] == 1
+
+
+def test_disk_tier_survives_a_new_cache_but_not_the_ttl(clock, tmp_path):
+    path = str(tmp_path / "cache.db")
+    CompletionCache(ttl=60, disk_path=path).put("k", "m", ["a", "b"])
+    assert CompletionCache(ttl=60, disk_path=path).get("k", "m") == ["a", "b"]
+    clock.value += 60
+    assert CompletionCache(ttl=60, disk_path=path).get("k", "m") is None
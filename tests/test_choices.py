@@ -0,0 +1,90 @@
+import asyncio
+import itertools
+import time
+
+import pytest
+
+from gateway.choices import Choices, choice_count
+
+
+class CharMeter:
+    prompt_tokens = 3
+
+    def __init__(self):
+        self.completion_tokens = 0
+
+    def feed(self, text):
+        self.completion_tokens += len(text)
+
+    def peek(self, text):
+        return self.completion_tokens + len(text)
+
+
+class Upstreams:
+    """One token stream per choice, each recording whether it was closed."""
+
+    def __init__(self, count=100, delay=0.02):
+        self.count = count
+        self.delay = delay
+        self.closed = []
+        self._ids = itertools.count()
+
+    def start(self):
+        return self.tokens(next(self._ids))
+
+    async def astart(self):
+        return self.atokens(next(self._ids))
+
+    def tokens(self, i):
+        try:
+            for _ in range(self.count):
+                time.sleep(self.delay)
+                yield "x"
+        finally:
+            self.closed.append(i)
+
+    async def atokens(self, i):
+        try:
+            for _ in range(self.count):
+                await asyncio.sleep(self.delay)
+                yield "x"
+        finally:
+            self.closed.append(i)
+
+
+def choices(n, max_tokens=None):
+    return Choices([CharMeter() for _ in range(n)], max_tokens)
+
+
+@pytest.mark.parametrize("value", [0, 9, "2", True, 1.5])
+def test_choice_count_rejects_malformed_values(value):
+    with pytest.raises(ValueError):
+        choice_count(value)
+
+
+def test_every_choice_streams_to_its_own_limit():
+    c = choices(3, max_tokens=4)
+    events = list(c.start(Upstreams(count=10, delay=0.001).start))
+    assert sorted(events) == sorted((i, "x") for i in range(3) for _ in range(4))
+    assert [c.finish_reason(i) for i in range(3)] == ["length"] * 3
+    assert c.usage()["completion_tokens"] == 12
+
+
+def test_closing_the_merged_stream_closes_every_choice():
+    upstreams = Upstreams()
+    events = choices(3).start(upstreams.start)
+    next(events)
+    events.close()
+    assert sorted(upstreams.closed) == [0, 1, 2]
+
+
+def test_closing_the_async_merged_stream_closes_every_choice():
+    upstreams = Upstreams()
+
+    async def main():
+        events = await choices(3).astart(upstreams.astart)
+        await events.__anext__()
+        await events.aclose()
+        return sorted(upstreams.closed)
+
+    assert asyncio.run(main()) == [0, 1, 2]
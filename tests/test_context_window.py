@@ -0,0 +1,27 @@
+from Provider import context_window
+from Provider.context_window import ContextWindow
+
+
+def window(budget):
+    w = ContextWindow("test", None, lambda role, content: f"{role}: {content}\n")
+    w.budget = budget
+    return w
+
+
+def history(count):
+    return [{"role": "user" if i % 2 else "assistant", "content": f"message {i:03d} " * 10} for i in range(count)]
+
+
+def test_history_is_trimmed_to_the_newest_messages_that_fit():
+    messages = history(40)
+    kept = window(600).keep(messages, 100)
+    assert context_window.PINNED_MESSAGES < len(kept) < len(messages)
+    assert kept == messages[-len(kept):]
+
+
+def test_unbounded_max_tokens_reserves_no_more_than_a_reply_budget():
+    w = window(context_window.REPLY_TOKENS + 500)
+    messages = history(40)
+    kept = w.keep(messages, 10_000_000_000)
+    assert len(kept) > context_window.PINNED_MESSAGES
+    assert kept == w.keep(messages, context_window.REPLY_TOKENS)
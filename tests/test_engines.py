@@ -0,0 +1,44 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+from Provider import make_workable
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tools"))
+
+import stress_engines  # noqa: E402
+
+CALLS = 48
+CONCURRENCY = 16
+
+
+@pytest.fixture(scope="module")
+def upstream():
+    return stress_engines.start_upstream()
+
+
+@pytest.fixture
+def models(upstream, monkeypatch):
+    """The shared engines, pointed at the echo upstream for one test."""
+    prefixes = {"command-a": "/c4ai", "Qwen3Omni": "/omni", "Qwen3VL": "/vl", "gpt-oss-120b": "/amd"}
+    for model, prefix in prefixes.items():
+        monkeypatch.setattr(make_workable(model), "endpoints", [upstream + prefix])
+    return list(prefixes)
+
+
+def failures(results):
+    return [(model, error) for model, error in results if error]
+
+
+def test_concurrent_calls_through_one_engine_do_not_share_sessions(models):
+    engines = {model: id(make_workable(model)) for model in models}
+    results = stress_engines.run_sync(models, CALLS, CONCURRENCY)
+    assert failures(results) == []
+    assert engines == {model: id(make_workable(model)) for model in models}
+
+
+def test_concurrent_async_calls_do_not_share_sessions(models):
+    results = asyncio.run(stress_engines.run_async(models, CALLS, CONCURRENCY, CALLS))
+    assert failures(results) == []
@@ -0,0 +1,64 @@
+import asyncio
+
+import pytest
+
+from Provider import deadlines, replicas
+from Provider.hedging import Hedger
+
+
+class Upstream:
+    """Token streams per URL that record whether they were closed."""
+
+    def __init__(self, failing):
+        self.failing = failing
+        self.closed = set()
+        self.go = asyncio.Event()
+
+    async def attempt(self, url):
+        await self.go.wait()
+        if url == self.failing:
+            raise deadlines.UpstreamTimeout("first_token")
+        return self.tokens(url)
+
+    async def tokens(self, url):
+        try:
+            yield "a"
+            yield "b"
+        finally:
+            self.closed.add(url)
+
+
+class FireOnce(Hedger):
+    """Hedges every call, and lets both legs finish in the same wakeup."""
+
+    def __init__(self, upstream):
+        super().__init__(budget=1.0)
+        self.upstream = upstream
+
+    def fire(self, model):
+        self.upstream.go.set()
+        return super().fire(model)
+
+
+@pytest.mark.parametrize("failing", ["primary", "hedge"])
+def test_hedge_leg_failing_after_the_other_finished_releases_both(monkeypatch, failing):
+    urls = [f"http://{failing}-primary.test", f"http://{failing}-hedge.test"]
+    upstream = Upstream(urls[0] if failing == "primary" else urls[1])
+    hedger = FireOnce(upstream)
+    hedger.delay("m")  # earns the hedge
+    monkeypatch.setattr(replicas, "hedger", hedger)
+
+    async def main():
+        try:
+            tokens = await replicas._ahedged(urls, upstream.attempt, urls[0], "m", 0.01)
+        except deadlines.UpstreamTimeout:
+            return None
+        text = "".join([token async for token in tokens])
+        await tokens.aclose()
+        return text
+
+    text = asyncio.run(main())
+    finished = urls[1] if failing == "primary" else urls[0]
+    assert text in (None, "ab")
+    assert finished in upstream.closed
+    assert [replicas.replica_table._get(url).in_flight for url in urls] == [0, 0]
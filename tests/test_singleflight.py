@@ -0,0 +1,155 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from gateway.singleflight import AsyncSingleFlight, SingleFlight
+from Provider import deadlines
+
+
+class Saturated(Exception):
+    retry_after = 3
+
+
+def slow_tokens(tokens, delay):
+    def stream():
+        for token in tokens:
+            time.sleep(delay)
+            yield token
+    return stream()
+
+
+async def aslow_tokens(tokens, delay):
+    for token in tokens:
+        await asyncio.sleep(delay)
+        yield token
+
+
+# =======================
+# THREADS
+# =======================
+def test_error_before_the_first_token_is_raised_from_join():
+    flight = SingleFlight()
+
+    def start():
+        raise Saturated("every replica is busy")
+
+    with pytest.raises(Saturated):
+        flight.join("k", start)
+    assert flight.stats()["in_flight"] == 0
+
+
+def test_error_after_the_first_token_is_raised_while_reading():
+    def start():
+        yield "a"
+        raise Saturated("dropped")
+
+    tokens = SingleFlight().join("k", start)
+    assert next(tokens) == "a"
+    with pytest.raises(Saturated):
+        next(tokens)
+
+
+def test_concurrent_joins_share_one_upstream_call():
+    flight = SingleFlight()
+    calls = []
+    completed = []
+
+    def start():
+        calls.append(1)
+        return slow_tokens(["a", "b", "c"], 0.05)
+
+    results = []
+    readers = [
+        threading.Thread(target=lambda: results.append(list(flight.join("k", start, completed.append))))
+        for _ in range(3)
+    ]
+    for reader in readers:
+        reader.start()
+    for reader in readers:
+        reader.join()
+
+    assert results == [["a", "b", "c"]] * 3
+    assert calls == [1]
+    assert completed == [["a", "b", "c"]]
+    assert flight.stats()["coalesced"] == 2
+
+
+def test_follower_times_out_on_its_own_budget():
+    flight = SingleFlight()
+    leader = []
+    reader = threading.Thread(target=lambda: leader.extend(flight.join("k", lambda: slow_tokens(["a", "b"], 0.3))))
+    reader.start()
+    time.sleep(0.05)
+
+    started = time.monotonic()
+    with pytest.raises(TimeoutError):
+        flight.join("k", lambda: None, budget=deadlines.Budget(0.1))
+    assert time.monotonic() - started < 0.25
+    reader.join()
+    assert leader == ["a", "b"]
+
+
+def test_follower_budget_also_bounds_later_tokens():
+    flight = SingleFlight()
+    flight.join("k", lambda: slow_tokens(["a", "b"], 0.3))
+    follower = flight.join("k", lambda: None, budget=deadlines.Budget(0.2))
+    assert next(follower) == "a"
+    with pytest.raises(deadlines.UpstreamTimeout):
+        next(follower)
+
+
+# =======================
+# ASYNCIO
+# =======================
+def test_async_error_before_the_first_token_is_raised_from_join():
+    async def main():
+        flight = AsyncSingleFlight()
+
+        async def start():
+            raise Saturated("every replica is busy")
+
+        with pytest.raises(Saturated):
+            await flight.join("k", start)
+        assert flight.stats()["in_flight"] == 0
+
+    asyncio.run(main())
+
+
+def test_async_joins_share_one_upstream_call():
+    async def main():
+        flight = AsyncSingleFlight()
+        calls = []
+
+        async def start():
+            calls.append(1)
+            return aslow_tokens(["a", "b"], 0.02)
+
+        async def read():
+            return [token async for token in await flight.join("k", start)]
+
+        results = await asyncio.gather(read(), read(), read())
+        assert results == [["a", "b"]] * 3
+        assert calls == [1]
+
+    asyncio.run(main())
+
+
+def test_async_follower_times_out_on_its_own_budget():
+    async def main():
+        flight = AsyncSingleFlight()
+
+        async def start():
+            return aslow_tokens(["a", "b"], 0.3)
+
+        async def read():
+            return [token async for token in await flight.join("k", start)]
+
+        leader = asyncio.create_task(read())
+        await asyncio.sleep(0.05)
+        with pytest.raises(TimeoutError):
+            await flight.join("k", start, budget=deadlines.Budget(0.1))
+        assert await leader == ["a", "b"]
+
+    asyncio.run(main())
@@ -0,0 +1,58 @@
+import asyncio
+import time
+
+from gateway.sse import acoalesce, coalesce
+
+
+class Upstream:
+    """Tokens that arrive every `delay` seconds and record whether the stream was closed."""
+
+    def __init__(self, count=100, delay=0.02):
+        self.count = count
+        self.delay = delay
+        self.closed = False
+
+    def tokens(self):
+        try:
+            for i in range(self.count):
+                time.sleep(self.delay)
+                yield f"t{i} "
+        finally:
+            self.closed = True
+
+    async def atokens(self):
+        try:
+            for i in range(self.count):
+                await asyncio.sleep(self.delay)
+                yield f"t{i} "
+        finally:
+            self.closed = True
+
+
+def test_coalesce_sends_the_first_token_alone_then_joins_the_rest():
+    upstream = Upstream(count=6, delay=0.01)
+    chunks = list(coalesce(upstream.tokens(), interval=1.0))
+    assert chunks == ["t0 ", "t1 t2 t3 t4 t5 "]
+    assert upstream.closed
+
+
+def test_closing_coalesce_mid_stream_closes_the_upstream():
+    upstream = Upstream()
+    chunks = coalesce(upstream.tokens(), interval=0.01)
+    assert next(chunks) == "t0 "
+    next(chunks)
+    chunks.close()
+    assert upstream.closed
+
+
+def test_closing_acoalesce_mid_stream_closes_the_upstream():
+    upstream = Upstream()
+
+    async def main():
+        chunks = acoalesce(upstream.atokens(), interval=0.01)
+        assert await chunks.__anext__() == "t0 "
+        await chunks.__anext__()
+        await chunks.aclose()
+        return upstream.closed
+
+    assert asyncio.run(main())
@@ -0,0 +1,119 @@
+import asyncio
+
+import pytest
+
+from gateway.stopping import Completion, stop_sequences
+
+
+class CharMeter:
+    """One token per character, so where max_tokens cuts is easy to see."""
+
+    def __init__(self):
+        self.completion_tokens = 0
+
+    def feed(self, text):
+        self.completion_tokens += len(text)
+
+    def peek(self, text):
+        return self.completion_tokens + len(text)
+
+
+class Upstream:
+    """A token stream that records whether it was closed."""
+
+    def __init__(self, tokens):
+        self._tokens = iter(tokens)
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._tokens)
+
+    def close(self):
+        self.closed = True
+
+
+def run(tokens, max_tokens=None, stop=()):
+    upstream = Upstream(tokens)
+    completion = Completion(CharMeter(), max_tokens, stop)
+    text = "".join(completion.limit(upstream))
+    return text, completion.finish_reason, upstream.closed
+
+
+# =======================
+# STOP PARAMETER
+# =======================
+def test_stop_sequences_accepts_a_string_or_a_list():
+    assert stop_sequences(None) == ()
+    assert stop_sequences("END") == ("END",)
+    assert stop_sequences(["a", "", "b"]) == ("a", "b")
+
+
+@pytest.mark.parametrize("value", [7, ["ok", 3], ["a", "b", "c", "d", "e"]])
+def test_stop_sequences_rejects_malformed_values(value):
+    with pytest.raises(ValueError):
+        stop_sequences(value)
+
+
+# =======================
+# MAX TOKENS
+# =======================
+def test_stream_under_the_limit_finishes_with_stop():
+    assert run(["abc", "de"], max_tokens=10) == ("abcde", "stop", True)
+
+
+def test_chunk_past_max_tokens_is_cut_at_the_limit():
+    assert run(["abc", "def", "ghi"], max_tokens=5) == ("abcde", "length", True)
+
+
+def test_reply_ending_exactly_at_max_tokens_is_a_length_finish():
+    assert run(["abc", "de"], max_tokens=5) == ("abcde", "length", True)
+
+
+@pytest.mark.parametrize("max_tokens", [None, 0, -1, "100"])
+def test_missing_or_invalid_max_tokens_does_not_limit(max_tokens):
+    assert run(["abc", "def"], max_tokens=max_tokens) == ("abcdef", "stop", True)
+
+
+# =======================
+# STOP SEQUENCES
+# =======================
+def test_stop_sequence_inside_a_chunk_ends_the_reply_without_it():
+    assert run(["Hello STOP world", "more"], stop=("STOP",)) == ("Hello ", "stop", True)
+
+
+def test_stop_sequence_split_across_chunks_is_found():
+    completion = Completion(CharMeter(), stop=("STOP",))
+    sent = list(completion.limit(Upstream(["Hello ST", "OP world"])))
+    assert sent == ["Hello "]
+
+
+def test_held_back_prefix_is_released_when_it_is_not_a_stop():
+    text, finish_reason, _ = run(["Hello ST", "ILL here"], stop=("STOP",))
+    assert (text, finish_reason) == ("Hello STILL here", "stop")
+
+
+def test_held_back_prefix_is_flushed_at_the_end_of_the_stream():
+    assert run(["abc S"], stop=("STOP",))[0] == "abc S"
+
+
+def test_first_of_several_stop_sequences_wins():
+    assert run(["one. two\nthree"], stop=("\n", "."))[0] == "one"
+
+
+def test_stop_sequence_after_the_limit_is_a_length_finish():
+    assert run(["abcdefgh", "STOP"], max_tokens=4, stop=("STOP",)) == ("abcd", "length", True)
+
+
+def test_alimit_matches_limit():
+    async def tokens():
+        for token in ["Hello ST", "OP world"]:
+            yield token
+
+    async def collect():
+        completion = Completion(CharMeter(), 3, ("STOP",))
+        return "".join([t async for t in completion.alimit(tokens())]), completion.finish_reason
+
+    assert asyncio.run(collect()) == ("Hel", "length")
@@ -0,0 +1,40 @@
+import pytest
+
+from gateway import tokens
+from gateway.tokens import ApproximateTokenizer, UsageMeter, register_tokenizer
+
+
+class WidestCount(ApproximateTokenizer):
+    """The approximate tokenizer, remembering the longest text it was asked to count."""
+
+    widest = 0
+
+    def count(self, text):
+        WidestCount.widest = max(WidestCount.widest, len(text))
+        return super().count(text)
+
+
+@pytest.fixture
+def meter():
+    WidestCount.widest = 0
+    register_tokenizer("widest", lambda family: WidestCount())
+    return UsageMeter("widest", [])
+
+
+def test_pieces_cut_at_whitespace_add_up_to_the_whole_reply(meter):
+    text = "The gateway streams tokens, 12345 of them, as they arrive.\nDone."
+    for i in range(0, len(text), 3):
+        meter.feed(text[i:i + 3])
+    assert meter.completion_tokens == ApproximateTokenizer().count(text)
+
+
+def test_long_text_without_whitespace_is_counted_in_bounded_pieces(meter):
+    text = "流式输出的每个词元都会被计数" * 1500
+    for i in range(0, len(text), 2):
+        chunk = text[i:i + 2]
+        meter.peek(chunk)
+        meter.feed(chunk)
+
+    assert WidestCount.widest <= 2 * tokens.PENDING_CHARS + 2
+    whole = ApproximateTokenizer().count(text)
+    assert abs(meter.completion_tokens - whole) <= whole * 0.01
@@ -0,0 +1,76 @@
+"""
+Benchmark: SSE framing cost per streamed token.
+
+Compares the old per-token dict + json.dumps framing with the ChunkEncoder
+byte templates in gateway/sse.py, then runs the encoder with coalescing
+against tokens arriving at a fixed rate. Reports frames/s, frames per token
+and CPU time per token.
+
+    python tools/bench_sse.py --tokens 200000 --rate 2000 --coalesce-ms 20
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gateway import completion_chunk, new_completion_id, sse_stream  # noqa: E402
+
+TOKENS = ["Hello", " world", ",", " the", " quick", " brown", " fox", "\n", " été", " \"q\""]
+
+
+def legacy_stream(tokens, model_name):
+    """The framing chat_completions used before ChunkEncoder."""
+    completion_id = new_completion_id()
+    created = int(time.time())
+    yield f"data: {json.dumps(completion_chunk(completion_id, created, model_name, {'role': 'assistant'}))}\n\n"
+    for token in tokens:
+        yield f"data: {json.dumps(completion_chunk(completion_id, created, model_name, {'content': token}))}\n\n"
+    yield f"data: {json.dumps(completion_chunk(completion_id, created, model_name, {}, 'stop'))}\n\n"
+    yield "data: [DONE]\n\n"
+
+
+def token_source(n, rate=None):
+    interval = 1 / rate if rate else 0
+    for i in range(n):
+        if interval:
+            time.sleep(interval)
+        yield TOKENS[i % len(TOKENS)]
+
+
+def run(name, frames_iter, tokens):
+    wall, cpu = time.perf_counter(), time.process_time()
+    frames = 0
+    size = 0
+    for frame in frames_iter:
+        frames += 1
+        size += len(frame)
+    wall = time.perf_counter() - wall
+    cpu = time.process_time() - cpu
+    print(f"{name:26s} {frames:8d} frames  {frames / wall:12,.0f} frames/s  "
+          f"{frames / tokens:5.2f} frames/token  {cpu / tokens * 1e9:7.0f} ns CPU/token  {size / 1024:8.0f} KiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--tokens", type=int, default=200000, help="tokens for the framing comparison")
+    parser.add_argument("--rate", type=float, default=2000, help="tokens/s for the coalescing runs")
+    parser.add_argument("--paced-tokens", type=int, default=4000, help="tokens for the coalescing runs")
+    parser.add_argument("--coalesce-ms", type=float, default=20)
+    args = parser.parse_args()
+
+    print(f"framing, {args.tokens} tokens as fast as possible")
+    run("json.dumps per token", legacy_stream(token_source(args.tokens), "bench"), args.tokens)
+    run("ChunkEncoder", sse_stream(token_source(args.tokens), "bench", coalesce_ms=0), args.tokens)
+
+    n = args.paced_tokens
+    print(f"\ncoalescing, {n} tokens at {args.rate:.0f} tokens/s")
+    run("ChunkEncoder", sse_stream(token_source(n, args.rate), "bench", coalesce_ms=0), n)
+    run(f"ChunkEncoder + {args.coalesce_ms:g} ms", sse_stream(token_source(n, args.rate), "bench",
+                                                     coalesce_ms=args.coalesce_ms), n)
+
+
+if __name__ == "__main__":
+    main()
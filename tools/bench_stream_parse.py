@@ -0,0 +1,156 @@
+"""
+Microbenchmark: per-token cost of parsing upstream token streams.
+
+Builds synthetic Gradio queue/data SSE and Cohere NDJSON streams (tokens
+mixed with heartbeats, estimation and status messages), cuts them into
+socket-sized chunks, and times the shared byte-level parsers in
+Provider/streamparse.py against the line-by-line json.loads loops the
+providers used before.
+
+    python tools/bench_stream_parse.py --tokens 20000 --noise 0.5
+"""
+import argparse
+import codecs
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Provider import streamparse  # noqa: E402
+
+CHUNK = 4096
+
+
+# =======================
+# SYNTHETIC STREAMS
+# =======================
+def _token(i):
+    return random.choice(["Hello", " world", ",", " the", " quick\n", " été", " \"quoted\""]) + str(i % 10)
+
+
+def gradio_stream(tokens, noise, index=4):
+    """SSE bytes carrying `tokens` append ops at output.data[index]."""
+    lines = []
+    for _ in range(5):
+        lines.append({"msg": "estimation", "event_id": "e1", "rank": 3, "queue_size": 9, "rank_eta": 4.2})
+    lines.append({"msg": "process_starts", "event_id": "e1", "eta": 1.0})
+    for i in range(tokens):
+        data = [None] * (index + 1)
+        data[index] = [["append", [1, "content"], _token(i)]]
+        lines.append({"msg": "process_generating", "event_id": "e1", "output": {"data": data}, "success": True})
+        if random.random() < noise:
+            lines.append({"msg": "heartbeat"})
+    lines.append({"msg": "process_completed", "event_id": "e1", "output": {"data": []}, "success": True})
+    return "".join(f"data: {json.dumps(obj)}\n\n" for obj in lines).encode()
+
+
+def cohere_stream(tokens, noise):
+    """NDJSON bytes like Cohere's chat endpoint."""
+    lines = [{"type": "status", "status": "started"}]
+    for i in range(tokens):
+        lines.append({"type": "stream", "token": _token(i)})
+        if random.random() < noise:
+            lines.append({"type": "status", "status": "keepAlive"})
+    lines.append({"type": "finalAnswer", "text": "..."})
+    return "".join(json.dumps(obj) + "\n" for obj in lines).encode()
+
+
+def chunks(data):
+    return [data[i:i + CHUNK] for i in range(0, len(data), CHUNK)]
+
+
+def _iter_lines(byte_chunks):
+    """What the providers got from httpx's iter_lines(): decoded text lines."""
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    tail = ""
+    for chunk in byte_chunks:
+        text = tail + decoder.decode(chunk)
+        lines = text.split("\n")
+        tail = lines.pop()
+        yield from lines
+    if tail:
+        yield tail
+
+
+# =======================
+# PARSERS
+# =======================
+def legacy_gradio(byte_chunks, index=4):
+    for line in _iter_lines(byte_chunks):
+        if not line or not line.startswith("data: "):
+            continue
+        data = json.loads(line[6:])
+        if data.get("msg") == "process_generating":
+            outputs = data.get("output", {}).get("data", [])
+            if not outputs:
+                continue
+            for patch in outputs[index]:
+                if len(patch) == 3:
+                    op, path, value = patch
+                    if op == "append" and isinstance(value, str):
+                        yield value
+
+
+def shared_gradio(byte_chunks, index=4):
+    for event in streamparse.gradio_events(byte_chunks):
+        yield from streamparse.append_tokens(event, index)
+
+
+def legacy_cohere(byte_chunks):
+    for line in _iter_lines(byte_chunks):
+        if not line.strip():
+            continue
+        try:
+            obj = json.loads(line)
+        except ValueError:
+            continue
+        if obj.get("type") == "stream":
+            yield obj["token"].replace("\x00", "")
+
+
+def shared_cohere(byte_chunks):
+    return streamparse.cohere_tokens(byte_chunks)
+
+
+# =======================
+# BENCH
+# =======================
+def bench(parser, byte_chunks, tokens, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        n = sum(1 for _ in parser(byte_chunks))
+        best = min(best, time.perf_counter() - started)
+    assert n == tokens, f"{parser.__name__} produced {n} tokens, expected {tokens}"
+    return best / tokens * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--tokens", type=int, default=20000)
+    parser.add_argument("--noise", type=float, default=0.5, help="non-token messages per token")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    random.seed(0)
+    gradio = chunks(gradio_stream(args.tokens, args.noise))
+    cohere = chunks(cohere_stream(args.tokens, args.noise))
+
+    assert list(legacy_gradio(gradio)) == list(shared_gradio(gradio))
+    assert list(legacy_cohere(cohere)) == list(shared_cohere(cohere))
+
+    print(f"{args.tokens} tokens, noise {args.noise}, JSON backend: {streamparse.JSON_BACKEND}")
+    for name, legacy, shared, stream in (
+        ("gradio sse", legacy_gradio, shared_gradio, gradio),
+        ("cohere ndjson", legacy_cohere, shared_cohere, cohere),
+    ):
+        before = bench(legacy, stream, args.tokens, args.repeat)
+        after = bench(shared, stream, args.tokens, args.repeat)
+        print(f"{name:14s} legacy {before:8.0f} ns/token   shared {after:8.0f} ns/token   {before / after:5.2f}x")
+
+
+if __name__ == "__main__":
+    main()
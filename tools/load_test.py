@@ -0,0 +1,208 @@
+"""
+Load driver for the gateway.
+
+Sends streaming chat completions to a gateway at a fixed concurrency and
+reports requests/s, completion tokens/s, and p50/p90/p99 of time to first
+token, inter-token gaps and total latency, plus failures by status. Each
+request gets a unique prompt, so the completion cache does not answer it.
+
+With --local, tools/mock_spaces.py and app.py are first started in this
+process, with every provider pointed at the mock, so no real Space is
+touched. Rate limits, batches and the usage ledger are off there, as
+everywhere, unless set in the environment. The mock options (--token-rate,
+--queue-delay, --error-rate, --replay...) shape the upstream.
+
+    python tools/load_test.py --local --concurrency 32 --requests 500
+    python tools/load_test.py --local --token-rate 20 --queue-delay 0.5 --duration 60
+    python tools/load_test.py --url http://127.0.0.1:7860 --key sk-... --model Qwen3VL
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mock_spaces  # noqa: E402
+
+MODELS = ["Qwen3VL", "Qwen3Omni", "gpt-oss-120b", "command-a"]
+DEFAULT_KEY = "sk-apinow-tbfgenratedpro"
+
+
+# =======================
+# LOCAL GATEWAY
+# =======================
+def start_local(args):
+    """Start the mock Spaces and app.py on free ports; returns the gateway URL."""
+    settings = mock_spaces.Settings(
+        queue_delay=args.queue_delay, token_rate=args.token_rate, jitter=args.jitter, tokens=args.tokens,
+        space_concurrency=args.space_concurrency, error_rate=args.error_rate,
+        errors=tuple(e for e in args.errors.split(",") if e), speed=args.speed,
+    )
+    _, upstream = mock_spaces.serve(settings, replay=args.replay)
+    os.environ.update(mock_spaces.endpoint_env(upstream))
+
+    from werkzeug.serving import WSGIRequestHandler, make_server
+    import app as gateway
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args):
+            pass
+
+    server = make_server("127.0.0.1", 0, gateway.app, threaded=True, request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+
+# =======================
+# REQUESTS
+# =======================
+class Result:
+    __slots__ = ("model", "status", "ttft", "gaps", "latency", "tokens")
+
+    def __init__(self, model, status, ttft=None, gaps=(), latency=None, tokens=0):
+        self.model = model
+        self.status = status
+        self.ttft = ttft
+        self.gaps = gaps
+        self.latency = latency
+        self.tokens = tokens
+
+
+async def one_request(client, url, key, model, i, args):
+    body = {
+        "model": model,
+        "messages": [{"role": "user", "content": f"request {i}: {args.prompt}"}],
+        "stream": True,
+        "stream_options": {"include_usage": True},
+    }
+    if args.max_tokens:
+        body["max_tokens"] = args.max_tokens
+    started = time.perf_counter()
+    first, last, gaps, tokens = None, None, [], 0
+    try:
+        async with client.stream("POST", url, json=body, headers={"Authorization": f"Bearer {key}"}) as res:
+            if res.status_code != 200:
+                await res.aread()
+                return Result(model, res.status_code)
+            async for line in res.aiter_lines():
+                if not line.startswith("data: {"):
+                    continue
+                chunk = json.loads(line[6:])
+                if "error" in chunk:
+                    return Result(model, "stream error")
+                if chunk.get("usage"):
+                    tokens = chunk["usage"]["completion_tokens"]
+                if not any(c["delta"].get("content") for c in chunk.get("choices", ())):
+                    continue
+                now = time.perf_counter()
+                if first is None:
+                    first = now
+                else:
+                    gaps.append(now - last)
+                last = now
+    except httpx.HTTPError as e:
+        return Result(model, type(e).__name__)
+    if first is None:
+        return Result(model, "no tokens")
+    return Result(model, 200, first - started, gaps, time.perf_counter() - started, tokens)
+
+
+async def drive(url, args):
+    endpoint = url.rstrip("/") + "/v1/chat/completions"
+    models = args.model or MODELS
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    results = []
+    counter = iter(range(args.requests or (sys.maxsize if args.duration else 200)))
+    stop_at = time.perf_counter() + args.duration if args.duration else None
+
+    async def worker(client):
+        for i in counter:
+            if stop_at is not None and time.perf_counter() >= stop_at:
+                return
+            results.append(await one_request(client, endpoint, args.key, models[i % len(models)], i, args))
+
+    async with httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(args.timeout)) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+    return results, elapsed
+
+
+# =======================
+# REPORT
+# =======================
+def percentile(values, p):
+    """Nearest-rank percentile of sorted `values`."""
+    if not values:
+        return float("nan")
+    return values[min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))]
+
+
+def summarize(label, results, elapsed):
+    ok = [r for r in results if r.status == 200]
+    failures = {}
+    for r in results:
+        if r.status != 200:
+            failures[str(r.status)] = failures.get(str(r.status), 0) + 1
+    tokens = sum(r.tokens for r in ok)
+    print(f"{label}: {len(results)} requests, {len(ok) / elapsed:.1f} req/s, "
+          f"{tokens / elapsed:.0f} completion tokens/s")
+    series = {
+        "ttft": sorted(r.ttft for r in ok),
+        "inter-token": sorted(g for r in ok for g in r.gaps),
+        "latency": sorted(r.latency for r in ok),
+    }
+    for name, values in series.items():
+        print(f"  {name:<12}" + "  ".join(f"p{p} {percentile(values, p) * 1000:8.1f} ms" for p in (50, 90, 99)))
+    if failures:
+        print("  failures    " + ", ".join(f"{status}: {n}" for status, n in sorted(failures.items())))
+    return not failures
+
+
+def report(results, elapsed, concurrency):
+    """Print the totals, then each model's when there are several; returns False on any failure."""
+    models = sorted({r.model for r in results})
+    passed = summarize(f"all in {elapsed:.2f}s at concurrency {concurrency}", results, elapsed)
+    if len(models) > 1:
+        for model in models:
+            summarize(model, [r for r in results if r.model == model], elapsed)
+    return passed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--url", help="gateway to load (default: --local)")
+    parser.add_argument("--local", action="store_true", help="start the mock Spaces and app.py here")
+    parser.add_argument("--key", default=DEFAULT_KEY)
+    parser.add_argument("--model", action="append", help=f"model to call, repeatable (default: {', '.join(MODELS)})")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, help="requests to send (default: 200, or no limit with --duration)")
+    parser.add_argument("--duration", type=float, help="stop sending after this many seconds")
+    parser.add_argument("--max-tokens", type=int)
+    parser.add_argument("--prompt", default="Say something.")
+    parser.add_argument("--timeout", type=float, default=120)
+    mock = parser.add_argument_group("mock Spaces (with --local)")
+    mock.add_argument("--queue-delay", type=float, default=0.0)
+    mock.add_argument("--token-rate", type=float, default=50.0)
+    mock.add_argument("--jitter", type=float, default=0.0)
+    mock.add_argument("--tokens", type=int, default=64)
+    mock.add_argument("--space-concurrency", type=int, default=8)
+    mock.add_argument("--error-rate", type=float, default=0.0)
+    mock.add_argument("--errors", default="http,error,drop")
+    mock.add_argument("--replay")
+    mock.add_argument("--speed", type=float, default=1.0)
+    args = parser.parse_args()
+
+    url = args.url if args.url and not args.local else start_local(args)
+    results, elapsed = asyncio.run(drive(url, args))
+    sys.exit(0 if report(results, elapsed, args.concurrency) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,674 @@
+"""
+Local stand-ins for the Hugging Face Spaces the providers call.
+
+One server speaks each upstream's protocol under its own prefix, so the
+gateway can be load tested without touching the real Spaces:
+
+    /omni /vl /amd  Gradio: run/predict, queue/join, cancel, and the
+                    queue/data SSE stream (estimation, process_starts,
+                    process_generating diffs at the output index each
+                    provider reads, process_completed, close_stream)
+    /c4ai           Cohere chat-ui: conversation, __data.json, the NDJSON
+                    chat stream and stop-generating
+
+Every job waits --queue-delay seconds in its Space's queue, which sends
+estimation messages meanwhile. At most --space-concurrency jobs per Space
+generate at once. Tokens come at --token-rate per second with +/- --jitter.
+--error-rate injects failures of the --errors kinds:
+
+    http    a 500 on queue/join or on the Cohere chat POST
+    error   an `unexpected_error` message, or a Cohere error status line
+    drop    the connection closed halfway through the reply
+
+With --capture FILE, requests are proxied to the real Spaces instead, and
+each job's stream is appended to FILE as one JSON line with its timings.
+--replay FILE serves those recordings back with their original pacing,
+scaled by --speed. Spaces without recordings keep the synthetic replies.
+--upstream NAME=URL captures from another copy of a Space.
+
+    python tools/mock_spaces.py --port 9200 --token-rate 50 --error-rate 0.01
+    python tools/mock_spaces.py --port 9200 --capture recordings.jsonl --upstream vl=https://my-copy.hf.space
+    python tools/mock_spaces.py --port 9200 --replay recordings.jsonl
+
+It prints the <PROVIDER>_ENDPOINTS variables that point the gateway at it.
+"""
+import argparse
+import email
+import itertools
+import json
+import queue
+import random
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import NamedTuple
+from urllib.parse import parse_qs, urlsplit
+
+import httpx
+
+
+class Space(NamedTuple):
+    env: str              # endpoint variable of the provider
+    upstream: str         # the real Space, for --capture
+    output: int = None    # Gradio output index the provider reads tokens from
+    path: list = None     # component path of its append diffs
+
+
+SPACES = {
+    "omni": Space("QWEN3OMNI_ENDPOINTS", "https://qwen-qwen3-omni-demo.hf.space", 4, ["value", 1, "content"]),
+    "vl": Space("QWEN3VL_ENDPOINTS", "https://qwen-qwen3-vl-demo.hf.space", 5, ["value", 1, "content", 0, "content"]),
+    "amd": Space("GPT_OSS_120B_ENDPOINTS", "https://amd-gpt-oss-120b-chatbot.hf.space", 1, [1, "content"]),
+    "c4ai": Space("C4AI_ENDPOINTS", "https://coherelabs-c4ai-command.hf.space"),
+}
+
+WORDS = ("the", "gateway", "streams", "tokens", "from", "a", "local", "space", "under", "load", "and",
+         "measures", "every", "reply", "as", "it", "arrives", "quickly")
+HEARTBEAT = 15
+CLOSE_GRACE = 1.0
+DROP = object()
+
+
+class Settings(NamedTuple):
+    queue_delay: float = 0.0
+    token_rate: float = 50.0
+    jitter: float = 0.0
+    tokens: int = 64
+    space_concurrency: int = 8
+    error_rate: float = 0.0
+    errors: tuple = ("http", "error", "drop")
+    speed: float = 1.0
+
+
+def endpoint_env(base):
+    """<PROVIDER>_ENDPOINTS variables pointing every provider at `base`."""
+    return {space.env: f"{base}/{name}" for name, space in SPACES.items()}
+
+
+# =======================
+# RECORDINGS
+# =======================
+class Recorder:
+    """Appends captured job streams to a JSONL file."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.records = 0
+
+    def write(self, space, frames):
+        line = json.dumps({"space": space, "frames": frames}, ensure_ascii=False)
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+            self.records += 1
+
+
+class Replays:
+    """Recorded job streams per Space, handed out round-robin."""
+
+    def __init__(self, path=None):
+        recorded = {}
+        if path is not None:
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        recorded.setdefault(record["space"], []).append(record["frames"])
+        self.counts = {space: len(frames) for space, frames in recorded.items()}
+        self._cycles = {space: itertools.cycle(frames) for space, frames in recorded.items()}
+        self._lock = threading.Lock()
+
+    def next(self, space):
+        with self._lock:
+            cycle = self._cycles.get(space)
+            return next(cycle) if cycle is not None else None
+
+
+# =======================
+# MOCK SPACES
+# =======================
+class _Session:
+    """Messages waiting for a Gradio session's data stream."""
+
+    def __init__(self):
+        self.messages = queue.Queue()
+        self.active = 0
+
+
+class _Job:
+    def __init__(self, space, session_hash):
+        self.event_id = uuid.uuid4().hex
+        self.space = space
+        self.session_hash = session_hash
+        self.cancelled = threading.Event()
+
+
+class _Conversation:
+    def __init__(self):
+        self.id = uuid.uuid4().hex[:24]
+        self.cookie = uuid.uuid4().hex
+        self.messages = [str(uuid.uuid4())]
+        self.stop = threading.Event()
+
+
+class MockSpaces:
+    """Generation state shared by the handler threads."""
+
+    def __init__(self, settings, replays=None):
+        self.settings = settings
+        self.replays = replays or Replays()
+        self.slots = {name: threading.BoundedSemaphore(settings.space_concurrency) for name in SPACES}
+        self.waiting = {name: 0 for name in SPACES}
+        self.sessions = {}
+        self.jobs = {}
+        self.conversations = {}
+        self.lock = threading.Lock()
+        self.stats = {"jobs": 0, "chats": 0, "cancelled": 0, "faults": 0}
+        self._random = random.Random()
+
+    # -----------------------------------------------------
+    def fault(self):
+        """An injected failure kind for the next job, or None."""
+        s = self.settings
+        if s.error_rate and self._random.random() < s.error_rate:
+            with self.lock:
+                self.stats["faults"] += 1
+            return self._random.choice(s.errors)
+        return None
+
+    def pause(self):
+        s = self.settings
+        if s.token_rate > 0:
+            time.sleep(max(0.0, (1 + s.jitter * self._random.uniform(-1, 1)) / s.token_rate))
+
+    def reply(self):
+        return [(" " if i else "") + self._random.choice(WORDS) for i in range(self.settings.tokens)]
+
+    def replay(self, frames, cancelled):
+        """Recorded `frames` with their pacing, until `cancelled` is set."""
+        speed = self.settings.speed
+        last = 0.0
+        for at, frame in frames:
+            if speed > 0 and at > last:
+                time.sleep((at - last) / speed)
+            last = at
+            if cancelled.is_set():
+                return
+            yield frame
+
+    def queued(self, name, wait):
+        """Hold a job in the Space's queue, then take a generation slot; `wait(rank)` paces it."""
+        with self.lock:
+            rank = self.waiting[name]
+            self.waiting[name] += 1
+        try:
+            wait(rank)
+            self.slots[name].acquire()
+        finally:
+            with self.lock:
+                self.waiting[name] -= 1
+
+    # ------------------ GRADIO ------------------
+    def join(self, name, session_hash, fault=None):
+        job = _Job(name, session_hash)
+        with self.lock:
+            session = self.sessions.setdefault((name, session_hash), _Session())
+            session.active += 1
+            self.jobs[job.event_id] = job
+            self.stats["jobs"] += 1
+        threading.Thread(target=self._run_job, args=(job, session, fault), daemon=True).start()
+        return job
+
+    def cancel(self, event_id):
+        with self.lock:
+            job = self.jobs.get(event_id)
+            if job is not None:
+                self.stats["cancelled"] += 1
+        if job is not None:
+            job.cancelled.set()
+
+    def _run_job(self, job, session, fault):
+        name, space, put = job.space, SPACES[job.space], session.messages.put
+        try:
+            frames = self.replays.next(name)
+            if frames is not None:
+                self.queued(name, lambda rank: None)
+                try:
+                    for message in self.replay(frames, job.cancelled):
+                        put({**message, "event_id": job.event_id})
+                finally:
+                    self.slots[name].release()
+                return
+
+            def wait(rank):
+                eta = self.settings.queue_delay
+                put({"msg": "estimation", "event_id": job.event_id, "rank": rank,
+                     "queue_size": rank + 1, "rank_eta": eta})
+                if eta:
+                    time.sleep(eta)
+
+            self.queued(name, wait)
+            try:
+                put({"msg": "process_starts", "event_id": job.event_id, "eta": None})
+                tokens = self.reply()
+                for i, token in enumerate(tokens):
+                    self.pause()
+                    if job.cancelled.is_set():
+                        put({"msg": "process_completed", "event_id": job.event_id, "output": {}, "success": False})
+                        return
+                    if fault in ("error", "drop") and i == len(tokens) // 2:
+                        if fault == "drop":
+                            put(DROP)
+                        else:
+                            put({"msg": "unexpected_error", "event_id": job.event_id,
+                                 "message": "Injected error", "success": False})
+                        return
+                    data = [None] * (space.output + 1)
+                    data[space.output] = [["append", space.path, token]]
+                    put({"msg": "process_generating", "event_id": job.event_id,
+                         "output": {"data": data, "is_generating": True}, "success": True})
+                put({"msg": "process_completed", "event_id": job.event_id,
+                     "output": {"data": [None] * (space.output + 1), "is_generating": False}, "success": True})
+            finally:
+                self.slots[name].release()
+        finally:
+            with self.lock:
+                self.jobs.pop(job.event_id, None)
+                session.active -= 1
+
+    def session_messages(self, name, session_hash):
+        """The session's messages for one data stream; ends once it has no jobs left."""
+        with self.lock:
+            session = self.sessions.setdefault((name, session_hash), _Session())
+        idle = 0.0
+        while True:
+            try:
+                message = session.messages.get(timeout=CLOSE_GRACE)
+            except queue.Empty:
+                with self.lock:
+                    done = not session.active and session.messages.empty()
+                    if done:
+                        self.sessions.pop((name, session_hash), None)
+                if done:
+                    yield {"msg": "close_stream"}
+                    return
+                idle += CLOSE_GRACE
+                if idle >= HEARTBEAT:
+                    idle = 0.0
+                    yield {"msg": "heartbeat"}
+                continue
+            idle = 0.0
+            yield message
+            if message is DROP:
+                return
+
+    # ------------------ COHERE ------------------
+    def new_conversation(self):
+        conv = _Conversation()
+        with self.lock:
+            self.conversations[conv.id] = conv
+        return conv
+
+    def conversation(self, con_id):
+        with self.lock:
+            return self.conversations.get(con_id)
+
+    @staticmethod
+    def data_json(conv):
+        """The conversation as the devalue-encoded node __data.json returns."""
+        data = [{"messages": 1}, []]
+        for msgid in conv.messages:
+            data[1].append(len(data))
+            data.append({"id": len(data) + 1})
+            data.append(msgid)
+        return {"type": "data", "nodes": [{"type": "data", "data": []}, {"type": "data", "data": data}]}
+
+    def chat(self, conv, fault):
+        """NDJSON lines of one reply on `conv`."""
+        with self.lock:
+            self.stats["chats"] += 1
+        conv.stop.clear()
+        conv.messages += [str(uuid.uuid4()), str(uuid.uuid4())]
+
+        frames = self.replays.next("c4ai")
+        if frames is not None:
+            self.queued("c4ai", lambda rank: None)
+            try:
+                yield from self.replay(frames, conv.stop)
+            finally:
+                self.slots["c4ai"].release()
+            return
+
+        yield {"type": "status", "status": "started"}
+        self.queued("c4ai", lambda rank: time.sleep(self.settings.queue_delay))
+        try:
+            tokens = self.reply()
+            for i, token in enumerate(tokens):
+                self.pause()
+                if conv.stop.is_set():
+                    yield {"type": "finalAnswer", "text": "".join(tokens[:i]), "interrupted": True}
+                    return
+                if fault in ("error", "drop") and i == len(tokens) // 2:
+                    yield DROP if fault == "drop" else {"type": "status", "status": "error",
+                                                        "message": "Injected error"}
+                    return
+                yield {"type": "stream", "token": token}
+            yield {"type": "finalAnswer", "text": "".join(tokens), "interrupted": False}
+        finally:
+            self.slots["c4ai"].release()
+
+
+# =======================
+# HTTP
+# =======================
+def _sse(message):
+    return "data: " + json.dumps(message, ensure_ascii=False) + "\n\n"
+
+
+def _multipart_field(content_type, body, name):
+    """One form field of a multipart/form-data body."""
+    message = email.message_from_bytes(b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body)
+    for part in message.get_payload() if message.is_multipart() else ():
+        if part.get_param("name", header="content-disposition") == name:
+            return part.get_payload(decode=True).decode()
+    return None
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    spaces = None  # MockSpaces, set by serve()
+
+    def log_message(self, *args):
+        pass
+
+    def _body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def _json(self, obj, status=200, headers=()):
+        body = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _stream(self, frames, content_type):
+        """Write `frames` as a chunked response; DROP cuts the connection instead of ending it."""
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for frame in frames:
+                if frame is DROP:
+                    self.close_connection = True
+                    return
+                data = frame.encode()
+                self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                self.wfile.flush()
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+    def _route(self):
+        parts = urlsplit(self.path)
+        name, _, rest = parts.path.lstrip("/").partition("/")
+        return name, rest, parse_qs(parts.query)
+
+    # -----------------------------------------------------
+    def do_POST(self):
+        name, rest, _ = self._route()
+        body = self._body()
+        if name not in SPACES:
+            return self._json({"detail": "Not Found"}, 404)
+        if name == "c4ai":
+            return self._cohere_post(rest, body)
+
+        if rest == "gradio_api/run/predict":
+            return self._json({"data": [], "is_generating": False, "duration": 0.0, "average_duration": 0.0})
+        if rest == "gradio_api/cancel":
+            self.spaces.cancel(json.loads(body).get("event_id"))
+            return self._json({"success": True})
+        if rest == "gradio_api/queue/join":
+            fault = self.spaces.fault()
+            if fault == "http":
+                return self._json({"detail": "Injected error"}, 500)
+            job = self.spaces.join(name, json.loads(body)["session_hash"], fault)
+            return self._json({"event_id": job.event_id})
+        return self._json({"detail": "Not Found"}, 404)
+
+    def do_GET(self):
+        name, rest, query = self._route()
+        if name == "stats":
+            return self._json({**self.spaces.stats, "replays": self.spaces.replays.counts})
+        if name not in SPACES:
+            return self._json({"detail": "Not Found"}, 404)
+        if name == "c4ai":
+            return self._cohere_get(rest)
+        if rest == "gradio_api/queue/data":
+            messages = self.spaces.session_messages(name, query["session_hash"][0])
+            return self._stream((m if m is DROP else _sse(m) for m in messages), "text/event-stream")
+        return self._json({}, 200)
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    # ------------------ COHERE ------------------
+    def _conversation(self, con_id):
+        conv = self.spaces.conversation(con_id)
+        if conv is None:
+            self._json({"message": "Conversation not found"}, 404)
+            return None
+        if f"hf-chat={conv.cookie}" not in self.headers.get("Cookie", ""):
+            self._json({"message": "Unauthorized"}, 403)
+            return None
+        return conv
+
+    def _cohere_post(self, rest, body):
+        if rest == "conversation":
+            conv = self.spaces.new_conversation()
+            return self._json({"conversationId": conv.id}, headers=[("Set-Cookie", f"hf-chat={conv.cookie}; Path=/")])
+
+        _, con_id, action = (rest.split("/") + [""])[:3]
+        conv = self._conversation(con_id)
+        if conv is None:
+            return
+        if action == "stop-generating":
+            conv.stop.set()
+            return self._json({})
+
+        fault = self.spaces.fault()
+        if fault == "http":
+            return self._json({"message": "Injected error"}, 500)
+        field = _multipart_field(self.headers.get("Content-Type", ""), body, "data")
+        parent = json.loads(field).get("id") if field else None
+        if parent not in conv.messages:
+            return self._json({"message": "Message not found"}, 400)
+        lines = self.spaces.chat(conv, fault)
+        return self._stream((m if m is DROP else json.dumps(m) + "\n" for m in lines), "application/jsonl")
+
+    def _cohere_get(self, rest):
+        parts = rest.split("/")
+        if len(parts) != 3 or parts[2] != "__data.json":
+            return self._json({}, 200)
+        conv = self._conversation(parts[1])
+        if conv is not None:
+            body = (json.dumps(self.spaces.data_json(conv)) + "\n").encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+
+# =======================
+# CAPTURE PROXY
+# =======================
+HOP_HEADERS = {"host", "content-length", "connection", "accept-encoding", "transfer-encoding", "keep-alive"}
+
+
+def _cookie_for_local(header):
+    """A Set-Cookie header without the attributes that would stop a local client sending it back."""
+    kept = [p for p in header.split(";") if p.strip().split("=")[0].lower() not in ("domain", "secure", "samesite")]
+    return ";".join(kept)
+
+
+class CaptureHandler(BaseHTTPRequestHandler):
+    """Proxies to the real Spaces and records every job's stream."""
+
+    protocol_version = "HTTP/1.1"
+    recorder = None  # Recorder, set by serve()
+    client = None  # httpx.Client, set by serve()
+    upstreams = {}  # space name -> URL, set by serve()
+    joined = {}  # event_id -> (space, monotonic join time, frames)
+    lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def _forward(self, method):
+        parts = urlsplit(self.path)
+        name, _, rest = parts.path.lstrip("/").partition("/")
+        if name not in SPACES:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        url = f"{self.upstreams[name]}/{rest}" + (f"?{parts.query}" if parts.query else "")
+        headers = {k: v for k, v in self.headers.items() if k.lower() not in HOP_HEADERS}
+        headers["Accept-Encoding"] = "identity"
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0))) or None
+        started = time.monotonic()
+
+        with self.client.stream(method, url, content=body, headers=headers) as res:
+            self.send_response(res.status_code)
+            for key, value in res.headers.multi_items():
+                if key.lower() in HOP_HEADERS or key.lower() == "content-encoding":
+                    continue
+                self.send_header(key, _cookie_for_local(value) if key.lower() == "set-cookie" else value)
+            streaming = "text/event-stream" in res.headers.get("content-type", "") or (
+                name == "c4ai" and method == "POST" and rest.count("/") == 1)
+            if not streaming:
+                data = res.read()
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+                if rest.startswith("gradio_api/queue/join") and res.status_code == 200:
+                    with self.lock:
+                        self.joined[res.json().get("event_id")] = (name, started, [])
+                return
+
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            frames = []
+            for line in res.iter_lines():
+                data = (line + ("\n\n" if name != "c4ai" else "\n")).encode() if line else b""
+                if data:
+                    self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                    self.wfile.flush()
+                try:
+                    if name == "c4ai" and line.strip():
+                        frames.append([round(time.monotonic() - started, 4), json.loads(line)])
+                    elif line.startswith("data:"):
+                        self._record_gradio(json.loads(line[5:]))
+                except ValueError:
+                    pass  # not a JSON message; forwarded but not recorded
+            self.wfile.write(b"0\r\n\r\n")
+            if name == "c4ai" and frames:
+                self.recorder.write(name, frames)
+
+    def _record_gradio(self, message):
+        """Add a queue/data message to its job's recording; write it out once the job ends."""
+        with self.lock:
+            job = self.joined.get(message.get("event_id"))
+            if job is None:
+                return
+            name, started, frames = job
+            frames.append([round(time.monotonic() - started, 4), message])
+            if message.get("msg") not in ("process_completed", "unexpected_error"):
+                return
+            del self.joined[message["event_id"]]
+        self.recorder.write(name, frames)
+
+    def do_GET(self):
+        self._forward("GET")
+
+    def do_POST(self):
+        self._forward("POST")
+
+    def do_HEAD(self):
+        self._forward("HEAD")
+
+
+# =======================
+# SERVER
+# =======================
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def handle_error(self, request, client_address):
+        pass  # clients dropping idle keep-alive connections
+
+
+def serve(settings=Settings(), host="127.0.0.1", port=0, replay=None, capture=None, upstreams=None):
+    """Start the mock Spaces (or the capture proxy) in a thread; returns (server, base URL)."""
+    if capture is not None:
+        client = httpx.Client(timeout=httpx.Timeout(120, connect=10), follow_redirects=True)
+        upstreams = {**{name: space.upstream for name, space in SPACES.items()}, **(upstreams or {})}
+        handler = type("Capture", (CaptureHandler,), {
+            "recorder": Recorder(capture), "client": client, "upstreams": upstreams,
+        })
+    else:
+        handler = type("Mock", (MockHandler,), {"spaces": MockSpaces(settings, Replays(replay))})
+    server = MockServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9200)
+    parser.add_argument("--queue-delay", type=float, default=0.0, help="seconds each job waits in the queue")
+    parser.add_argument("--token-rate", type=float, default=50.0, help="tokens per second per job (0: no pacing)")
+    parser.add_argument("--jitter", type=float, default=0.0, help="+/- fraction of the token interval")
+    parser.add_argument("--tokens", type=int, default=64, help="tokens per synthetic reply")
+    parser.add_argument("--space-concurrency", type=int, default=8, help="jobs generating at once per Space")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of jobs that fail")
+    parser.add_argument("--errors", default="http,error,drop", help="failure kinds to inject")
+    parser.add_argument("--replay", help="JSONL recordings to serve")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed-up (0: no pacing)")
+    parser.add_argument("--capture", help="proxy to the real Spaces and append recordings here")
+    parser.add_argument("--upstream", action="append", default=[], metavar="NAME=URL",
+                        help=f"Space to capture from instead of the default ({', '.join(SPACES)})")
+    args = parser.parse_args()
+    upstreams = dict(u.split("=", 1) for u in args.upstream)
+    unknown = set(upstreams) - set(SPACES)
+    if unknown:
+        parser.error(f"unknown Space {', '.join(sorted(unknown))}")
+
+    settings = Settings(
+        queue_delay=args.queue_delay, token_rate=args.token_rate, jitter=args.jitter, tokens=args.tokens,
+        space_concurrency=args.space_concurrency, error_rate=args.error_rate,
+        errors=tuple(e for e in args.errors.split(",") if e), speed=args.speed,
+    )
+    server, base = serve(settings, args.host, args.port, args.replay, args.capture, upstreams)
+    print(f"{'capturing to ' + args.capture if args.capture else 'mock Spaces'} on {base}")
+    for env, url in endpoint_env(base).items():
+        print(f"export {env}={url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+        sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,280 @@
+"""
+Concurrency stress check for the shared provider engines.
+
+Starts a local echo upstream that speaks each provider's protocol, points the
+singleton engines at it, and fires many overlapping create()/acreate() calls
+through ONE engine per provider. Every call carries a unique marker; the
+upstream echoes back whatever it received for that session, so a response
+containing another call's marker (or missing its own) means per-request
+state leaked between calls.
+
+    python tools/stress_engines.py --calls 200 --concurrency 64
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Provider import make_workable  # noqa: E402
+from Provider.space_queues import space_queues  # noqa: E402
+
+MARKER = re.compile(r"M\d{6}X")
+TOKEN_DELAY = 0.002
+
+
+# =======================
+# ECHO UPSTREAM
+# =======================
+class EchoUpstream(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    received = {}
+    pending = {}  # session_hash -> [(event_id, text)] joined but not yet streamed
+    lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length).decode()
+
+    def _json(self, obj, headers=()):
+        body = json.dumps(obj).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _stream(self, frames, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for frame in frames:
+            data = frame.encode()
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+            time.sleep(TOKEN_DELAY)
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _remember(self, key, text):
+        with self.lock:
+            self.received.setdefault(key, []).append(text)
+
+    def _recall(self, key):
+        with self.lock:
+            return "".join(self.received.pop(key, []))
+
+    # -----------------------------------------------------
+    def do_POST(self):
+        parts = urlsplit(self.path)
+        kind, _, rest = parts.path.lstrip("/").partition("/")
+        body = self._body()
+
+        if kind == "c4ai":
+            if rest == "conversation":
+                con_id = uuid.uuid4().hex[:12]
+                self._remember(con_id, body)
+                return self._json({"conversationId": con_id}, [("Set-Cookie", f"hf-chat={con_id}; Path=/")])
+
+            con_id = rest.rsplit("/", 1)[-1]
+            if f"hf-chat={con_id}" not in self.headers.get("Cookie", ""):
+                self.send_response(403)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            text = self._recall(con_id) + body
+            frames = [json.dumps({"type": "stream", "token": text[i:i + 16]}) + "\n"
+                      for i in range(0, len(text), 16)]
+            return self._stream(frames, "application/jsonl")
+
+        payload = json.loads(body)
+        session_hash = payload["session_hash"]
+        data = json.dumps(payload["data"], ensure_ascii=False)
+        if not rest.startswith("gradio_api/queue/join"):
+            self._remember(session_hash, data)
+            return self._json({"data": []})
+
+        # A job sees what its session staged with run/predict plus its own inputs
+        event_id = uuid.uuid4().hex
+        with self.lock:
+            text = "".join(self.received.pop(session_hash, [])) + data
+            self.pending.setdefault(session_hash, []).append((event_id, text))
+        return self._json({"event_id": event_id})
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        kind, _, rest = parts.path.lstrip("/").partition("/")
+
+        if kind == "c4ai":
+            con_id = rest.split("/")[1]
+            return self._json({"type": "data", "nodes": [{}, {"data": [0, 1, 2, f"msg-{con_id}"]}]})
+
+        session_hash = parse_qs(parts.query)["session_hash"][0]
+        return self._stream(self._session_frames(kind, session_hash), "text/event-stream")
+
+    def _session_frames(self, kind, session_hash):
+        """Interleaved messages for every job of the session, like a Gradio data stream.
+
+        The stream stays open while the session has jobs, picking up jobs
+        joined while it runs, and closes once none are left.
+        """
+        while True:
+            with self.lock:
+                jobs = self.pending.pop(session_hash, [])
+            if not jobs:
+                yield self._sse({"msg": "close_stream"})
+                return
+
+            yield "".join(self._sse({"msg": "estimation", "event_id": event_id, "rank": rank,
+                                     "queue_size": len(jobs), "rank_eta": 0.001 * rank})
+                          for rank, (event_id, _) in enumerate(jobs))
+            chunks = [(event_id, [text[i:i + 16] for i in range(0, len(text), 16)]) for event_id, text in jobs]
+            for step in range(max(len(parts) for _, parts in chunks)):
+                frame = ""
+                for event_id, parts in chunks:
+                    if step >= len(parts):
+                        continue
+                    op = ["append", [1, "content"], parts[step]]
+                    data = {
+                        "omni": [None, None, None, None, [op]],
+                        "vl": [None, None, None, None, None, [op]],
+                        "amd": [None, [op]],
+                    }[kind]
+                    frame += self._sse({"msg": "process_generating", "event_id": event_id, "output": {"data": data}})
+                yield frame  # one token per job per tick
+            yield "".join(self._sse({"msg": "process_completed", "event_id": event_id, "output": {}})
+                          for event_id, _ in jobs)
+
+    @staticmethod
+    def _sse(obj):
+        return "data: " + json.dumps(obj) + "\n\n"
+
+
+class EchoServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def handle_error(self, request, client_address):
+        pass  # clients dropping idle keep-alive connections
+
+
+def start_upstream():
+    server = EchoServer(("127.0.0.1", 0), EchoUpstream)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def point_engines_at(base, dead_replica=False):
+    """Redirect the shared engines to the echo upstream. Returns model names.
+
+    With `dead_replica`, every engine also gets an endpoint nothing listens
+    on, so calls routed there have to fail over before their first token.
+    """
+    targets = {
+        "command-a": "/c4ai",
+        "Qwen3Omni": "/omni",
+        "Qwen3VL": "/vl",
+        "gpt-oss-120b": "/amd",
+    }
+    for model, prefix in targets.items():
+        endpoints = [base + prefix]
+        if dead_replica:
+            endpoints.append("http://127.0.0.1:9" + prefix)
+        make_workable(model).endpoints = endpoints
+    return list(targets)
+
+
+# =======================
+# STRESS
+# =======================
+def messages_for(i):
+    marker = f"M{i:06d}X"
+    return marker, [
+        {"role": "system", "content": f"system {marker}"},
+        {"role": "user", "content": f"hello {marker}"},
+        {"role": "assistant", "content": f"earlier answer {marker}"},
+        {"role": "user", "content": f"question {marker}"},
+    ]
+
+
+def check(marker, text):
+    seen = set(MARKER.findall(text))
+    if seen != {marker}:
+        return f"expected only {marker}, saw {sorted(seen)}"
+    return None
+
+
+def run_sync(models, calls, concurrency):
+    def one(i):
+        model = models[i % len(models)]
+        marker, messages = messages_for(i)
+        engine = make_workable(model)
+        text = "".join(engine.create(messages, model=model, max_tokens=256, stream=bool(i % 2)))
+        return model, check(marker, text)
+
+    with ThreadPoolExecutor(concurrency) as pool:
+        return list(pool.map(one, range(calls)))
+
+
+async def run_async(models, calls, concurrency, offset):
+    gate = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        model = models[i % len(models)]
+        marker, messages = messages_for(i)
+        engine = make_workable(model)
+        async with gate:
+            if i % 2:
+                text = "".join([t async for t in await engine.acreate(messages, model=model, max_tokens=256)])
+            else:
+                text = await engine.acreate(messages, model=model, max_tokens=256, stream=False)
+        return model, check(marker, text)
+
+    return await asyncio.gather(*(one(offset + i) for i in range(calls)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--calls", type=int, default=200, help="calls per mode (sync and async)")
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--dead-replica", action="store_true", help="add an unreachable replica to every engine")
+    args = parser.parse_args()
+
+    models = point_engines_at(start_upstream(), args.dead_replica)
+    engines = {model: id(make_workable(model)) for model in models}
+
+    started = time.perf_counter()
+    results = run_sync(models, args.calls, args.concurrency)
+    results += asyncio.run(run_async(models, args.calls, args.concurrency, args.calls))
+    elapsed = time.perf_counter() - started
+
+    assert engines == {model: id(make_workable(model)) for model in models}, "engines were not reused"
+
+    failures = [(model, err) for model, err in results if err]
+    for model, err in failures[:20]:
+        print(f"FAIL {model}: {err}")
+    print(f"{len(results)} calls through {len(models)} shared engines in {elapsed:.2f}s, "
+          f"{len(failures)} isolation failures")
+    if space_queues is not None:
+        spaces = space_queues.stats()["spaces"]
+        print(f"queue estimates recorded for {len(spaces)} spaces: "
+              f"{sum(s['estimations'] for s in spaces.values())} estimation messages")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()